@@ -1,5 +1,5 @@
 from .launch.launch_api import run_command, run_python
-from .mode import LocalMode, SSHMode, GCPMode
+from .mode import LocalMode, SSHMode, SSHClusterMode, GCPMode
 from .mount import MountLocal, MountGit, MountGCP
 
 __version__ = '1.0.0'
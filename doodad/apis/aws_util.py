@@ -1,29 +1,218 @@
-import subprocess
+"""
+S3 and EC2 helpers built on boto3.
 
-def s3_exists(bucket, path, region=None):
-    cmd = 'aws s3 ls s3://%s/%s' % (bucket, path)
-    if region is not None:
-        cmd += ' --region %s'%region
+S3 transfers use one pooled client per region, so uploads and existence
+checks cost a request rather than an aws CLI process.
+"""
+import collections
+import concurrent.futures
+import os
+import random
+import threading
+import time
+
+from doodad.utils import hash_file_cached, safe_import
+boto3 = safe_import.try_import('boto3')
+boto3.s3 = safe_import.try_import('boto3.s3')
+boto3.s3.transfer = safe_import.try_import('boto3.s3.transfer')
+botocore = safe_import.try_import('botocore')
+botocore.config = safe_import.try_import('botocore.config')
+botocore.exceptions = safe_import.try_import('botocore.exceptions')
+
+# error codes of AWS requests which should be retried
+RETRY_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                     'InternalError', 'Unavailable', 'ServiceUnavailable',
+                     'InvalidSpotInstanceRequestID.NotFound', 'InvalidInstanceID.NotFound')
+NOT_FOUND_ERROR_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+# multipart uploads of large archives, with parts sent concurrently
+MULTIPART_THRESHOLD = 16 * 1024 ** 2
+MULTIPART_CHUNKSIZE = 16 * 1024 ** 2
+MAX_TRANSFER_CONCURRENCY = 10
+MAX_POOL_CONNECTIONS = 32
+# object metadata key holding the md5 of an uploaded file
+MD5_METADATA_KEY = 'doodad-md5'
+# s3_existing_keys sends one HEAD request per key up to this many keys, and
+# lists their directories otherwise. Listings grow with the number of
+# archives ever uploaded, so they only pay off for large sweeps.
+MAX_HEAD_REQUESTS = 32
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_s3_client(region=None):
+    """
+    Returns a shared S3 client for a region. boto3 clients are thread-safe.
+    """
+    with _clients_lock:
+        if region not in _clients:
+            config = botocore.config.Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                                            retries={'max_attempts': 10, 'mode': 'adaptive'})
+            _clients[region] = boto3.client('s3', region_name=region, config=config)
+        return _clients[region]
+
+
+def reset_clients():
+    """
+    Discards shared clients, e.g. after changing credentials.
+    """
+    with _clients_lock:
+        _clients.clear()
+    _uploaded.clear()
+
+
+def _transfer_config():
+    return boto3.s3.transfer.TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                            multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                            max_concurrency=MAX_TRANSFER_CONCURRENCY,
+                                            use_threads=True)
+
+
+def _is_not_found(error):
+    return error.response.get('Error', {}).get('Code') in NOT_FOUND_ERROR_CODES
+
+
+def _head_object(bucket, path, region=None):
     try:
-        result = subprocess.check_output(cmd, shell=True)
-    except subprocess.CalledProcessError:
-        return False
+        return get_s3_client(region).head_object(Bucket=bucket, Key=path)
+    except botocore.exceptions.ClientError as e:
+        if _is_not_found(e):
+            return None
+        raise
 
-    if result:
-        return True
-    else:
-        return False
 
+def s3_exists(bucket, path, region=None):
+    return _head_object(bucket, path, region=region) is not None
+
+
+def s3_existing_keys(bucket, paths, region=None):
+    """
+    Checks which of many paths exist, with concurrent HEAD requests for a
+    few paths or one listing per directory for many.
+
+    Returns:
+        set: The paths which exist
+    """
+    paths = set(paths)
+    if len(paths) <= MAX_HEAD_REQUESTS:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_TRANSFER_CONCURRENCY) as executor:
+            exists = dict(zip(paths, executor.map(lambda path: s3_exists(bucket, path, region=region),
+                                                  paths)))
+        return set([path for path in paths if exists[path]])
+    by_dir = collections.defaultdict(set)
+    for path in paths:
+        by_dir[os.path.dirname(path)].add(path)
+    paginator = get_s3_client(region).get_paginator('list_objects_v2')
+    existing = set()
+    for dirname, dir_paths in by_dir.items():
+        prefix = dirname + '/' if dirname else ''
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            for obj in page.get('Contents', []):
+                if obj['Key'] in dir_paths:
+                    existing.add(obj['Key'])
+    return existing
 
-def s3_upload(local_file_name, s3_bucket, s3_path, dry=False, region=None):
+
+def s3_upload(local_file_name, s3_bucket, s3_path, dry=False, region=None, skip_identical=True):
+    """
+    Uploads a file to S3.
+
+    Args:
+        skip_identical (bool): If True, the upload is skipped when the
+            object already exists with the same md5 checksum.
+    Returns:
+        str: The full s3:// path of the file
+    """
     remote_path = "s3://%s/%s" % (s3_bucket, s3_path)
-    if region is None:
-        upload_cmd = ["aws", "s3", "cp", local_file_name, remote_path]
-    else:
-        upload_cmd = ["aws", "s3", "cp", '--region', region, local_file_name, remote_path]
-    if not dry:
-        subprocess.check_call(upload_cmd)
-    else:
-        print(' '.join(upload_cmd))
+    if dry:
+        print('Upload %s to %s' % (local_file_name, remote_path))
+        return remote_path
+    md5 = hash_file_cached(local_file_name)
+    if skip_identical:
+        head = _head_object(s3_bucket, s3_path, region=region)
+        if head is not None and head.get('Metadata', {}).get(MD5_METADATA_KEY) == md5:
+            return remote_path
+    get_s3_client(region).upload_file(local_file_name, s3_bucket, s3_path,
+                                      ExtraArgs={'Metadata': {MD5_METADATA_KEY: md5}},
+                                      Config=_transfer_config())
     return remote_path
 
+
+# (bucket, path) of files known to be in S3
+_uploaded = set()
+_upload_locks = {}
+_upload_locks_lock = threading.Lock()
+
+
+def s3_upload_by_hash(local_file_name, s3_bucket, s3_dir='doodad/mount', dry=False, region=None):
+    """
+    Uploads a file to s3_dir under a name given by a hash of its contents,
+    unless an identical file was already uploaded.
+
+    Returns:
+        str: The path of the file within the bucket
+    """
+    if dry and not os.path.exists(local_file_name):
+        s3_path = '%s/%s' % (s3_dir, os.path.basename(local_file_name))
+        s3_upload(local_file_name, s3_bucket, s3_path, dry=True, region=region)
+        return s3_path
+    ext = os.path.splitext(local_file_name)[1]
+    s3_path = '%s/%s%s' % (s3_dir, hash_file_cached(local_file_name), ext)
+    key = (s3_bucket, s3_path)
+    with _upload_locks_lock:
+        lock = _upload_locks.setdefault(key, threading.Lock())
+    # concurrent launches of the same file wait for a single upload
+    with lock:
+        if key in _uploaded:
+            return s3_path
+        if dry:
+            s3_upload(local_file_name, s3_bucket, s3_path, dry=True, region=region)
+            return s3_path
+        if not s3_exists(s3_bucket, s3_path, region=region):
+            s3_upload(local_file_name, s3_bucket, s3_path, region=region, skip_identical=False)
+        _uploaded.add(key)
+    return s3_path
+
+
+def s3_upload_many_by_hash(local_file_names, s3_bucket, s3_dir='doodad/mount', region=None):
+    """
+    Uploads many files as in s3_upload_by_hash, checking which already
+    exist with a single listing and uploading the rest concurrently.
+
+    Returns:
+        list: The path of each file within the bucket
+    """
+    s3_paths = ['%s/%s%s' % (s3_dir, hash_file_cached(fname), os.path.splitext(fname)[1])
+                for fname in local_file_names]
+    unknown = set([path for path in s3_paths if (s3_bucket, path) not in _uploaded])
+    if unknown:
+        for path in s3_existing_keys(s3_bucket, unknown, region=region):
+            _uploaded.add((s3_bucket, path))
+    # s3_upload_by_hash uploads the remaining files and updates _uploaded
+    to_upload = [fname for fname, path in zip(local_file_names, s3_paths)
+                 if (s3_bucket, path) not in _uploaded]
+    if to_upload:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_TRANSFER_CONCURRENCY) as executor:
+            futures = [executor.submit(s3_upload_by_hash, fname, s3_bucket, s3_dir, region=region)
+                       for fname in to_upload]
+            for future in futures:
+                future.result()
+    return s3_paths
+
+
+def call_with_backoff(fn, *args, max_retries=8, base_delay=0.5, max_delay=30.0,
+                      retry_codes=RETRY_ERROR_CODES, **kwargs):
+    """
+    Calls a boto3 client method, retrying throttled and transient errors
+    with jittered exponential backoff.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in retry_codes or attempt == max_retries:
+                raise
+            delay = min(max_delay, base_delay * (2 ** attempt))
+            time.sleep(delay * random.uniform(0.5, 1.0))
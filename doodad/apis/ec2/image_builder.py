@@ -0,0 +1,179 @@
+"""
+Builds "prepared" AMIs for EC2Mode(prepared_image=True).
+
+A prepared image has the AWS CLI installed, docker enabled at boot and a
+swap file listed in /etc/fstab, so instances launched from it skip these
+steps in their user data and start the user script sooner.
+
+Example usage:
+
+ec2 = boto3.client('ec2', region_name='us-west-1')
+image_id = image_builder.build_prepared_image(ec2, base_image_id='ami-...',
+                                              name='doodad-prepared')
+mode = EC2Mode(..., ami_name=image_id, prepared_image=True)
+"""
+import time
+
+# written when an image has been prepared
+PREPARED_MARKER = '/etc/doodad/prepared'
+# written to the console of a build instance when preparing it failed
+PREPARE_FAILED = 'DOODAD_PREPARE_FAILED'
+
+AWS_CLI_INSTALL = """
+curl "https://s3.amazonaws.com/aws-cli/awscli-bundle.zip" -o "awscli-bundle.zip"
+unzip awscli-bundle.zip
+sudo ./awscli-bundle/install -i /usr/local/aws -b /usr/local/bin/aws
+"""
+
+
+SWAP_TYPES = ('file', 'instance_store', 'zram')
+
+
+def _swap_file_commands(swap_location, swap_size):
+    # fallocate reserves the blocks without writing zeros to them, but some
+    # filesystems (e.g. btrfs, XFS on older kernels) refuse to swap to a
+    # fallocated file, so write it with dd if any step fails
+    return ('if ! (sudo fallocate -l {swap_size}M {swap_location} && '
+            'sudo chmod 600 {swap_location} && '
+            'sudo mkswap {swap_location} && '
+            'sudo swapon {swap_location}); then\n'
+            'sudo rm -f {swap_location}\n'
+            'sudo dd if=/dev/zero of={swap_location} bs=1M count={swap_size}\n'
+            'sudo chmod 600 {swap_location}\n'
+            'sudo mkswap {swap_location}\n'
+            'sudo swapon {swap_location}\n'
+            'fi\n').format(swap_location=swap_location, swap_size=swap_size)
+
+
+def swap_commands(swap_location, swap_size, swap_type='file'):
+    """
+    Returns commands which enable swap space of swap_size MB.
+
+    Args:
+        swap_location (str): Path of the swap file.
+        swap_size (int): Size of the swap space in MB. 0 disables swap.
+        swap_type (str): 'file' for a swap file, 'instance_store' to swap to
+            a whole unused NVMe instance store volume, or 'zram' for
+            compressed swap in memory. The latter two fall back to a swap
+            file when no instance store volume or zram module is available.
+    """
+    if swap_type not in SWAP_TYPES:
+        raise ValueError('Unknown swap type %s. Must be one of %s' % (swap_type, SWAP_TYPES))
+    if not swap_size:
+        return ''
+    swap_file = _swap_file_commands(swap_location, swap_size)
+    if swap_type == 'instance_store':
+        return ('SWAP_DEVICE=$(lsblk -dpno NAME,MODEL | grep "Instance Storage" | head -n 1 | cut -d " " -f 1)\n'
+                'if [ -n "$SWAP_DEVICE" ] && ! grep -q "^$SWAP_DEVICE " /proc/mounts; then\n'
+                'sudo mkswap $SWAP_DEVICE && sudo swapon $SWAP_DEVICE\n'
+                'else\n{swap_file}fi\n').format(swap_file=swap_file)
+    elif swap_type == 'zram':
+        return ('if sudo modprobe zram && SWAP_DEVICE=$(sudo zramctl --find --size {swap_size}M); then\n'
+                'sudo mkswap $SWAP_DEVICE && sudo swapon -p 100 $SWAP_DEVICE\n'
+                'else\n{swap_file}fi\n').format(swap_size=swap_size, swap_file=swap_file)
+    return swap_file
+
+
+def make_check_script(swap_location, swap_size, swap_type='file'):
+    """
+    Returns the user data commands for instances launched from a prepared
+    image. Each step of the image preparation is checked and only run if
+    it is missing, e.g. on an image which was not prepared.
+    """
+    swap = swap_commands(swap_location, swap_size, swap_type=swap_type)
+    if swap:
+        swap = 'if ! swapon --show=NAME --noheadings | grep -q .; then\n%sfi' % swap
+    return """
+    [ -f {marker} ] || echo "WARNING: image was not prepared for doodad"
+    {swap}
+    systemctl is-active --quiet docker || service docker start
+    if ! command -v aws > /dev/null 2>&1; then
+    {aws_cli}
+    fi
+    """.format(marker=PREPARED_MARKER,
+               swap=swap,
+               aws_cli=AWS_CLI_INSTALL)
+
+
+def make_prepare_script(swap_size=4096, swap_location='/var/swap.1'):
+    """
+    Returns the user data which prepares a build instance and then stops it.
+    The instance is also stopped if a step fails, after writing
+    PREPARE_FAILED to its console.
+    """
+    swap = ''
+    if swap_size:
+        # only added to fstab once swapon has accepted the file
+        swap = (_swap_file_commands(swap_location, swap_size) +
+                'echo "{swap_location} none swap sw 0 0" | sudo tee -a /etc/fstab\n'
+                ).format(swap_location=swap_location)
+    return """#!/bin/bash
+    set -e
+    trap 'status=$?; [ $status -eq 0 ] || echo "{failed}: exit code $status" | sudo tee /dev/console; sudo shutdown -h now' EXIT
+    {aws_cli}
+    {swap}
+    sudo systemctl enable docker
+    sudo mkdir -p $(dirname {marker})
+    date | sudo tee {marker}
+    """.format(aws_cli=AWS_CLI_INSTALL, swap=swap, marker=PREPARED_MARKER, failed=PREPARE_FAILED)
+
+
+def build_prepared_image(ec2_client,
+                         base_image_id,
+                         name,
+                         instance_type='t3.small',
+                         swap_size=4096,
+                         key_name=None,
+                         security_group_ids=None,
+                         iam_instance_profile_name=None,
+                         poll_interval=15,
+                         timeout=3600):
+    """
+    Launches an instance from base_image_id, prepares it and creates an
+    image from it once it has stopped. The build instance is terminated
+    afterwards.
+
+    Args:
+        ec2_client: A boto3 EC2 client in the region of the image.
+        base_image_id (str): Image to prepare, with docker installed.
+        name (str): Name of the new image.
+        swap_size (int): Size of the swap file in MB.
+    Returns:
+        str: The id of the prepared image
+    """
+    run_args = dict(
+        ImageId=base_image_id,
+        InstanceType=instance_type,
+        MinCount=1,
+        MaxCount=1,
+        UserData=make_prepare_script(swap_size=swap_size),
+        InstanceInitiatedShutdownBehavior='stop',
+        TagSpecifications=[{'ResourceType': 'instance',
+                            'Tags': [{'Key': 'Name', 'Value': name + '-builder'}]}],
+    )
+    if key_name:
+        run_args['KeyName'] = key_name
+    if security_group_ids:
+        run_args['SecurityGroupIds'] = security_group_ids
+    if iam_instance_profile_name:
+        run_args['IamInstanceProfile'] = {'Name': iam_instance_profile_name}
+    instance_id = ec2_client.run_instances(**run_args)['Instances'][0]['InstanceId']
+    print('Preparing instance %s' % instance_id)
+    try:
+        waiter_config = {'Delay': poll_interval, 'MaxAttempts': int(timeout / poll_interval)}
+        ec2_client.get_waiter('instance_stopped').wait(InstanceIds=[instance_id],
+                                                       WaiterConfig=waiter_config)
+        console = ec2_client.get_console_output(InstanceId=instance_id).get('Output', '')
+        if PREPARE_FAILED in console:
+            raise RuntimeError('Preparing instance %s failed:\n%s' % (
+                instance_id, '\n'.join(console.splitlines()[-20:])))
+        image_id = ec2_client.create_image(InstanceId=instance_id, Name=name,
+                                           Description='doodad prepared image')['ImageId']
+        print('Creating image %s' % image_id)
+        start = time.time()
+        ec2_client.get_waiter('image_available').wait(ImageIds=[image_id],
+                                                      WaiterConfig=waiter_config)
+        print('Image %s available after %.0fs' % (image_id, time.time() - start))
+    finally:
+        ec2_client.terminate_instances(InstanceIds=[instance_id])
+    return image_id
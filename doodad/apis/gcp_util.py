@@ -1,15 +1,123 @@
+import concurrent.futures
 import os
+import threading
 import time
+import uuid
 
-from doodad.utils import hash_file, REPO_DIR, safe_import
+from doodad.utils import hash_file, hash_file_cached, REPO_DIR, safe_import
 storage = safe_import.try_import('google.cloud.storage')
 
 GCP_STARTUP_SCRIPT_PATH = os.path.join(REPO_DIR, "scripts/gcp/gcp_startup_script.sh")
 GCP_SHUTDOWN_SCRIPT_PATH = os.path.join(REPO_DIR, "scripts/gcp/gcp_shutdown_script.sh")
 
+GCP_MOUNT_DIR = 'doodad/mount'
+# files larger than this are uploaded as parts in parallel and composed
+COMPOSITE_UPLOAD_THRESHOLD = 64 * 1024 ** 2
+COMPOSITE_PART_SIZE = 32 * 1024 ** 2
+# GCS composes at most 32 objects per request
+MAX_COMPOSE_PARTS = 32
+MAX_UPLOAD_WORKERS = 8
+# upload_files_to_gcp_storage checks up to this many files with one request
+# each, and lists GCP_MOUNT_DIR otherwise. The listing grows with the number
+# of archives ever uploaded, so it only pays off for large sweeps.
+MAX_EXISTS_REQUESTS = 32
+
 def make_timekey():
         return '%d'%(int(time.time()*1000))
 
+_clients = {}
+_buckets = {}
+_clients_lock = threading.Lock()
+
+
+def get_storage_client(project=None):
+    """
+    Returns a shared storage client. Clients are thread-safe and reuse
+    their HTTP connections.
+    """
+    with _clients_lock:
+        if project not in _clients:
+            _clients[project] = storage.Client(project=project)
+        return _clients[project]
+
+
+def get_bucket(bucket_name):
+    """
+    Returns a handle to a bucket, without a request to fetch its metadata.
+    """
+    client = get_storage_client()
+    with _clients_lock:
+        if bucket_name not in _buckets:
+            _buckets[bucket_name] = client.bucket(bucket_name)
+        return _buckets[bucket_name]
+
+
+def reset_clients():
+    """
+    Discards shared clients, e.g. after changing credentials.
+    """
+    with _clients_lock:
+        _clients.clear()
+        _buckets.clear()
+    _uploaded.clear()
+
+
+def hash_remote_filename(file_name):
+    """
+    Returns a blob name given by a hash of the file contents, so that
+    identical archives are stored once.
+    """
+    return hash_file_cached(file_name) + os.path.splitext(file_name)[1]
+
+
+def _upload_part(bucket, part_name, file_name, offset, size):
+    with open(file_name, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+    blob = bucket.blob(part_name)
+    blob.upload_from_string(data)
+    return blob
+
+
+def composite_upload(bucket, file_name, remote_path, part_size=COMPOSITE_PART_SIZE):
+    """
+    Uploads parts of a file in parallel and composes them into one blob.
+    """
+    file_size = os.path.getsize(file_name)
+    # grow the parts so that a single compose request is enough
+    num_parts = min(MAX_COMPOSE_PARTS, max(1, -(-file_size // part_size)))
+    part_size = -(-file_size // num_parts)
+    part_prefix = '%s.parts-%s/' % (remote_path, uuid.uuid4().hex[:8])
+    blob = bucket.blob(remote_path)
+    futures = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+            for i in range(num_parts):
+                futures.append(executor.submit(_upload_part, bucket, part_prefix + '%03d' % i,
+                                               file_name, i * part_size, part_size))
+        # all parts have finished here, so a failed part cannot leak the others
+        parts = [future.result() for future in futures]
+        blob.compose(parts)
+    finally:
+        for future in futures:
+            if future.done() and future.exception() is None:
+                future.result().delete()
+    return blob
+
+
+def _upload(bucket, file_name, remote_path):
+    if os.path.getsize(file_name) > COMPOSITE_UPLOAD_THRESHOLD:
+        composite_upload(bucket, file_name, remote_path)
+    else:
+        bucket.blob(remote_path).upload_from_filename(file_name)
+
+
+# (bucket, path) of files known to be in GCS
+_uploaded = set()
+_upload_locks = {}
+_upload_locks_lock = threading.Lock()
+
+
 def upload_file_to_gcp_storage(
     bucket_name,
     file_name,
@@ -17,19 +125,76 @@ def upload_file_to_gcp_storage(
     dry=False,
     check_exists=True
 ):
+    """
+    Uploads a file to doodad/mount in a bucket.
+
+    Args:
+        remote_filename (str): Name of the uploaded file. Defaults to a hash
+            of the file contents, in which case files which were already
+            uploaded are not uploaded again.
+        check_exists (bool): If True, skip the upload if the file already
+            exists in the bucket.
+    Returns:
+        str: The path of the file within the bucket
+    """
     if remote_filename is None:
-        remote_filename = os.path.basename(file_name)
-    remote_path = 'doodad/mount/' + remote_filename
-    if not dry:
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(bucket_name)
-        blob = bucket.blob(remote_path)
-        if check_exists and blob.exists(storage_client):
-            print("{remote_path} already exists".format(remote_path=remote_path))
+        if dry and not os.path.exists(file_name):
+            remote_filename = os.path.basename(file_name)
+        else:
+            remote_filename = hash_remote_filename(file_name)
+    remote_path = GCP_MOUNT_DIR + '/' + remote_filename
+    if dry:
+        return remote_path
+    key = (bucket_name, remote_path)
+    with _upload_locks_lock:
+        lock = _upload_locks.setdefault(key, threading.Lock())
+    # concurrent launches of the same file wait for a single upload
+    with lock:
+        if check_exists and key in _uploaded:
             return remote_path
-        blob.upload_from_filename(file_name)
+        bucket = get_bucket(bucket_name)
+        if check_exists and bucket.blob(remote_path).exists():
+            print("{remote_path} already exists".format(remote_path=remote_path))
+        else:
+            _upload(bucket, file_name, remote_path)
+        _uploaded.add(key)
     return remote_path
 
+
+def upload_files_to_gcp_storage(bucket_name, file_names, dry=False):
+    """
+    Uploads many files under content-hash names, checking which already
+    exist (see MAX_EXISTS_REQUESTS) and uploading the rest concurrently.
+
+    Returns:
+        list: The path of each file within the bucket
+    """
+    remote_paths = [upload_file_to_gcp_storage(bucket_name, file_name, dry=True)
+                    for file_name in file_names]
+    if dry:
+        return remote_paths
+    unknown = set([path for path in remote_paths if (bucket_name, path) not in _uploaded])
+    if len(unknown) > MAX_EXISTS_REQUESTS:
+        for blob in get_storage_client().list_blobs(bucket_name, prefix=GCP_MOUNT_DIR + '/'):
+            _uploaded.add((bucket_name, blob.name))
+    elif unknown:
+        bucket = get_bucket(bucket_name)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+            exists = dict(zip(unknown, executor.map(lambda path: bucket.blob(path).exists(), unknown)))
+        _uploaded.update([(bucket_name, path) for path in unknown if exists[path]])
+    to_upload = {}
+    for file_name, path in zip(file_names, remote_paths):
+        if (bucket_name, path) not in _uploaded:
+            to_upload.setdefault(path, file_name)
+    if to_upload:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+            futures = [executor.submit(upload_file_to_gcp_storage, bucket_name, file_name,
+                                       check_exists=False)
+                       for file_name in to_upload.values()]
+            for future in futures:
+                future.result()
+    return remote_paths
+
 def get_machine_type(zone, instance_type):
     return "zones/{zone}/machineTypes/{instance_type}".format(
             zone=zone,
@@ -26,41 +26,55 @@ class SlurmJobGenerator(object):
         self.n_tasks = n_tasks
         self.extra_flags = extra_flags
 
-    def wrap_command_with_sbatch(self, cmd):
-        cmd = cmd.replace("'", "\\'")
+    def _sbatch_prefix(self):
         num_cpus = self.n_tasks * self.n_cpus_per_task
         n_nodes = self.n_nodes or math.ceil(
             num_cpus / self.max_num_cores_per_node)
-        if self.n_gpus > 0:
-            full_cmd = (
-                "sbatch -A {account_name} -p {partition} -t {time}"
-                " -N {nodes} -n {n_tasks} --cpus-per-task={cpus_per_task}"
-                " --gres=gpu:{n_gpus} {extra_flags} --wrap=$'{cmd}'".format(
-                    account_name=self.account_name,
-                    partition=self.partition,
-                    time=self.time_in_mins,
-                    nodes=n_nodes,
-                    n_tasks=self.n_tasks,
-                    cpus_per_task=self.n_cpus_per_task,
-                    cmd=cmd,
-                    n_gpus=self.n_gpus,
-                    extra_flags=self.extra_flags,
-                )
+        prefix = (
+            "sbatch -A {account_name} -p {partition} -t {time}"
+            " -N {nodes} -n {n_tasks} --cpus-per-task={cpus_per_task}".format(
+                account_name=self.account_name,
+                partition=self.partition,
+                time=self.time_in_mins,
+                nodes=n_nodes,
+                n_tasks=self.n_tasks,
+                cpus_per_task=self.n_cpus_per_task,
             )
-        else:
-            full_cmd = (
-                "sbatch -A {account_name} -p {partition} -t {time}"
-                " -N {nodes} -n {n_tasks} --cpus-per-task={cpus_per_task}"
-                " {extra_flags} --wrap=$'{cmd}'".format(
-                    account_name=self.account_name,
-                    partition=self.partition,
-                    time=self.time_in_mins,
-                    nodes=n_nodes,
-                    n_tasks=self.n_tasks,
-                    cpus_per_task=self.n_cpus_per_task,
-                    cmd=cmd,
-                    extra_flags=self.extra_flags,
-                )
-            )
-        return full_cmd
+        )
+        if self.n_gpus > 0:
+            prefix += " --gres=gpu:{n_gpus}".format(n_gpus=self.n_gpus)
+        return prefix + " " + self.extra_flags
+
+    def wrap_command_with_sbatch(self, cmd):
+        cmd = cmd.replace("'", "\\'")
+        return "{prefix} --wrap=$'{cmd}'".format(prefix=self._sbatch_prefix(), cmd=cmd)
+
+    def wrap_task_table_with_sbatch(self, task_table_path, n_tasks,
+                                    max_concurrent=None, max_array_size=1000):
+        """
+        Returns sbatch commands which run every line of a task table as one
+        task of a job array. Task SLURM_ARRAY_TASK_ID of an array runs the
+        line at that index, counting from the first line of the array.
 
+        Args:
+            task_table_path (str): Path of the task table on the cluster,
+                with one shell command per line.
+            n_tasks (int): Number of lines in the task table.
+            max_concurrent (int): If given, the maximum number of tasks of
+                each array which run at once.
+            max_array_size (int): The cluster's MaxArraySize minus one.
+                Larger tables are split into several arrays.
+        Returns:
+            list: One sbatch command per array
+        """
+        cmds = []
+        for offset in range(0, n_tasks, max_array_size):
+            size = min(max_array_size, n_tasks - offset)
+            array = "0-%d" % (size - 1)
+            if max_concurrent:
+                array += "%%%d" % max_concurrent
+            task_cmd = 'eval "$(sed -n "$((SLURM_ARRAY_TASK_ID + {line}))p" {table})"'.format(
+                line=offset + 1, table=task_table_path)
+            cmds.append("{prefix} --array={array} --wrap=$'{cmd}'".format(
+                prefix=self._sbatch_prefix(), array=array, cmd=task_cmd.replace("'", "\\'")))
+        return cmds
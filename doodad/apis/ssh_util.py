@@ -0,0 +1,185 @@
+"""
+Helpers for running archives on hosts over SSH.
+"""
+import os
+import shlex
+import threading
+import uuid
+
+from doodad.utils import hash_file_cached, shell
+
+# relative to the home directory of the remote user
+DEFAULT_REMOTE_CACHE_DIR = '.doodad/archives'
+
+
+class RemoteArchiveCache(object):
+    """
+    Uploads archives to SSH hosts under a name given by a hash of their
+    contents, so each archive is sent to a host once however many jobs
+    run it. Archives are touched whenever they are used, and the least
+    recently used ones are deleted once a host has more than max_entries.
+    Since other sweeps on a host may evict an archive, every upload checks
+    that the archive is still there.
+
+    Args:
+        cache_dir (str): Directory of the cache on each host.
+        max_entries (int): Number of archives kept on each host.
+    """
+    def __init__(self, cache_dir=DEFAULT_REMOTE_CACHE_DIR, max_entries=10):
+        self.cache_dir = cache_dir.rstrip('/')
+        self.max_entries = max_entries
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def remote_path(self, local_file, missing_ok=False):
+        """
+        Args:
+            missing_ok (bool): If True, a file which does not exist (e.g. in
+                a dry run) is named by its basename instead of its hash.
+        """
+        if missing_ok and not os.path.exists(local_file):
+            return '%s/%s' % (self.cache_dir, os.path.basename(local_file))
+        return '%s/%s%s' % (self.cache_dir, hash_file_cached(local_file),
+                            os.path.splitext(local_file)[1])
+
+    def evict_cmd(self):
+        """
+        Returns a remote command which deletes all but the max_entries most
+        recently used archives.
+        """
+        return ('ls -t {cache_dir} | grep -v "\\.part\\." | tail -n +{start} | '
+                'sed "s|^|{cache_dir}/|" | xargs rm -f').format(cache_dir=self.cache_dir,
+                                                               start=self.max_entries + 1)
+
+    def upload(self, credentials, local_file, dry=False):
+        """
+        Uploads an archive to a host unless it is already in the cache, and
+        marks it as recently used so that it is not evicted before it runs.
+
+        Args:
+            credentials (SSHCredentials): The host.
+        Returns:
+            str: The path of the archive on the host
+        """
+        remote_path = self.remote_path(local_file, missing_ok=dry)
+        key = (credentials.user_host, remote_path)
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # concurrent launches of the same archive wait for a single upload
+        with lock:
+            check_cmd = credentials.get_ssh_bash_cmd(
+                'mkdir -p {cache_dir} && touch -c {path} && test -f {path}'.format(
+                    cache_dir=self.cache_dir, path=remote_path))
+            if dry:
+                print(check_cmd)
+                return remote_path
+            _, returncode = shell.call_and_get_output(check_cmd, shell=True, return_code=True)
+            if returncode != 0:
+                # upload to a temporary name so that no job sees a partial archive
+                part_path = '%s.part.%s' % (remote_path, uuid.uuid4().hex[:8])
+                returncode = shell.call(credentials.get_scp_cmd(local_file, part_path, src_remote=False,
+                                                                recursive=False), shell=True)
+                if returncode == 0:
+                    returncode = shell.call(credentials.get_ssh_bash_cmd(
+                        'mv %s %s && %s' % (part_path, remote_path, self.evict_cmd())), shell=True)
+                if returncode != 0:
+                    raise IOError('Could not upload %s to %s:%s' % (local_file, credentials.user_host,
+                                                                   remote_path))
+        return remote_path
+
+
+# relative to the home directory of the remote user
+DEFAULT_REMOTE_JOB_DIR = '.doodad/jobs'
+
+# states reported by job_status_cmd
+JOB_STARTING = 'starting'
+JOB_RUNNING = 'running'
+JOB_EXITED = 'exited'
+# the process died without writing an exit code, e.g. on a reboot
+JOB_LOST = 'lost'
+
+
+def detached_job_cmd(job_dir, run_cmd, remove_files=()):
+    """
+    Returns a remote command which starts run_cmd in its own session and
+    returns immediately. The job writes its pid, output and exit code to
+    job_dir/pid, job_dir/log and job_dir/exit.
+
+    Args:
+        remove_files (tuple): Files deleted once the job has finished,
+            e.g. a copy of the script it runs.
+    """
+    # the exit code is renamed into place so that it is never read half-written
+    job_cmd = ('echo $$ > {job_dir}/pid; ({run_cmd}) > {job_dir}/log 2>&1; '
+               'echo $? > {job_dir}/exit.tmp && mv {job_dir}/exit.tmp {job_dir}/exit').format(
+                   job_dir=job_dir, run_cmd=run_cmd)
+    if remove_files:
+        job_cmd += '; rm -f %s' % ' '.join(remove_files)
+    # setsid is missing on some systems (e.g. macOS), where nohup alone is used
+    return ('mkdir -p {job_dir} && $(command -v setsid) nohup sh -c {job_cmd} '
+            '> /dev/null 2>&1 < /dev/null &').format(job_dir=job_dir, job_cmd=shlex.quote(job_cmd))
+
+
+def job_status_cmd(job_dirs):
+    """
+    Returns a remote command which prints a line "<job_dir> <state> [exit code]"
+    for each job directory.
+    """
+    return ('for job_dir in {job_dirs}; do '
+            'if [ -f $job_dir/exit ]; then echo "$job_dir {exited} $(cat $job_dir/exit)"; '
+            'elif [ ! -d $job_dir ]; then echo "$job_dir {lost}"; '
+            'elif [ ! -f $job_dir/pid ]; then echo "$job_dir {starting}"; '
+            'elif kill -0 $(cat $job_dir/pid) 2> /dev/null; then echo "$job_dir {running}"; '
+            'else echo "$job_dir {lost}"; fi; done').format(
+                job_dirs=' '.join([shlex.quote(job_dir) for job_dir in job_dirs]),
+                exited=JOB_EXITED, starting=JOB_STARTING, running=JOB_RUNNING, lost=JOB_LOST)
+
+
+def parse_job_statuses(output):
+    """
+    Parses the output of job_status_cmd.
+
+    Returns:
+        dict: A map from job directory to (state, exit code or None)
+    """
+    statuses = {}
+    for line in output.strip().splitlines():
+        fields = line.split()
+        exit_code = int(fields[2]) if len(fields) > 2 else None
+        statuses[fields[0]] = (fields[1], exit_code)
+    return statuses
+
+
+def _wait_for_pid_cmd(job_dir):
+    # waits briefly for the pid of a job which was just started
+    return 'for i in $(seq 50); do [ -f {job_dir}/pid ] && break; sleep 0.1; done'.format(job_dir=job_dir)
+
+
+def kill_job_cmd(job_dir):
+    # the job leads its own process group when started with setsid
+    return ('{wait}; pid=$(cat {job_dir}/pid) && (kill -- -$pid 2> /dev/null || kill $pid)').format(
+        wait=_wait_for_pid_cmd(job_dir), job_dir=job_dir)
+
+
+def stream_log_cmd(job_dir):
+    """
+    Returns a remote command which prints the log of a job until it exits.
+    """
+    # tail --pid is only in GNU tail. Elsewhere (e.g. macOS) tail is
+    # stopped once the job has exited.
+    return ('{wait}; pid=$(cat {job_dir}/pid); '
+            'if tail --version > /dev/null 2>&1; then tail -n +1 -f --pid=$pid {job_dir}/log; '
+            'else tail -n +1 -f {job_dir}/log & tail_pid=$!; '
+            'while kill -0 $pid 2> /dev/null; do sleep 1; done; sleep 1; kill $tail_pid; fi').format(
+                wait=_wait_for_pid_cmd(job_dir), job_dir=job_dir)
+
+
+def clean_jobs_cmd(job_dirs):
+    """
+    Returns a remote command which deletes the directories of finished jobs.
+
+    Args:
+        job_dirs (list): Job directories, or shell patterns such as jobs/*
+    """
+    return ('for job_dir in {job_dirs}; do [ -f $job_dir/exit ] && rm -rf $job_dir; done; true').format(
+        job_dirs=' '.join(job_dirs))
@@ -0,0 +1,73 @@
+import unittest
+import os
+import os.path as path
+import shutil
+import tempfile
+
+from doodad.apis import aws_util
+from doodad.utils import safe_import
+
+moto = safe_import.try_import('moto')
+boto3 = safe_import.try_import('boto3')
+
+
+def _mock_aws():
+    # moto>=5 merged the per-service mocks into mock_aws
+    return getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+
+@unittest.skipIf(isinstance(moto, safe_import.FailedImportModule) or
+                 isinstance(boto3, safe_import.FailedImportModule),
+                 'moto and boto3 are required')
+class TestS3(unittest.TestCase):
+    bucket = 'doodad-test-bucket'
+
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        self.mock = _mock_aws()()
+        self.mock.start()
+        aws_util.reset_clients()
+        aws_util.get_s3_client('us-east-1').create_bucket(Bucket=self.bucket)
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        aws_util.reset_clients()
+        self.mock.stop()
+
+    def write_file(self, name, contents):
+        fname = path.join(self.work_dir, name)
+        with open(fname, 'w') as f:
+            f.write(contents)
+        return fname
+
+    def test_upload_skips_identical(self):
+        fname = self.write_file('a.dar', 'archive')
+        aws_util.s3_upload(fname, self.bucket, 'doodad/mount/a.dar', region='us-east-1')
+        self.assertTrue(aws_util.s3_exists(self.bucket, 'doodad/mount/a.dar', region='us-east-1'))
+        self.assertFalse(aws_util.s3_exists(self.bucket, 'doodad/mount/b.dar', region='us-east-1'))
+        client = aws_util.get_s3_client('us-east-1')
+        # an object with a matching checksum is not uploaded again
+        metadata = client.head_object(Bucket=self.bucket, Key='doodad/mount/a.dar')['Metadata']
+        client.put_object(Bucket=self.bucket, Key='doodad/mount/a.dar', Body=b'marker', Metadata=metadata)
+        aws_util.s3_upload(fname, self.bucket, 'doodad/mount/a.dar', region='us-east-1')
+        body = client.get_object(Bucket=self.bucket, Key='doodad/mount/a.dar')['Body'].read()
+        self.assertEqual(body, b'marker')
+
+    def test_upload_many_by_hash(self):
+        files = [self.write_file('%d.dar' % i, 'archive %d' % (i % 2)) for i in range(4)]
+        s3_paths = aws_util.s3_upload_many_by_hash(files, self.bucket, region='us-east-1')
+        self.assertEqual(len(set(s3_paths)), 2)
+        self.assertEqual(aws_util.s3_existing_keys(self.bucket, s3_paths + ['doodad/mount/x.dar'],
+                                                   region='us-east-1'),
+                         set(s3_paths))
+        # many keys are checked with a listing
+        many_paths = ['doodad/mount/%d.dar' % i for i in range(aws_util.MAX_HEAD_REQUESTS + 1)]
+        self.assertEqual(aws_util.s3_existing_keys(self.bucket, s3_paths + many_paths,
+                                                   region='us-east-1'),
+                         set(s3_paths))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import hashlib
+import os.path as path
+import shutil
+import tempfile
+
+from doodad.apis import gcp_util
+
+
+class FakeBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def exists(self):
+        return self.name in self.bucket.data
+
+    def upload_from_filename(self, file_name):
+        with open(file_name, 'rb') as f:
+            self.upload_from_string(f.read())
+
+    def upload_from_string(self, data):
+        if self.name in self.bucket.fail_names:
+            raise IOError('upload of %s failed' % self.name)
+        self.bucket.uploads.append(self.name)
+        self.bucket.data[self.name] = data
+
+    def compose(self, sources):
+        self.bucket.data[self.name] = b''.join([self.bucket.data[blob.name] for blob in sources])
+
+    def delete(self):
+        del self.bucket.data[self.name]
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.data = {}
+        self.uploads = []
+        self.fail_names = []
+        self.listings = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.fake_bucket = FakeBucket()
+
+    def bucket(self, bucket_name):
+        return self.fake_bucket
+
+    def list_blobs(self, bucket_name, prefix=''):
+        self.fake_bucket.listings += 1
+        return [FakeBlob(self.fake_bucket, name) for name in self.fake_bucket.data
+                if name.startswith(prefix)]
+
+
+class TestGCSUpload(unittest.TestCase):
+    def setUp(self):
+        gcp_util.reset_clients()
+        self.client = FakeClient()
+        gcp_util._clients[None] = self.client
+        self.bucket = self.client.fake_bucket
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        gcp_util.reset_clients()
+
+    def write_file(self, name, contents):
+        fname = path.join(self.work_dir, name)
+        with open(fname, 'wb') as f:
+            f.write(contents)
+        return fname
+
+    def test_upload_by_hash(self):
+        fname = self.write_file('a.dar', b'archive')
+        remote_path = gcp_util.upload_file_to_gcp_storage('bucket', fname)
+        self.assertEqual(remote_path, 'doodad/mount/%s.dar' % gcp_util.hash_file(fname))
+        copy = self.write_file('b.dar', b'archive')
+        self.assertEqual(gcp_util.upload_file_to_gcp_storage('bucket', copy), remote_path)
+        self.assertEqual(self.bucket.uploads, [remote_path])
+
+    def test_upload_many(self):
+        self.bucket.data['doodad/mount/%s.dar' % hashlib.md5(b'archive 0').hexdigest()] = b'x'
+        files = [self.write_file('%d.dar' % i, b'archive %d' % (i % 3)) for i in range(6)]
+        remote_paths = gcp_util.upload_files_to_gcp_storage('bucket', files)
+        self.assertEqual(len(set(remote_paths)), 3)
+        self.assertEqual(sorted(self.bucket.uploads), sorted(set(remote_paths[1:3])))
+        # a few files are checked without listing the bucket
+        self.assertEqual(self.bucket.listings, 0)
+        files = [self.write_file('%d.dar' % i, b'%d' % i) for i in range(gcp_util.MAX_EXISTS_REQUESTS + 1)]
+        gcp_util.upload_files_to_gcp_storage('bucket', files)
+        self.assertEqual(self.bucket.listings, 1)
+
+    def test_composite_upload(self):
+        contents = bytes(bytearray(range(256))) * 100
+        fname = self.write_file('a.dar', contents)
+        gcp_util.composite_upload(self.bucket, fname, 'doodad/mount/a.dar', part_size=500)
+        self.assertEqual(list(self.bucket.data.keys()), ['doodad/mount/a.dar'])
+        self.assertEqual(self.bucket.data['doodad/mount/a.dar'], contents)
+        self.assertEqual(len(self.bucket.uploads), gcp_util.MAX_COMPOSE_PARTS)
+
+    def test_composite_upload_failure(self):
+        fname = self.write_file('a.dar', b'x' * 1000)
+        # fails the upload of the third part
+        class FailThird(object):
+            def __contains__(self, name):
+                return name.endswith('/002')
+        self.bucket.fail_names = FailThird()
+        with self.assertRaises(IOError):
+            gcp_util.composite_upload(self.bucket, fname, 'doodad/mount/a.dar', part_size=100)
+        # the parts which were uploaded are deleted
+        self.assertEqual(len(self.bucket.uploads), 9)
+        self.assertEqual(self.bucket.data, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
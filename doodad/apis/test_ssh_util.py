@@ -0,0 +1,138 @@
+import unittest
+import os
+import os.path as path
+import shutil
+import subprocess
+import shlex
+import tempfile
+import time
+
+from doodad.apis import ssh_util
+
+
+class LocalHost(object):
+    """Runs the commands of RemoteArchiveCache in a local directory."""
+    user_host = 'local'
+
+    def __init__(self, home):
+        self.home = home
+
+    def get_ssh_bash_cmd(self, cmd):
+        return 'cd %s && bash -c %s' % (shlex.quote(self.home), shlex.quote(cmd))
+
+    def get_scp_cmd(self, source, destination, src_remote=True, recursive=True):
+        return 'cp %s %s' % (shlex.quote(source), shlex.quote(path.join(self.home, destination)))
+
+
+class TestRemoteArchiveCache(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_remote_path(self):
+        cache = ssh_util.RemoteArchiveCache('cache/')
+        fname = path.join(self.work_dir, 'a.dar')
+        with open(fname, 'w') as f:
+            f.write('archive')
+        self.assertEqual(cache.remote_path(fname), 'cache/%s.dar' % ssh_util.hash_file_cached(fname))
+        self.assertEqual(cache.remote_path('missing.dar', missing_ok=True), 'cache/missing.dar')
+
+    def test_upload(self):
+        host = LocalHost(self.work_dir)
+        cache = ssh_util.RemoteArchiveCache('cache')
+        fname = path.join(self.work_dir, 'a.dar')
+        with open(fname, 'w') as f:
+            f.write('archive')
+        remote_path = cache.upload(host, fname)
+        self.assertTrue(path.exists(path.join(self.work_dir, remote_path)))
+        # e.g. evicted by another sweep on the same host
+        os.remove(path.join(self.work_dir, remote_path))
+        self.assertEqual(cache.upload(host, fname), remote_path)
+        self.assertTrue(path.exists(path.join(self.work_dir, remote_path)))
+
+    def test_evict(self):
+        cache = ssh_util.RemoteArchiveCache('cache', max_entries=2)
+        cache_dir = path.join(self.work_dir, 'cache')
+        os.makedirs(cache_dir)
+        for i, name in enumerate(['a.dar', 'b.dar', 'c.dar', 'd.dar.part.1234']):
+            with open(path.join(cache_dir, name), 'w') as f:
+                f.write(name)
+            os.utime(path.join(cache_dir, name), (i, i))
+        subprocess.check_call(['bash', '-c', cache.evict_cmd()], cwd=self.work_dir)
+        # the least recently used archive is deleted, uploads in progress are kept
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['b.dar', 'c.dar', 'd.dar.part.1234'])
+
+
+class TestDetachedJob(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def job_statuses(self, job_dirs):
+        output = subprocess.check_output(['bash', '-c', ssh_util.job_status_cmd(job_dirs)],
+                                         cwd=self.work_dir)
+        return ssh_util.parse_job_statuses(output.decode('utf-8'))
+
+    def wait_for(self, name):
+        for _ in range(100):
+            if path.exists(path.join(self.work_dir, name)):
+                break
+            time.sleep(0.05)
+
+    def test_run(self):
+        os.makedirs(path.join(self.work_dir, 'jobs', 'b'))
+        with open(path.join(self.work_dir, 'script.sh'), 'w') as f:
+            f.write('echo hello; exit 3\n')
+        subprocess.check_call(['bash', '-c', ssh_util.detached_job_cmd('jobs/a', 'sh script.sh',
+                                                                     remove_files=['script.sh'])],
+                              cwd=self.work_dir)
+        self.wait_for('jobs/a/exit')
+        statuses = self.job_statuses(['jobs/a', 'jobs/b', 'jobs/c'])
+        self.assertEqual(statuses['jobs/a'], (ssh_util.JOB_EXITED, 3))
+        self.assertEqual(statuses['jobs/b'], (ssh_util.JOB_STARTING, None))
+        self.assertEqual(statuses['jobs/c'], (ssh_util.JOB_LOST, None))
+        with open(path.join(self.work_dir, 'jobs/a/log')) as f:
+            self.assertEqual(f.read(), 'hello\n')
+        time.sleep(0.1)
+        self.assertFalse(path.exists(path.join(self.work_dir, 'script.sh')))
+
+        # only finished jobs are cleaned
+        subprocess.check_call(['bash', '-c', ssh_util.clean_jobs_cmd(['jobs/*'])], cwd=self.work_dir)
+        self.assertEqual(os.listdir(path.join(self.work_dir, 'jobs')), ['b'])
+
+    def test_stream_log(self):
+        subprocess.check_call(['bash', '-c', ssh_util.detached_job_cmd('jobs/a', 'echo a; sleep 0.5; echo b')],
+                              cwd=self.work_dir)
+        output = subprocess.check_output(['bash', '-c', ssh_util.stream_log_cmd('jobs/a')], cwd=self.work_dir)
+        self.assertEqual(output.decode('utf-8'), 'a\nb\n')
+        # a tail without --pid, as on macOS
+        with open(path.join(self.work_dir, 'tail'), 'w') as f:
+            f.write('#!/bin/sh\n[ "$1" = "--version" ] && exit 1\nexec %s "$@"\n'
+                    % shutil.which('tail'))
+        os.chmod(path.join(self.work_dir, 'tail'), 0o755)
+        env = dict(os.environ, PATH=self.work_dir + os.pathsep + os.environ['PATH'])
+        output = subprocess.check_output(['bash', '-c', ssh_util.stream_log_cmd('jobs/a')],
+                                         cwd=self.work_dir, env=env, timeout=10)
+        self.assertEqual(output.decode('utf-8'), 'a\nb\n')
+
+    def test_kill(self):
+        subprocess.check_call(['bash', '-c', ssh_util.detached_job_cmd('jobs/a', 'sleep 30')],
+                              cwd=self.work_dir)
+        self.wait_for('jobs/a/pid')
+        self.assertEqual(self.job_statuses(['jobs/a'])['jobs/a'], (ssh_util.JOB_RUNNING, None))
+        subprocess.check_call(['bash', '-c', ssh_util.kill_job_cmd('jobs/a')], cwd=self.work_dir)
+        for _ in range(100):
+            state = self.job_statuses(['jobs/a'])['jobs/a'][0]
+            if state != ssh_util.JOB_RUNNING:
+                break
+            time.sleep(0.05)
+        # the shell which writes the exit code is killed with the job
+        self.assertEqual(state, ssh_util.JOB_LOST)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,6 @@
+import os
+
+from doodad import job_registry
+
+# keeps jobs launched by tests out of ~/.doodad/jobs.db
+os.environ[job_registry.DB_PATH_ENV] = ':memory:'
@@ -1,6 +1,10 @@
 import os
+import shlex
+import tempfile
 
 SSH_IDENTITY_FILE = None
+# %C is replaced by ssh with a hash of the user, host and port
+DEFAULT_CONTROL_PATH = os.path.join(tempfile.gettempdir(), 'doodad-ssh-%C')
 
 class SSHCredentials(object):
     """
@@ -11,14 +15,36 @@ class SSHCredentials(object):
         username (str):
         identity_file (str, optional):
             Path to a private key file for SSL public key authentication
+        control_path (str, optional): If given, ssh and scp commands share
+            one persistent master connection through a socket at this path,
+            so only the first command pays for the handshake.
+        control_persist (int): Number of seconds the master connection
+            stays open after the last command.
     """
-    def __init__(self, hostname, username, identity_file=None):
+    def __init__(self, hostname, username, identity_file=None, control_path=None,
+                 control_persist=600):
         self.hostname = hostname
         self.username = username
         if identity_file:
             self.identity_file = os.path.expanduser(identity_file)
         else:
             self.identity_file = None
+        self.control_path = control_path
+        self.control_persist = control_persist
+
+    def get_ssh_options(self):
+        """
+        Returns options shared by ssh and scp commands.
+            Ex.
+            ' -i id_file -o ControlMaster=auto -o ControlPath=... -o ControlPersist=600'
+        """
+        options = ''
+        if self.identity_file:
+            options += ' -i %s' % self.identity_file
+        if self.control_path:
+            options += ' -o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%d' % (
+                shlex.quote(self.control_path), self.control_persist)
+        return options
 
     def get_ssh_cmd_prefix(self):
         """
@@ -27,34 +53,73 @@ class SSHCredentials(object):
             'ssh user@host -i id_file '
         """
         cmd = 'ssh %s@%s' % (self.username, self.hostname)
-        if self.identity_file:
-            cmd += ' -i %s' % self.identity_file
+        cmd += self.get_ssh_options()
         return cmd + ' '
 
+    def get_close_master_cmd(self):
+        """
+        Returns a command which closes the persistent master connection.
+        """
+        return 'ssh -O exit%s %s' % (self.get_ssh_options(), self.user_host)
+
     def get_ssh_bash_cmd(self, cmd):
         prefix = self.get_ssh_cmd_prefix()
         return prefix + " '%s'"%cmd
 
-    def get_ssh_script_cmd(self, script_name, shell_interpreter='bash'):
+    def get_ssh_script_cmd(self, script_name, shell_interpreter='bash', remote_script='./tmp_script.sh',
+                           env=None):
+        """
+        Returns a command which copies a script to the host, runs it and
+        deletes it.
+
+        Args:
+            remote_script (str): Path of the copied script on the host. Jobs
+                running at the same time on a host need different paths.
+            env (dict): Environment variables set for the script.
+        """
         # The following does not work with archive scripts
         # cmd = self.get_ssh_cmd_prefix()
         # cmd += "'%s -s' < %s" % (shell_interpreter, script_name)
         cmd = "{scp_cmd};" + \
-              "{ssh_cmd}'{shell_interpreter} ./tmp_script.sh';" + \
-              "{ssh_cmd}'rm ./tmp_script.sh'" 
+              "{ssh_cmd}'{env}{shell_interpreter} {remote_script}';" + \
+              "{ssh_cmd}'rm {remote_script}'" 
         cmd = cmd.format(
-            scp_cmd=self.get_scp_cmd(script_name, './tmp_script.sh', src_remote=False),
+            scp_cmd=self.get_scp_cmd(script_name, remote_script, src_remote=False),
             ssh_cmd=self.get_ssh_cmd_prefix(),
-            shell_interpreter=shell_interpreter
+            shell_interpreter=shell_interpreter,
+            remote_script=remote_script,
+            env=''.join(['%s=%s ' % (key, env[key]) for key in sorted(env or {})]),
         )
         return cmd
 
+    def get_ssh_run_cmd(self, remote_script, args=(), shell_interpreter='bash', env=None):
+        """
+        Returns a command which runs a script already on the host.
+
+        Args:
+            args (list): Command line arguments of the script.
+            env (dict): Environment variables set for the script.
+        """
+        remote_cmd = 'touch -c {remote_script}; {env}{shell_interpreter} {remote_script} {args}'.format(
+            remote_script=remote_script,
+            env=''.join(['%s=%s ' % (key, env[key]) for key in sorted(env or {})]),
+            shell_interpreter=shell_interpreter,
+            args=' '.join([shlex.quote(arg) for arg in args]),
+        )
+        return self.get_ssh_cmd(remote_cmd.strip())
+
+    def get_ssh_cmd(self, remote_cmd):
+        """
+        Returns a command which runs remote_cmd on the host. Unlike
+        get_ssh_bash_cmd, remote_cmd may contain any quotes.
+        """
+        return self.get_ssh_cmd_prefix() + shlex.quote(remote_cmd)
+
     def get_scp_cmd(self, source, destination, src_remote=True, recursive=True):
         cmd = 'scp'
         if recursive:
             cmd += ' -r'
-        if self.identity_file:
-            cmd += ' -i %s' % self.identity_file
+        cmd += self.get_ssh_options()
         if src_remote:
             cmd += ' %s@%s:%s' % (self.username, self.hostname, source)
             cmd += ' %s' % destination
@@ -11,3 +11,12 @@ class TestSSHCreds(unittest.TestCase):
         ssh.set_identity_file('mykey')
         creds = ssh.get_credentials(username='a', hostname='b.com')
         self.assertEqual(creds.identity_file, 'mykey')
+
+    def test_control_path(self):
+        creds = ssh.SSHCredentials(username='a', hostname='b.com', control_path='/tmp/ctl-%C',
+                                   control_persist=60)
+        options = '-o ControlMaster=auto -o ControlPath=/tmp/ctl-%C -o ControlPersist=60'
+        self.assertEqual(creds.get_ssh_cmd_prefix(), 'ssh a@b.com %s ' % options)
+        self.assertEqual(creds.get_scp_cmd('x', 'y', src_remote=False), 'scp -r %s x a@b.com:y' % options)
+        self.assertEqual(creds.get_close_master_cmd(), 'ssh -O exit %s a@b.com' % options)
+
@@ -4,8 +4,9 @@ Library for building runnable Doodad Archives.
 Doodad Archives package code and data into a single
 executable shell script, which runs within a docker container.
 
-Currently, doodad uses makeself as a backend to build these
-packaged scripts.
+Archives use the makeself self-extracting format. By default they
+are written by the streaming writer in archive_writer, and the
+bundled makeself script can be used as an alternative backend.
 """
 import os
 import pathlib
@@ -19,6 +20,9 @@ import contextlib
 import uuid
 
 import doodad
+from doodad.darchive import archive_cache as archive_cache_lib
+from doodad.darchive import archive_writer
+from doodad.darchive.compression import Compression, make_compression
 from doodad.utils import cmd_builder
 
 THIS_FILE_DIR = os.path.dirname(__file__)
@@ -27,6 +31,7 @@ MAKESELF_HEADER_PATH = os.path.join(THIS_FILE_DIR, 'makeself-header.sh')
 BEGIN_HEADER = '--- BEGIN DAR OUTPUT ---'
 DAR_PAYLOAD_MOUNT = 'dar_payload'
 FINAL_SCRIPT = './final_script.sh'
+ARCHIVE_BACKENDS = ('python', 'makeself')
 
 def build_archive(archive_filename='runfile.dar',
                   docker_image='ubuntu:18.04',
@@ -36,7 +41,11 @@ def build_archive(archive_filename='runfile.dar',
                   payload_script='',
                   mounts=(),
                   use_gpu_image=False,
-                  verbose=False):
+                  verbose=False,
+                  archive_cache=None,
+                  layer_cache=None,
+                  compression=None,
+                  backend='python'):
     """
     Construct a Doodad Archive
 
@@ -46,6 +55,14 @@ def build_archive(archive_filename='runfile.dar',
         payload_script (str): A command or sequence of shell commands to be
             executed inside the container on when the script is run.
         mounts (tuple): A list of Mount objects
+        archive_cache (ArchiveCache): If provided, an identical previously
+            built archive is reused from this cache instead of rebuilding it.
+        layer_cache (LayerCache): If provided, local mounts are packed into
+            tarballs which are reused across archives.
+        compression (Compression or str): Compression settings, or the name of
+            a compression algorithm. Defaults to gzip at level 9.
+        backend (str): 'python' streams mount files directly into the archive.
+            'makeself' stages a copy of all files and runs makeself.sh.
 
     Returns:
         str: Name of archive file.
@@ -55,6 +72,29 @@ def build_archive(archive_filename='runfile.dar',
                          "'singularity', 'docker'")
     if container_type == 'singularity' and singularity_image is None:
         raise ValueError("singularity_image must be set.")
+    if backend not in ARCHIVE_BACKENDS:
+        raise ValueError("Unknown archive backend: {}. Valid backends: "
+                         "'python', 'makeself'".format(backend))
+    compression = make_compression(compression)
+
+    if archive_cache is not None:
+        cache_key = archive_cache_lib.hash_archive_config(
+            mounts=mounts,
+            docker_image=docker_image,
+            singularity_image=singularity_image,
+            container_type=container_type,
+            extra_container_flags=extra_container_flags,
+            payload_script=payload_script,
+            use_gpu_image=use_gpu_image,
+            verbose=verbose,
+            use_layers=layer_cache is not None,
+            compression=str(compression),
+            backend=backend,
+        )
+        if archive_cache.fetch(cache_key, archive_filename):
+            if verbose:
+                print('Reusing cached archive %s' % archive_cache.path(cache_key))
+            return archive_filename
 
     # create a temporary work directory
     try:
@@ -65,7 +105,8 @@ def build_archive(archive_filename='runfile.dar',
         deps_dir = os.path.join(archive_dir, 'deps')
         os.makedirs(deps_dir)
         for mnt in mounts:
-            mnt.dar_build_archive(deps_dir)
+            mnt.dar_build_archive(deps_dir, layer_cache=layer_cache,
+                                  copy_files=(backend == 'makeself'))
 
         write_run_script(archive_dir, mounts,
             payload_script=payload_script, verbose=verbose)
@@ -86,10 +127,19 @@ def build_archive(archive_filename='runfile.dar',
         write_metadata(archive_dir)
 
         # create the self-extracting archive
-        compile_archive(archive_dir, archive_filename, FINAL_SCRIPT,
-                        verbose=verbose)
+        if backend == 'python':
+            writer = archive_writer.ArchiveWriter(FINAL_SCRIPT, compression=compression)
+            writer.add_tree(archive_dir)
+            for mnt in mounts:
+                mnt.dar_add_to_writer(writer, layer_cache=layer_cache)
+            writer.write(archive_filename)
+        else:
+            compile_archive(archive_dir, archive_filename, FINAL_SCRIPT,
+                            verbose=verbose, compression=compression)
     finally:
         shutil.rmtree(work_dir)
+    if archive_cache is not None:
+        archive_cache.store(cache_key, archive_filename)
     return archive_filename
 
 def write_metadata(arch_dir):
@@ -105,6 +155,7 @@ def write_docker_hook(
     docker_hook_file = os.path.join(arch_dir, script_name)
     builder = cmd_builder.CommandBuilder()
     builder.append('#!/bin/bash')
+    append_host_commands(builder, mounts)
     #if verbose:
     #    builder.echo('All script arguments:')
     #    builder.echo('$@')
@@ -112,8 +163,10 @@ def write_docker_hook(
         for mnt in mounts if mnt.writeable])
     # mount the script into the docker image
     mnt_cmd += ' -v $(pwd):/'+DAR_PAYLOAD_MOUNT
-    docker_cmd = ('docker run {gpu_opt} {mount_cmds} {extra_flags} -t {img} /bin/bash -c "cd /{dar_payload};./run.sh $*"'.format(
-        gpu_opt='--gpus all' if use_nvidia_docker else '',
+    # DAR_DOCKER_FLAGS and DAR_DOCKER_GPUS are set by the host at run time,
+    # e.g. to pin jobs to cores and GPUs (see mode.LocalPoolMode)
+    docker_cmd = ('docker run {gpu_opt} {mount_cmds} {extra_flags} $DAR_DOCKER_FLAGS -t {img} /bin/bash -c "cd /{dar_payload};./run.sh $*"'.format(
+        gpu_opt='--gpus "${DAR_DOCKER_GPUS:-all}"' if use_nvidia_docker else '',
         img=image_name,
         extra_flags=extra_flags,
         mount_cmds=mnt_cmd,
@@ -127,6 +180,13 @@ def write_docker_hook(
         f.write(builder.dump_script())
     os.chmod(docker_hook_file, 0o777)
 
+def append_host_commands(builder, mounts):
+    # e.g. sync manifests, which must be readable outside of the container
+    for mnt in mounts:
+        host_cmd = mnt.dar_host_command()
+        if host_cmd:
+            builder.append(host_cmd)
+
 def write_singularity_hook(arch_dir, image_name, mounts,
                            script_name,
                            extra_flags='',
@@ -134,6 +194,7 @@ def write_singularity_hook(arch_dir, image_name, mounts,
     singularity_hook_file = os.path.join(arch_dir, script_name)
     builder = cmd_builder.CommandBuilder()
     builder.append('#!/bin/bash')
+    append_host_commands(builder, mounts)
     mnt_cmd = ' '.join(['--bind %s:%s' % (mnt.sync_dir, mnt.mount_point)
                        for mnt in mounts if mnt.writeable])
     tmp_dir = tempfile.mkdtemp()
@@ -184,11 +245,12 @@ def write_run_script(arch_dir, mounts, payload_script, verbose=False):
 
     os.chmod(runfile, 0o777)
 
-def compile_archive(archive_dir, output_file, script_name, verbose=False):
-    compile_cmd = "{mkspath} --nocrc --nomd5 --header {mkhpath} {archive_dir} {output_file} {name} {run_script}"
+def compile_archive(archive_dir, output_file, script_name, verbose=False, compression=None):
+    compile_cmd = "{mkspath} --nocrc --nomd5 {compression_flags} --header {mkhpath} {archive_dir} {output_file} {name} {run_script}"
     compile_cmd = compile_cmd.format(
         mkspath=MAKESELF_PATH,
         mkhpath=MAKESELF_HEADER_PATH,
+        compression_flags=make_compression(compression).makeself_flags(),
         name='DAR',
         archive_dir=archive_dir,
         output_file=output_file,
@@ -0,0 +1,205 @@
+"""
+A persistent on-disk cache of built Doodad Archives.
+
+Archives are addressed by a hash of everything that goes into them
+(mounts, payload script, container image and flags), so relaunching an
+unchanged experiment can reuse a previously built archive instead of
+copying and compressing all of its mounts again.
+
+Individual MountLocal directories can also be cached as compressed
+tarball "layers", so that an archive whose payload or one small mount
+changed only needs to pack that mount again.
+
+Example usage:
+
+cache = archive_cache.ArchiveCache(max_size=5*1024**3)
+layers = archive_cache.LayerCache()
+archive_builder_docker.build_archive(..., archive_cache=cache, layer_cache=layers)
+"""
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import uuid
+
+import doodad
+from doodad import utils
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.doodad', 'archive_cache')
+DEFAULT_LAYER_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.doodad', 'layer_cache')
+LAYER_COMPRESS_LEVEL = 6
+
+
+def hash_archive_config(mounts=(), **config):
+    """
+    Computes a cache key for an archive.
+
+    Args:
+        mounts (tuple): A list of Mount objects
+        **config: All other (JSON-serializable) arguments which affect
+            the contents of the archive.
+
+    Returns:
+        str: A hex digest
+    """
+    hasher = hashlib.sha1()
+    hasher.update(('doodad_version=%s\n' % doodad.__version__).encode('utf-8'))
+    hasher.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+    for mnt in mounts:
+        hasher.update(b'\n')
+        hasher.update(mnt.dar_fingerprint().encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class ArchiveCache(object):
+    """
+    A directory of content-addressed files with least-recently-used eviction.
+
+    Args:
+        cache_dir (str): Directory in which to store cached archives.
+        max_size (int): Maximum total size of the cache in bytes.
+            None for no limit.
+        max_entries (int): Maximum number of files in the cache.
+            None for no limit.
+    """
+    suffix = '.dar'
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=10*1024**3, max_entries=100):
+        self.cache_dir = os.path.realpath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        self.max_entries = max_entries
+        utils.makedirs(self.cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def fetch(self, key, filename):
+        """
+        Copies a cached file to filename.
+
+        Returns:
+            bool: True if the key was in the cache.
+        """
+        cached_file = self.path(key)
+        try:
+            # mark as recently used
+            os.utime(cached_file, None)
+        except OSError:
+            return False
+        _copy_file(cached_file, filename)
+        return True
+
+    def store(self, key, filename):
+        """
+        Adds a copy of filename to the cache under key.
+        """
+        tmp_file = os.path.join(self.cache_dir, '.tmp_%s' % uuid.uuid4().hex)
+        try:
+            _copy_file(filename, tmp_file)
+            os.replace(tmp_file, self.path(key))
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        self.evict()
+        return self.path(key)
+
+    def entries(self):
+        """
+        Returns:
+            list: (path, size, last_used) tuples, most recently used first.
+        """
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(self.suffix):
+                continue
+            full_path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            entries.append((full_path, stat.st_size, stat.st_mtime))
+        entries.sort(key=lambda entry: entry[2], reverse=True)
+        return entries
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache is within
+        max_size and max_entries.
+        """
+        total_size = 0
+        for i, (full_path, size, _) in enumerate(self.entries()):
+            total_size += size
+            over_entries = self.max_entries is not None and i >= self.max_entries
+            # always keep the most recently used entry
+            over_size = self.max_size is not None and total_size > self.max_size and i > 0
+            if over_entries or over_size:
+                try:
+                    os.remove(full_path)
+                except OSError:
+                    pass
+                total_size -= size
+
+    def clear(self):
+        for full_path, _, _ in self.entries():
+            os.remove(full_path)
+
+
+class LayerCache(ArchiveCache):
+    """
+    A cache of per-mount tarballs. See ArchiveCache for arguments.
+    """
+    suffix = '.tar.gz'
+
+    def __init__(self, cache_dir=DEFAULT_LAYER_CACHE_DIR, max_size=10*1024**3, max_entries=100):
+        super(LayerCache, self).__init__(cache_dir=cache_dir, max_size=max_size,
+                                         max_entries=max_entries)
+
+    def get_layer(self, mnt, filename=None):
+        """
+        Returns a gzipped tarball of the files in a MountLocal, building
+        and caching it if an identical layer is not cached.
+
+        Members of the tarball are stored under their path inside an
+        archive (deps/local/{name}/...), so a layer can also be appended
+        directly to an archive as one of its parts.
+
+        Args:
+            mnt (MountLocal): A mount
+            filename (str): Location to write the layer to. If None, the
+                path of the layer inside the cache is returned.
+        Returns:
+            str: Path to the layer
+        """
+        key = hashlib.sha1(('layer\n' + mnt.dar_fingerprint()).encode('utf-8')).hexdigest()
+        if filename is None:
+            if key in self:
+                os.utime(self.path(key), None)
+                return self.path(key)
+        elif self.fetch(key, filename):
+            return filename
+        tmp_file = os.path.join(self.cache_dir, '.build_%s' % uuid.uuid4().hex)
+        try:
+            with tarfile.open(tmp_file, 'w:gz', compresslevel=LAYER_COMPRESS_LEVEL,
+                              format=tarfile.GNU_FORMAT, dereference=True) as tar:
+                for arcname, full_path in mnt.dar_archive_files():
+                    tar.add(full_path, arcname=arcname, recursive=False)
+            cached_file = self.store(key, tmp_file)
+        finally:
+            os.remove(tmp_file)
+        if filename is None:
+            return cached_file
+        _copy_file(cached_file, filename)
+        return filename
+
+
+def _copy_file(src, dst):
+    # never a hard link: archive writers truncate and rewrite their output
+    # file in place, which would change the cached entry as well
+    if os.path.exists(dst):
+        os.remove(dst)
+    shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
@@ -0,0 +1,294 @@
+"""
+A pure-Python writer for Doodad Archives.
+
+Archives written here use the same self-extracting makeself header as
+makeself.sh, but files are streamed directly from their sources into a
+compressed tar stream. Mounts do not need to be copied into a staging
+directory first, and no makeself subprocess is involved.
+
+The makeself header extracts an archive as a sequence of independently
+compressed tar "parts", so cached mount layers can be appended to an
+archive verbatim when they use a compatible compression format.
+
+Example usage:
+
+writer = archive_writer.ArchiveWriter(script_name='./run.sh')
+writer.add_tree('/path/to/staging_dir')
+writer.add_files([('code/main.py', '/home/user/code/main.py')])
+writer.write('runfile.dar')
+"""
+import bz2
+import gzip
+import lzma
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import time
+
+from doodad.darchive.compression import make_compression
+
+MAKESELF_HEADER_PATH = os.path.join(os.path.dirname(__file__), 'makeself-header.sh')
+MAKESELF_VERSION = '2.4.0'
+# number of characters reserved in the header for each part size
+FILESIZE_WIDTH = 20
+FILESIZE_PLACEHOLDER = '#'
+# layers in the cache are always gzipped
+LAYER_ALGORITHMS = ('gzip', 'pigz')
+
+_HEREDOC_START = re.compile(r'^cat << EOF\s+>>?\s+"\$archname"$')
+_HEREDOC_TOKEN = re.compile(r'\\([$`\\])|\\\n|\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)|`([^`]*)`')
+_EXPR_PLUS = re.compile(r'^expr (\S+) \+ (\S+)$')
+
+
+def _expand_heredoc(text, variables):
+    """
+    Expands an unquoted shell here-document the way sh does.
+    Only arithmetic command substitutions of the form `expr A + B`
+    are supported.
+    """
+    def expand(match):
+        escaped, braced_var, var, command = match.groups()
+        if escaped is not None:
+            return escaped
+        if braced_var is not None or var is not None:
+            return str(variables.get(braced_var or var, ''))
+        if command is not None:
+            expr_match = _EXPR_PLUS.match(_HEREDOC_TOKEN.sub(expand, command))
+            if expr_match is None:
+                raise ValueError('Unsupported command in makeself header: %s' % command)
+            return str(int(expr_match.group(1)) + int(expr_match.group(2)))
+        return ''  # escaped newline
+    return _HEREDOC_TOKEN.sub(expand, text)
+
+
+def render_header(variables, header_path=MAKESELF_HEADER_PATH):
+    """
+    Renders a makeself header template.
+
+    Args:
+        variables (dict): Values of the makeself.sh variables used by the
+            template. Missing variables expand to empty strings.
+        header_path (str): Path to the header template.
+    Returns:
+        str: The rendered header
+    """
+    with open(header_path) as f:
+        lines = f.read().splitlines(True)
+    output = []
+    i = 0
+    while i < len(lines):
+        line = lines[i].rstrip('\n')
+        i += 1
+        if _HEREDOC_START.match(line):
+            body = []
+            while lines[i].rstrip('\n') != 'EOF':
+                body.append(lines[i])
+                i += 1
+            i += 1
+            output.append(_expand_heredoc(''.join(body), variables))
+        elif line == 'eval "$LSM_CMD"':
+            output.append('No LSM.\n')
+        elif line.strip():
+            raise ValueError('Unsupported line in makeself header: %s' % line)
+    return ''.join(output)
+
+
+class ArchiveWriter(object):
+    """
+    Writes a self-extracting Doodad Archive.
+
+    Args:
+        script_name (str): Script inside the archive to execute after extraction.
+        compression (Compression or str): Compression settings.
+        label (str): Archive label.
+        archive_dir_name (str): Name of the directory the archive extracts
+            to when it is kept.
+    """
+    def __init__(self, script_name, compression=None, label='DAR', archive_dir_name='archive'):
+        self.script_name = script_name
+        self.compression = make_compression(compression)
+        self.label = label
+        self.archive_dir_name = archive_dir_name
+        self._files = []
+        self._layers = []
+
+    def add_file(self, arcname, path):
+        self._files.append((arcname, path))
+
+    def add_files(self, files):
+        """
+        Args:
+            files: An iterable of (path inside archive, local path) tuples
+        """
+        self._files.extend(files)
+
+    def add_tree(self, local_dir, arcname='.'):
+        """
+        Adds a directory and all of its contents.
+        """
+        for dirpath, dirnames, filenames in os.walk(local_dir, followlinks=True):
+            dirnames.sort()
+            for name in dirnames + sorted(filenames):
+                full_path = os.path.join(dirpath, name)
+                rel_path = os.path.relpath(full_path, local_dir)
+                self.add_file(os.path.normpath(os.path.join(arcname, rel_path)), full_path)
+
+    def add_layer(self, layer_file):
+        """
+        Adds the contents of a gzipped tarball (see LayerCache).
+        """
+        self._layers.append(layer_file)
+
+    def write(self, output_file):
+        """
+        Writes the archive to output_file.
+
+        Returns:
+            str: output_file
+        """
+        raw_layers = self.compression.algorithm in LAYER_ALGORITHMS
+        num_parts = 1 + (len(self._layers) if raw_layers else 0)
+        header, filesizes_offset = self._make_header(num_parts)
+
+        with open(output_file, 'wb') as f:
+            f.write(header)
+            part_sizes = []
+            start = f.tell()
+            self._write_tar_part(f, reencode_layers=not raw_layers)
+            part_sizes.append(f.tell() - start)
+            if raw_layers:
+                for layer_file in self._layers:
+                    start = f.tell()
+                    with open(layer_file, 'rb') as layer_f:
+                        _copy_stream(layer_f, f)
+                    part_sizes.append(f.tell() - start)
+
+            filesizes = ' '.join([str(size) for size in part_sizes])
+            f.seek(filesizes_offset)
+            f.write(filesizes.ljust(_filesizes_width(num_parts)).encode('utf-8'))
+        os.chmod(output_file, 0o777)
+        return output_file
+
+    def _uncompressed_kb(self):
+        total = 0
+        for _, path in self._files:
+            total += os.stat(path).st_size
+        for layer_file in self._layers:
+            # gzipped code is usually compressed by at least this much
+            total += 4 * os.stat(layer_file).st_size
+        return total // 1024 + len(self._files) + 1
+
+    def _make_header(self, num_parts):
+        width = _filesizes_width(num_parts)
+        compression = self.compression
+        variables = {
+            'MS_VERSION': MAKESELF_VERSION,
+            'KEEP_UMASK': 'n',
+            'CRCsum': '0000000000',
+            'MD5sum': '0' * 32,
+            'SHAsum': '0' * 64,
+            'LABEL': self.label,
+            'SCRIPT': self.script_name,
+            'archdirname': self.archive_dir_name,
+            'filesizes': FILESIZE_PLACEHOLDER * width,
+            'KEEP': 'n',
+            'NOOVERWRITE': 'n',
+            'EXPORT_CONF': 'n',
+            'GUNZIP_CMD': compression.decompress_command(),
+            'PROGRESS': 'n',
+            'NOX11': 'n',
+            'NOWAIT': 'n',
+            'COPY': 'none',
+            'NEED_ROOT': 'n',
+            'ENCRYPT': 'n',
+            'USIZE': self._uncompressed_kb(),
+            'COMPRESS': compression.algorithm,
+            'DATE': time.strftime('%a %b %d %H:%M:%S %Z %Y'),
+            'OSTYPE': os.environ.get('OSTYPE', sys.platform),
+            'MS_COMMAND': 'doodad',
+            'SKIP': 0,
+        }
+        header = render_header(variables)
+        variables['SKIP'] = header.count('\n')
+        header = render_header(variables).encode('utf-8')
+        filesizes_offset = header.index(('filesizes="%s"' % variables['filesizes']).encode('utf-8'))
+        return header, filesizes_offset + len('filesizes="')
+
+    def _write_tar_part(self, f, reencode_layers=False):
+        with _compressed_stream(f, self.compression) as stream:
+            # symlinks are replaced by what they point to, as shutil.copytree does
+            with tarfile.open(fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT,
+                              dereference=True) as tar:
+                for arcname, path in self._files:
+                    tar.add(path, arcname=arcname, recursive=False)
+                if reencode_layers:
+                    for layer_file in self._layers:
+                        with tarfile.open(layer_file, 'r:gz') as layer:
+                            for member in layer:
+                                tar.addfile(member, layer.extractfile(member) if member.isfile() else None)
+
+
+def _filesizes_width(num_parts):
+    return num_parts * (FILESIZE_WIDTH + 1)
+
+
+def _copy_stream(src, dst, buf_size=1024*1024):
+    while True:
+        data = src.read(buf_size)
+        if not data:
+            break
+        dst.write(data)
+
+
+class _compressed_stream(object):
+    """
+    A context manager returning a writeable file object which compresses
+    its input into f. The standard library is used for gzip, bzip2 and
+    (single-threaded) xz, and other algorithms are piped through their
+    command line tools.
+    """
+    def __init__(self, f, compression):
+        self.f = f
+        self.compression = compression
+        self.process = None
+        self.stream = None
+
+    def __enter__(self):
+        algorithm = self.compression.algorithm
+        level = 9 if self.compression.level is None else self.compression.level
+        if algorithm == 'none':
+            self.stream = _NonClosingFile(self.f)
+        elif algorithm == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.f, mode='wb', compresslevel=level, mtime=0)
+        elif algorithm == 'bzip2':
+            self.stream = bz2.BZ2File(self.f, mode='wb', compresslevel=level)
+        elif algorithm == 'xz' and not self.compression.threads:
+            self.stream = lzma.LZMAFile(self.f, mode='wb', preset=level)
+        else:
+            self.f.flush()
+            self.process = subprocess.Popen(self.compression.compress_command(),
+                                            stdin=subprocess.PIPE, stdout=self.f)
+            self.stream = self.process.stdin
+        return self.stream
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream.close()
+        if self.process is not None:
+            returncode = self.process.wait()
+            # the compressor wrote directly to the file descriptor
+            self.f.seek(0, os.SEEK_END)
+            if returncode != 0 and exc_type is None:
+                raise subprocess.CalledProcessError(returncode, self.compression.compress_command())
+
+
+class _NonClosingFile(object):
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def close(self):
+        pass
@@ -0,0 +1,89 @@
+"""
+Compression settings for Doodad Archives.
+"""
+
+COMPRESSION_ALGORITHMS = ('gzip', 'pigz', 'bzip2', 'pbzip2', 'xz', 'lz4', 'zstd', 'none')
+THREAD_FLAGS = {
+    'pigz': ('-p', '%d'),
+    'pbzip2': ('-p%d',),
+    'xz': ('-T%d',),
+    'zstd': ('-T%d',),
+}
+DECOMPRESS_COMMANDS = {
+    'gzip': 'gzip -cd',
+    'pigz': 'gzip -cd',
+    'bzip2': 'bzip2 -d',
+    'pbzip2': 'bzip2 -d',
+    'xz': 'xz -d',
+    'lz4': 'lz4 -d',
+    'zstd': 'zstd -cd',
+    'none': 'cat',
+}
+
+
+class Compression(object):
+    """
+    Compression settings for a Doodad Archive.
+
+    The decompression tool for the chosen algorithm must be available
+    wherever the archive is run (pigz archives only require gzip).
+
+    Args:
+        algorithm (str): One of 'gzip', 'pigz', 'bzip2', 'pbzip2', 'xz',
+            'lz4', 'zstd' or 'none'.
+        level (int): Compression level. Default 9.
+        threads (int): Number of compression threads. Only used by
+            pigz, pbzip2, xz and zstd.
+    """
+    def __init__(self, algorithm='gzip', level=None, threads=None):
+        if algorithm not in COMPRESSION_ALGORITHMS:
+            raise ValueError("Unknown compression algorithm: {}. Valid algorithms: {}".format(
+                algorithm, ', '.join(COMPRESSION_ALGORITHMS)))
+        self.algorithm = algorithm
+        self.level = level
+        self.threads = threads
+
+    def makeself_flags(self):
+        if self.algorithm == 'none':
+            return '--nocomp'
+        flags = '--' + self.algorithm
+        if self.level is not None:
+            flags += ' --complevel %d' % self.level
+        if self.threads is not None:
+            flags += ' --threads %d' % self.threads
+        return flags
+
+    def compress_command(self):
+        """
+        Returns:
+            list: A command which compresses stdin to stdout, or None
+                for no compression.
+        """
+        if self.algorithm == 'none':
+            return None
+        level = 9 if self.level is None else self.level
+        cmd = [self.algorithm, '-c', '-%d' % level]
+        if self.threads and self.algorithm in THREAD_FLAGS:
+            cmd += [flag % self.threads for flag in THREAD_FLAGS[self.algorithm]]
+        return cmd
+
+    def decompress_command(self):
+        return DECOMPRESS_COMMANDS[self.algorithm]
+
+    def __str__(self):
+        return 'Compression(%s, level=%s, threads=%s)' % (self.algorithm, self.level, self.threads)
+
+
+def make_compression(compression):
+    """
+    Args:
+        compression (Compression or str or None): A Compression object, an
+            algorithm name, or None for the default (gzip -9)
+    Returns:
+        Compression
+    """
+    if compression is None:
+        return Compression()
+    if isinstance(compression, Compression):
+        return compression
+    return Compression(algorithm=compression)
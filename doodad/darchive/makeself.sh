@@ -108,8 +108,11 @@ MS_Usage()
     echo "    --xz               : Compress using xz instead of gzip"
     echo "    --lzo              : Compress using lzop instead of gzip"
     echo "    --lz4              : Compress using lz4 instead of gzip"
+    echo "    --zstd             : Compress using zstd instead of gzip"
     echo "    --compress         : Compress using the UNIX 'compress' command"
     echo "    --complevel lvl    : Compression level for gzip pigz xz lzo lz4 bzip2 and pbzip2 (default 9)"
+    echo "    --threads thds     : Number of threads to be used by compressors that support parallelization."
+    echo "                         Used with pigz, pbzip2, xz and zstd."
     echo "    --base64           : Instead of compressing, encode the data using base64"
     echo "    --gpg-encrypt      : Instead of compressing, encrypt the data using GPG"
     echo "    --gpg-asymmetric-encrypt-sign"
@@ -172,6 +175,7 @@ PASSWD=""
 PASSWD_SRC=""
 OPENSSL_NO_MD=n
 COMPRESS_LEVEL=9
+THREADS=
 KEEP=n
 CURRENT=n
 NOX11=n
@@ -232,6 +236,10 @@ do
 	COMPRESS=lz4
 	shift
 	;;
+    --zstd)
+	COMPRESS=zstd
+	shift
+	;;
     --compress)
 	COMPRESS=Unix
 	shift
@@ -276,6 +284,10 @@ do
 	COMPRESS_LEVEL="$2"
 	if ! shift 2; then MS_Help; exit 1; fi
 	;;
+    --threads)
+	THREADS="$2"
+	if ! shift 2; then MS_Help; exit 1; fi
+	;;
     --notemp)
 	KEEP=y
 	shift
@@ -466,10 +478,16 @@ gzip)
     ;;
 pigz) 
     GZIP_CMD="pigz -$COMPRESS_LEVEL"
+    if test -n "$THREADS"; then
+        GZIP_CMD="$GZIP_CMD --processes $THREADS"
+    fi
     GUNZIP_CMD="gzip -cd"
     ;;
 pbzip2)
     GZIP_CMD="pbzip2 -c$COMPRESS_LEVEL"
+    if test -n "$THREADS"; then
+        GZIP_CMD="$GZIP_CMD -p$THREADS"
+    fi
     GUNZIP_CMD="bzip2 -d"
     ;;
 bzip2)
@@ -478,6 +496,9 @@ bzip2)
     ;;
 xz)
     GZIP_CMD="xz -c$COMPRESS_LEVEL"
+    if test -n "$THREADS"; then
+        GZIP_CMD="$GZIP_CMD -T$THREADS"
+    fi
     GUNZIP_CMD="xz -d"
     ;;
 lzo)
@@ -488,6 +509,13 @@ lz4)
     GZIP_CMD="lz4 -c$COMPRESS_LEVEL"
     GUNZIP_CMD="lz4 -d"
     ;;
+zstd)
+    GZIP_CMD="zstd -c -$COMPRESS_LEVEL"
+    if test -n "$THREADS"; then
+        GZIP_CMD="$GZIP_CMD -T$THREADS"
+    fi
+    GUNZIP_CMD="zstd -cd"
+    ;;
 base64)
     GZIP_CMD="base64"
     GUNZIP_CMD="base64 --decode -i -"
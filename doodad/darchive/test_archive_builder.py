@@ -3,6 +3,7 @@ import tempfile
 import os
 import os.path as path
 import shutil
+import subprocess
 
 from doodad import mount
 from doodad.darchive import archive_builder_docker
@@ -135,5 +136,55 @@ class TestDockerArchiveBuilder(unittest.TestCase):
         output = output.strip()
         self.assertEqual(output, 'hi --help')
 
+class TestHostCommands(unittest.TestCase):
+    def test_hooks(self):
+        """ Sync manifests are written outside of the container """
+        work_dir = tempfile.mkdtemp()
+        try:
+            mnt = mount.MountS3(s3_path='logs', mount_point='/data')
+            for container_type in ['docker', 'singularity']:
+                archive = path.join(work_dir, container_type + '.dar')
+                archive_builder_docker.build_archive(archive_filename=archive,
+                                                     payload_script='echo hello123',
+                                                     container_type=container_type,
+                                                     singularity_image='image.sif',
+                                                     mounts=[mnt])
+                extract_dir = path.join(work_dir, container_type)
+                subprocess.check_call(['sh', archive, '--noexec', '--target', extract_dir],
+                                      stdout=subprocess.DEVNULL)
+                with open(path.join(extract_dir, 'final_script.sh')) as f:
+                    self.assertIn(mnt.dar_host_command(), f.read())
+                with open(path.join(extract_dir, 'run.sh')) as f:
+                    self.assertNotIn(mnt.dar_host_command(), f.read())
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class TestCompression(unittest.TestCase):
+    def test_flags(self):
+        self.assertEqual(archive_builder_docker.make_compression(None).makeself_flags(), '--gzip')
+        self.assertEqual(archive_builder_docker.make_compression('none').makeself_flags(), '--nocomp')
+        compression = archive_builder_docker.Compression('zstd', level=3, threads=8)
+        self.assertEqual(compression.makeself_flags(), '--zstd --complevel 3 --threads 8')
+        with self.assertRaises(ValueError):
+            archive_builder_docker.Compression('rar')
+
+    def test_extract(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            for algorithm in ['none', 'bzip2', 'xz']:
+                archive = path.join(work_dir, algorithm + '.dar')
+                archive_builder_docker.build_archive(archive_filename=archive,
+                                                     payload_script='echo hello123',
+                                                     compression=algorithm)
+                extract_dir = path.join(work_dir, algorithm)
+                subprocess.check_call(['sh', archive, '--noexec', '--target', extract_dir],
+                                      stdout=subprocess.DEVNULL)
+                with open(path.join(extract_dir, 'run.sh')) as f:
+                    self.assertIn('echo hello123', f.read())
+        finally:
+            shutil.rmtree(work_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
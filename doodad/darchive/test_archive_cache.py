@@ -0,0 +1,104 @@
+import unittest
+import os
+import os.path as path
+import shutil
+import subprocess
+import tempfile
+
+from doodad import mount
+from doodad.darchive import archive_builder_docker, archive_cache
+from doodad.utils import TESTING_DIR
+
+
+class TestArchiveCache(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache = archive_cache.ArchiveCache(cache_dir=path.join(self.work_dir, 'cache'))
+        self.source_dir = path.join(self.work_dir, 'source')
+        shutil.copytree(path.join(TESTING_DIR, 'mount_test', 'source_dir'), self.source_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def build(self, name, payload_script='echo hello123', **kwargs):
+        mnt = mount.MountLocal(local_dir=self.source_dir, mount_point='./mymount')
+        archive_file = path.join(self.work_dir, name)
+        kwargs.setdefault('archive_cache', self.cache)
+        archive_builder_docker.build_archive(archive_filename=archive_file,
+                                             payload_script=payload_script,
+                                             docker_image='python:3',
+                                             mounts=[mnt],
+                                             **kwargs)
+        return archive_file, mnt
+
+    def test_reuse(self):
+        archive1, _ = self.build('a.dar')
+        self.assertEqual(len(self.cache.entries()), 1)
+        archive2, _ = self.build('b.dar')
+        self.assertEqual(len(self.cache.entries()), 1)
+        with open(archive1, 'rb') as f1, open(archive2, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_rebuild_same_file(self):
+        archive, _ = self.build('a.dar', payload_script='echo AAA')
+        with open(archive, 'rb') as f:
+            contents = f.read()
+        self.build('a.dar', payload_script='echo BBB')
+        self.build('a.dar', payload_script='echo AAA')
+        # rewriting the output must not change the cached archive
+        with open(archive, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+
+    def test_payload_changes_key(self):
+        self.build('a.dar')
+        self.build('b.dar', payload_script='echo bye')
+        self.assertEqual(len(self.cache.entries()), 2)
+
+    def test_mount_changes_key(self):
+        mnt = mount.MountLocal(local_dir=self.source_dir)
+        key1 = archive_cache.hash_archive_config(mounts=[mnt])
+        with open(path.join(self.source_dir, 'new.txt'), 'w') as f:
+            f.write('new')
+        key2 = archive_cache.hash_archive_config(mounts=[mnt])
+        self.assertNotEqual(key1, key2)
+        # filtered files do not affect the key
+        with open(path.join(self.source_dir, 'ignored.pyc'), 'w') as f:
+            f.write('new')
+        key3 = archive_cache.hash_archive_config(mounts=[mnt])
+        self.assertEqual(key2, key3)
+
+    def test_evict(self):
+        cache = archive_cache.ArchiveCache(cache_dir=path.join(self.work_dir, 'small_cache'),
+                                           max_entries=2)
+        for i, key in enumerate(['a', 'b', 'c']):
+            src_file = path.join(self.work_dir, key + '.txt')
+            with open(src_file, 'w') as f:
+                f.write(key)
+            cache.store(key, src_file)
+            os.utime(cache.path(key), (i, i))
+        cache.evict()
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertFalse(cache.fetch('a', path.join(self.work_dir, 'out.txt')))
+        self.assertTrue(cache.fetch('b', path.join(self.work_dir, 'out.txt')))
+
+    def test_layers(self):
+        layers = archive_cache.LayerCache(cache_dir=path.join(self.work_dir, 'layers'))
+        archive, mnt = self.build('a.dar', archive_cache=None, layer_cache=layers)
+        self.build('b.dar', payload_script='echo bye', archive_cache=None, layer_cache=layers)
+        self.assertEqual(len(layers.entries()), 1)
+
+        # unpack the archive without running it and mount the layer
+        extract_dir = path.join(self.work_dir, 'extract')
+        subprocess.check_call(['sh', archive, '--noexec', '--target', extract_dir],
+                              stdout=subprocess.DEVNULL)
+        subprocess.check_call(['sh', mnt.dar_extract_command()], cwd=extract_dir)
+        with open(path.join(extract_dir, 'mymount', 'a.txt')) as f:
+            with open(path.join(self.source_dir, 'a.txt')) as f_src:
+                self.assertEqual(f.read(), f_src.read())
+        self.assertTrue(path.exists(path.join(extract_dir, 'mymount', 'foo', 'placeholder')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import os
+import os.path as path
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+from doodad import mount
+from doodad.darchive import archive_builder_docker, archive_cache, archive_writer
+from doodad.utils import TESTING_DIR
+
+
+def extract_and_run(archive, extract_dir):
+    """Runs the payload of an archive without starting a container."""
+    subprocess.check_call(['sh', archive, '--noexec', '--target', extract_dir],
+                          stdout=subprocess.DEVNULL)
+    return subprocess.check_output(['bash', './run.sh'], cwd=extract_dir).decode('utf-8')
+
+
+class TestHeader(unittest.TestCase):
+    def test_matches_shell(self):
+        variables = {
+            'MS_VERSION': '2.4.0',
+            'LABEL': 'DAR',
+            'SCRIPT': './final_script.sh',
+            'filesizes': '1234',
+            'GUNZIP_CMD': 'gzip -cd',
+            'USIZE': 12,
+            'SKIP': 600,
+            'LSM_CMD': 'echo No LSM. >> "$archname"',
+        }
+        work_dir = tempfile.mkdtemp()
+        try:
+            header_file = path.join(work_dir, 'header.sh')
+            cmd = ''.join(['%s=%s\n' % (key, shlex.quote(str(value)))
+                           for key, value in variables.items()])
+            cmd += 'archname=%s\n. %s\n' % (header_file, archive_writer.MAKESELF_HEADER_PATH)
+            subprocess.check_call(['sh', '-c', cmd])
+            with open(header_file) as f:
+                self.assertEqual(archive_writer.render_header(variables), f.read())
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class TestArchiveWriter(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.mnt = mount.MountLocal(local_dir=TESTING_DIR, mount_point='./mymount')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def build(self, name, **kwargs):
+        archive = path.join(self.work_dir, name + '.dar')
+        archive_builder_docker.build_archive(archive_filename=archive,
+                                             payload_script='cat ./mymount/secret.txt',
+                                             mounts=[self.mnt],
+                                             **kwargs)
+        return extract_and_run(archive, path.join(self.work_dir, name))
+
+    def test_local_mount(self):
+        for compression in ['gzip', 'none', 'bzip2']:
+            output = self.build(compression, compression=compression)
+            self.assertEqual(output.strip(), 'apple')
+        mount_dir = path.join(self.work_dir, 'gzip', 'mymount')
+        self.assertTrue(path.exists(path.join(mount_dir, 'mount_test', 'source_dir', 'a.txt')))
+
+    def test_layers(self):
+        layers = archive_cache.LayerCache(cache_dir=path.join(self.work_dir, 'layers'))
+        # gzipped layers are appended as separate parts
+        output = self.build('gzip', layer_cache=layers)
+        self.assertEqual(output.strip(), 'apple')
+        # other compression algorithms repack the layer
+        output = self.build('bzip2', layer_cache=layers, compression='bzip2')
+        self.assertEqual(output.strip(), 'apple')
+        self.assertEqual(len(layers.entries()), 1)
+
+    def test_symlinks(self):
+        source_dir = path.join(self.work_dir, 'source')
+        os.makedirs(path.join(self.work_dir, 'target', 'dir'))
+        with open(path.join(self.work_dir, 'target', 'dir', 'b.txt'), 'w') as f:
+            f.write('banana\n')
+        os.makedirs(source_dir)
+        os.symlink(path.join(self.work_dir, 'target', 'dir'), path.join(source_dir, 'linked_dir'))
+        os.symlink(path.join(self.work_dir, 'target', 'dir', 'b.txt'), path.join(source_dir, 'linked.txt'))
+        self.mnt = mount.MountLocal(local_dir=source_dir, mount_point='./mymount')
+        layers = archive_cache.LayerCache(cache_dir=path.join(self.work_dir, 'layers'))
+        for name, kwargs in [('python', {}), ('layer', {'layer_cache': layers})]:
+            archive = path.join(self.work_dir, name + '.dar')
+            archive_builder_docker.build_archive(archive_filename=archive,
+                                                 payload_script='cat ./mymount/linked_dir/b.txt ./mymount/linked.txt',
+                                                 mounts=[self.mnt], **kwargs)
+            # the archive holds copies, which work once the targets are gone
+            shutil.move(path.join(self.work_dir, 'target'), path.join(self.work_dir, 'moved'))
+            try:
+                output = extract_and_run(archive, path.join(self.work_dir, name))
+            finally:
+                shutil.move(path.join(self.work_dir, 'moved'), path.join(self.work_dir, 'target'))
+            self.assertEqual(output, 'banana\nbanana\n')
+            self.assertFalse(path.islink(path.join(self.work_dir, name, 'mymount', 'linked.txt')))
+
+    def test_matches_makeself(self):
+        python_dir = path.join(self.work_dir, 'python')
+        makeself_dir = path.join(self.work_dir, 'makeself')
+        self.build('python')
+        self.build('makeself', backend='makeself')
+        for dirpath, dirnames, filenames in os.walk(makeself_dir):
+            rel_path = path.relpath(dirpath, makeself_dir)
+            self.assertEqual(set(filenames), set(os.listdir(path.join(python_dir, rel_path))) - set(dirnames))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+"""
+A local SQLite database of launched jobs.
+
+Every LaunchMode records the scripts it runs in the default registry,
+so the state of a sweep can be checked with a local query.
+
+Example usage:
+
+registry = job_registry.get_registry()
+with job_registry.job_context(sweep_id='my_sweep', config={'lr': 0.1}):
+    mode.run_script(archive)
+registry.query(sweep_id='my_sweep', status=job_registry.STATUS_RUNNING)
+registry.count_by_status(sweep_id='my_sweep')
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from doodad import utils
+
+DEFAULT_DB_PATH = os.path.join(os.path.expanduser('~'), '.doodad', 'jobs.db')
+# overrides DEFAULT_DB_PATH, e.g. ':memory:' in tests
+DB_PATH_ENV = 'DOODAD_JOB_DB'
+
+# written but must be submitted by the user, e.g. slurm scripts
+STATUS_PENDING = 'pending'
+# handed to a remote scheduler or cloud provider
+STATUS_SUBMITTED = 'submitted'
+STATUS_RUNNING = 'running'
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+
+COLUMNS = ('job_id', 'sweep_id', 'mode', 'config', 'command', 'archive_hash',
+           'instance_id', 'status', 'exit_code', 'created_at', 'updated_at')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    sweep_id TEXT,
+    mode TEXT,
+    config TEXT,
+    command TEXT,
+    archive_hash TEXT,
+    instance_id TEXT,
+    status TEXT,
+    exit_code INTEGER,
+    created_at REAL,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_sweep_status ON jobs (sweep_id, status);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_instance ON jobs (instance_id);
+"""
+
+
+class JobRegistry(object):
+    """
+    Stores jobs in a SQLite database. Safe to use from multiple threads.
+
+    Args:
+        db_path (str): Path to the database file, or ':memory:'.
+    """
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        if db_path != ':memory:':
+            db_path = os.path.expanduser(db_path)
+            utils.makedirs(os.path.dirname(os.path.abspath(db_path)))
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            if db_path != ':memory:':
+                # allows other processes to read while jobs are launched
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+
+    def add_job(self, mode, command, status, sweep_id=None, config=None,
+                archive_hash=None, instance_id=None):
+        """
+        Returns:
+            str: A new job id
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO jobs (job_id, sweep_id, mode, config, command, archive_hash, '
+                'instance_id, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, sweep_id, mode, json.dumps(config, default=str), command,
+                 archive_hash, instance_id, status, now, now))
+        return job_id
+
+    def update_job(self, job_id, status=None, instance_id=None, exit_code=None):
+        updates = {'updated_at': time.time()}
+        if status is not None:
+            updates['status'] = status
+        if instance_id is not None:
+            updates['instance_id'] = instance_id
+        if exit_code is not None:
+            updates['exit_code'] = exit_code
+        keys = sorted(updates.keys())
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE jobs SET %s WHERE job_id = ?' % ', '.join(['%s = ?' % key for key in keys]),
+                [updates[key] for key in keys] + [job_id])
+
+    def get_job(self, job_id):
+        jobs = self._select('job_id = ?', [job_id])
+        return jobs[0] if jobs else None
+
+    def query(self, sweep_id=None, status=None, mode=None, instance_id=None):
+        """
+        Returns:
+            list: Jobs matching all of the given fields as dicts, oldest first.
+        """
+        conditions, args = _where(sweep_id=sweep_id, status=status, mode=mode,
+                                  instance_id=instance_id)
+        return self._select(conditions, args)
+
+    def count_by_status(self, sweep_id=None):
+        """
+        Returns:
+            dict: A mapping from status to the number of jobs.
+        """
+        conditions, args = _where(sweep_id=sweep_id)
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT status, COUNT(*) FROM jobs WHERE %s GROUP BY status' % conditions,
+                args).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def close(self):
+        self._conn.close()
+
+    def _select(self, conditions, args):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT %s FROM jobs WHERE %s ORDER BY created_at' % (', '.join(COLUMNS), conditions),
+                args).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(zip(COLUMNS, row))
+            job['config'] = json.loads(job['config']) if job['config'] else None
+            jobs.append(job)
+        return jobs
+
+
+def _where(**fields):
+    conditions = ['%s = ?' % key for key in sorted(fields) if fields[key] is not None]
+    args = [fields[key] for key in sorted(fields) if fields[key] is not None]
+    return ' AND '.join(conditions) or '1', args
+
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+_DISABLED = False
+
+
+def set_registry(registry):
+    """
+    Sets the registry used by all launch modes. None disables job recording.
+    """
+    global _REGISTRY, _DISABLED
+    _REGISTRY = registry
+    _DISABLED = registry is None
+
+
+def get_registry():
+    """
+    Returns the registry used by all launch modes, creating one at
+    $DOODAD_JOB_DB or DEFAULT_DB_PATH if none was set. If it cannot be
+    created, a warning is printed once and job recording is disabled.
+    """
+    global _REGISTRY, _DISABLED
+    with _REGISTRY_LOCK:
+        if _DISABLED:
+            return None
+        if _REGISTRY is None:
+            db_path = os.environ.get(DB_PATH_ENV) or DEFAULT_DB_PATH
+            try:
+                _REGISTRY = JobRegistry(db_path)
+            except Exception as e:
+                # e.g. an unwritable home directory or a locked database
+                print('WARNING: Could not open job registry %s (%s). Jobs will not be recorded.' % (
+                    db_path, e))
+                _DISABLED = True
+                return None
+    return _REGISTRY
+
+
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def job_context(sweep_id=None, config=None):
+    """
+    Attaches a sweep id and config to jobs launched by this thread
+    within the context.
+    """
+    old_context = getattr(_context, 'value', None)
+    _context.value = {'sweep_id': sweep_id, 'config': config}
+    try:
+        yield
+    finally:
+        _context.value = old_context
+
+
+def current_context():
+    return getattr(_context, 'value', None) or {'sweep_id': None, 'config': None}
+
+
+def hash_archive(command):
+    """
+    Returns a hash of the archive (or script) run by a command, or None
+    if it is not a local file.
+    """
+    script = command.split(' -- ')[0].split()[0] if command.strip() else ''
+    try:
+        return utils.hash_file_cached(script)
+    except (OSError, IOError):
+        return None
+
+
+def record_job(mode, command, status, instance_id=None, context=None):
+    """
+    Adds a job to the default registry, using the current job context.
+    Failures to write to the registry are printed rather than raised so
+    that they never interrupt a launch.
+
+    Returns:
+        str: The job id, or None if the job was not recorded.
+    """
+    if context is None:
+        context = current_context()
+    try:
+        registry = get_registry()
+        if registry is None:
+            return None
+        return registry.add_job(str(mode), command, status,
+                                sweep_id=context['sweep_id'],
+                                config=context['config'],
+                                archive_hash=hash_archive(command),
+                                instance_id=instance_id)
+    except Exception as e:
+        # e.g. an unwritable home directory
+        print('Failed to record job: %s' % e)
+        return None
+
+
+def update_job(job_id, status=None, instance_id=None, exit_code=None):
+    if job_id is None:
+        return
+    try:
+        registry = get_registry()
+        if registry is None:
+            return
+        registry.update_job(job_id, status=status, instance_id=instance_id, exit_code=exit_code)
+    except Exception as e:
+        print('Failed to update job: %s' % e)
@@ -26,6 +26,9 @@ def run_command(
         singularity_image=None,
         container_type='docker',
         extra_container_flags='',
+        archive_cache=None,
+        layer_cache=None,
+        compression=None,
     ):
     """
     Runs a shell command using doodad via a specified launch mode.
@@ -40,6 +43,10 @@ def run_command(
         container_type (string): either 'docker' or 'singularity
         extra_container_flags (string): flags other than GPU flags to pass to
             docker run or singularity exec.
+        archive_cache (ArchiveCache): Optional cache of previously built archives.
+        layer_cache (LayerCache): Optional cache of packed local mounts.
+        compression (Compression or str): Archive compression settings,
+            i.e. 'lz4' or archive_builder.Compression('zstd', threads=8)
 
     Returns:
         A string output if return_output is True,
@@ -54,7 +61,10 @@ def run_command(
                                                 container_type=container_type,
                                                 extra_container_flags=extra_container_flags,
                                                 use_gpu_image=mode.use_gpu,
-                                                mounts=mounts)
+                                                mounts=mounts,
+                                                archive_cache=archive_cache,
+                                                layer_cache=layer_cache,
+                                                compression=compression)
         cmd = archive
         if cli_args:
             cmd = archive + ' -- ' + cli_args
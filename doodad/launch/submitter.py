@@ -0,0 +1,144 @@
+"""
+Concurrent submission of many jobs to a launch mode.
+
+Launching on cloud modes (EC2Mode, GCPMode) is dominated by blocking
+uploads and API requests, so sweeps submit jobs from a pool of threads.
+
+Example usage:
+
+submitter = JobSubmitter(max_workers=8, max_retries=2)
+results = submitter.map(lambda cmd: mode.run_script(cmd), commands)
+"""
+import concurrent.futures
+import time
+
+from doodad.utils import safe_import
+botocore = safe_import.try_import('botocore')
+botocore.exceptions = safe_import.try_import('botocore.exceptions')
+googleapiclient = safe_import.try_import('googleapiclient')
+googleapiclient.errors = safe_import.try_import('googleapiclient.errors')
+
+
+def _exception_types(module_name, names):
+    module = safe_import.try_import(module_name)
+    if isinstance(module, safe_import.FailedImportModule):
+        return ()
+    return tuple(getattr(module, name) for name in names)
+
+
+# network errors which are retried by default, including those of the
+# cloud SDKs. Launches on cloud modes are not idempotent, so other errors
+# (e.g. after an instance was created) are not retried, to avoid launching
+# duplicate instances.
+TRANSIENT_EXCEPTIONS = ((ConnectionError, TimeoutError) +
+                        _exception_types('botocore.exceptions', ['ConnectionError']) +
+                        _exception_types('requests.exceptions', ['ConnectionError']) +
+                        _exception_types('urllib3.exceptions', ['NewConnectionError']) +
+                        _exception_types('google.auth.exceptions', ['TransportError']))
+
+# error codes of rejected AWS requests which can be retried
+AWS_THROTTLING_CODES = frozenset(['Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                                  'RequestThrottled', 'TooManyRequestsException', 'SlowDown'])
+
+
+def is_transient_error(e):
+    """
+    Returns True if e is a network error, or a cloud API error caused by
+    rate limiting or an unavailable service.
+    """
+    if isinstance(e, TRANSIENT_EXCEPTIONS):
+        return True
+    if not isinstance(botocore, safe_import.FailedImportModule) and \
+            isinstance(e, botocore.exceptions.ClientError):
+        return e.response.get('Error', {}).get('Code') in AWS_THROTTLING_CODES
+    if not isinstance(googleapiclient, safe_import.FailedImportModule) and \
+            isinstance(e, googleapiclient.errors.HttpError):
+        return e.resp.status == 429 or e.resp.status >= 500
+    return False
+
+
+class JobSubmitter(object):
+    """
+    Calls a function on many jobs with bounded concurrency and per-job retries.
+
+    Args:
+        max_workers (int): Maximum number of jobs submitted at once.
+            If 1, jobs are submitted serially from the calling thread.
+        max_retries (int): Number of times to retry a job which raised
+            one of retry_exceptions.
+        retry_delay (float): Seconds to wait before the first retry.
+            The delay doubles after every retry.
+        retry_exceptions (tuple): Exception types which trigger a retry.
+            By default, errors for which is_transient_error is True.
+    """
+    def __init__(self, max_workers=1, max_retries=0, retry_delay=1.0,
+                 retry_exceptions=None):
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_exceptions = retry_exceptions
+
+    def call(self, fn, job):
+        """
+        Calls fn(job), retrying on failure.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn(job)
+            except Exception as e:
+                if attempt == self.max_retries or not self._should_retry(e):
+                    raise
+                delay = self.retry_delay * (2 ** attempt)
+                print('Job submission failed (%s). Retrying in %.1f seconds.' % (e, delay))
+                time.sleep(delay)
+
+    def _should_retry(self, e):
+        if self.retry_exceptions is None:
+            return is_transient_error(e)
+        return isinstance(e, self.retry_exceptions)
+
+    def map(self, fn, jobs):
+        """
+        Calls fn on every job.
+
+        jobs may be a lazy iterable; at most 2*max_workers jobs are
+        pulled from it ahead of the ones being submitted. If a job fails
+        after all retries, jobs which were already started are allowed to
+        finish and then the exception of the earliest failed job is raised.
+
+        Args:
+            fn: A function of one argument
+            jobs: An iterable of arguments to fn
+
+        Returns:
+            list: Results of fn, in the same order as jobs.
+        """
+        if self.max_workers == 1:
+            return [self.call(fn, job) for job in jobs]
+
+        results = {}
+        errors = {}
+        pending = {}
+
+        def collect(done):
+            for future in done:
+                idx = pending.pop(future)
+                try:
+                    results[idx] = future.result()
+                except Exception as e:
+                    errors[idx] = e
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for idx, job in enumerate(jobs):
+                if errors:
+                    break
+                pending[executor.submit(self.call, fn, job)] = idx
+                if len(pending) >= 2 * self.max_workers:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+            done, _ = concurrent.futures.wait(pending)
+            collect(done)
+        if errors:
+            raise errors[min(errors)]
+        return [results[idx] for idx in range(len(results))]
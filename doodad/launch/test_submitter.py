@@ -0,0 +1,115 @@
+import unittest
+import random
+import threading
+import time
+
+from doodad.launch.submitter import JobSubmitter
+from doodad.utils import safe_import
+botocore = safe_import.try_import('botocore')
+botocore.exceptions = safe_import.try_import('botocore.exceptions')
+googleapiclient = safe_import.try_import('googleapiclient')
+googleapiclient.errors = safe_import.try_import('googleapiclient.errors')
+httplib2 = safe_import.try_import('httplib2')
+
+
+def fail_twice(error):
+    attempts = []
+
+    def job(x):
+        attempts.append(x)
+        if len(attempts) < 3:
+            raise error
+        return x
+    return job, attempts
+
+
+class TestJobSubmitter(unittest.TestCase):
+    def test_ordered_results(self):
+        def job(x):
+            time.sleep(random.random() * 0.01)
+            return x * x
+        for max_workers in [1, 4]:
+            submitter = JobSubmitter(max_workers=max_workers)
+            self.assertEqual(submitter.map(job, iter(range(20))), [x * x for x in range(20)])
+
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        counts = {'running': 0, 'max': 0}
+
+        def job(x):
+            with lock:
+                counts['running'] += 1
+                counts['max'] = max(counts['max'], counts['running'])
+            time.sleep(0.01)
+            with lock:
+                counts['running'] -= 1
+        JobSubmitter(max_workers=3).map(job, range(12))
+        self.assertLessEqual(counts['max'], 3)
+        self.assertGreater(counts['max'], 1)
+
+    def test_retry(self):
+        attempts = {}
+
+        def flaky_job(x):
+            attempts[x] = attempts.get(x, 0) + 1
+            if attempts[x] < 3:
+                raise ConnectionError('transient error')
+            return x
+        submitter = JobSubmitter(max_workers=2, max_retries=2, retry_delay=0)
+        self.assertEqual(submitter.map(flaky_job, range(4)), list(range(4)))
+
+        attempts.clear()
+        submitter = JobSubmitter(max_workers=2, max_retries=1, retry_delay=0)
+        with self.assertRaises(ConnectionError):
+            submitter.map(flaky_job, range(4))
+
+    def test_no_retry(self):
+        attempts = []
+
+        def failing_job(x):
+            attempts.append(x)
+            raise ValueError('launched but failed afterwards')
+        submitter = JobSubmitter(max_retries=2, retry_delay=0)
+        with self.assertRaises(ValueError):
+            submitter.map(failing_job, range(1))
+        self.assertEqual(attempts, [0])
+
+
+    @unittest.skipIf(isinstance(botocore, safe_import.FailedImportModule), 'botocore is required')
+    def test_retry_botocore(self):
+        submitter = JobSubmitter(max_retries=2, retry_delay=0)
+        job, attempts = fail_twice(botocore.exceptions.EndpointConnectionError(
+            endpoint_url='https://ec2.us-west-1.amazonaws.com'))
+        self.assertEqual(submitter.map(job, range(1)), [0])
+        self.assertEqual(len(attempts), 3)
+
+        throttled = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'RequestLimitExceeded'}}, 'RunInstances')
+        job, attempts = fail_twice(throttled)
+        self.assertEqual(submitter.map(job, range(1)), [0])
+
+        denied = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'UnauthorizedOperation'}}, 'RunInstances')
+        job, attempts = fail_twice(denied)
+        with self.assertRaises(botocore.exceptions.ClientError):
+            submitter.map(job, range(1))
+        self.assertEqual(len(attempts), 1)
+
+    @unittest.skipIf(isinstance(googleapiclient, safe_import.FailedImportModule) or
+                     isinstance(httplib2, safe_import.FailedImportModule),
+                     'googleapiclient is required')
+    def test_retry_googleapiclient(self):
+        submitter = JobSubmitter(max_retries=2, retry_delay=0)
+        for status, retried in [(429, True), (503, True), (403, False)]:
+            error = googleapiclient.errors.HttpError(httplib2.Response({'status': status}), b'')
+            job, attempts = fail_twice(error)
+            if retried:
+                self.assertEqual(submitter.map(job, range(1)), [0])
+            else:
+                with self.assertRaises(googleapiclient.errors.HttpError):
+                    submitter.map(job, range(1))
+                self.assertEqual(len(attempts), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,8 @@
+import collections
+import concurrent.futures
+import copy
 import math
+import multiprocessing
 import os
 import json
 import uuid
@@ -8,17 +12,24 @@ import pprint
 import shlex
 import shutil
 import pathlib
+import queue
+import subprocess
+import threading
+import time
 
+from doodad import job_registry
 from doodad.apis.slurm_util import SlurmJobGenerator
 from doodad.utils import safe_import, shell, script_builder, cmd_builder
+from doodad.apis.ec2 import image_builder
 from doodad.apis.ec2.autoconfig import Autoconfig
+from doodad.credentials import ssh
 from doodad.credentials.ec2 import AWSCredentials
 
 googleapiclient = safe_import.try_import('googleapiclient')
 googleapiclient.discovery = safe_import.try_import('googleapiclient.discovery')
 boto3 = safe_import.try_import('boto3')
 botocore = safe_import.try_import('botocore')
-from doodad.apis import gcp_util, aws_util
+from doodad.apis import gcp_util, aws_util, ssh_util
 
 
 class LaunchMode(object):
@@ -29,6 +40,9 @@ class LaunchMode(object):
         shell_interpreter (str): Interpreter command for script. Default 'sh'
         async_run (bool): If True,
     """
+    # True if run_scripts launches many scripts with fewer requests than run_script
+    batch_launch = False
+
     def __init__(self, shell_interpreter='sh', async_run=False, use_gpu=False):
         self.shell_interpreter = shell_interpreter
         self.async_run = async_run
@@ -47,12 +61,51 @@ class LaunchMode(object):
         run_cmd = self._get_run_command(script_filename)
         if verbose:
             print('Executing command:', run_cmd)
+        job_id = None
+        if not dry:
+            job_id = self._record_job(script_filename, job_registry.STATUS_RUNNING)
         if return_output:
-            output = shell.call_and_get_output(run_cmd, shell=True, dry=dry)
+            output, returncode = shell.call_and_get_output(run_cmd, shell=True, dry=dry,
+                                                           return_code=True)
+            self._record_exit(job_id, returncode)
             if output:
                 return output.decode('utf-8')
         else:
-            shell.call(run_cmd, shell=True, dry=dry, wait=not self.async_run)
+            returncode = shell.call(run_cmd, shell=True, dry=dry, wait=not self.async_run)
+            if not self.async_run:
+                self._record_exit(job_id, returncode)
+
+    def run_scripts(self, script_filenames, dry=False, verbose=False, configs=None):
+        """
+        Runs many shell scripts. Modes which can launch many jobs in a
+        single request (batch_launch = True) override this.
+
+        Args:
+            script_filenames (list): Commands to run, as passed to run_script.
+            configs (list): If given, the config of each command, which is
+                recorded in the job registry.
+        """
+        context = job_registry.current_context()
+        for i, script_filename in enumerate(script_filenames):
+            config = configs[i] if configs is not None else context['config']
+            with job_registry.job_context(sweep_id=context['sweep_id'], config=config):
+                self.run_script(script_filename, dry=dry, verbose=verbose)
+
+    def _record_job(self, script_filename, status, instance_id=None, context=None):
+        """
+        Records a launched script in the job registry. See job_registry.py.
+
+        Returns:
+            str: A job id
+        """
+        return job_registry.record_job(self, script_filename, status,
+                                       instance_id=instance_id, context=context)
+
+    def _record_exit(self, job_id, returncode):
+        if returncode is None:
+            return
+        status = job_registry.STATUS_SUCCEEDED if returncode == 0 else job_registry.STATUS_FAILED
+        job_registry.update_job(job_id, status=status, exit_code=returncode)
 
     def _get_run_command(self, script_filename):
         raise NotImplementedError()
@@ -75,17 +128,562 @@ class LocalMode(LaunchMode):
         return '%s %s' % (self.shell_interpreter, script_filename)
 
 
+JobResult = collections.namedtuple('JobResult', ['returncode', 'output'])
+
+
+class LocalPoolMode(LocalMode):
+    """
+    A LocalPoolMode runs many scripts concurrently on the host computer.
+
+    Each script runs in one of a fixed number of worker slots, and scripts
+    wait in a queue while all slots are busy. Slots can be pinned to
+    disjoint sets of CPU cores and to GPUs. Pinning is passed to docker
+    through the DAR_DOCKER_FLAGS and DAR_DOCKER_GPUS environment variables,
+    and otherwise applied with taskset and CUDA_VISIBLE_DEVICES.
+
+    Example usage:
+
+    mode = LocalPoolMode(num_slots=16, cpus_per_job=4)
+    futures = [mode.submit(script) for script in scripts]
+    exit_codes = [future.result().returncode for future in futures]
+
+    Args:
+        num_slots (int): Number of scripts to run at once. Defaults to the
+            number of available CPU cores divided by cpus_per_job.
+        cpus_per_job (int): If set, each slot is pinned to its own set of
+            this many CPU cores.
+        gpu_ids (list): If set, slot i is given the GPU gpu_ids[i % len(gpu_ids)].
+    """
+    def __init__(self, num_slots=None, cpus_per_job=None, gpu_ids=None, **kwargs):
+        if gpu_ids:
+            kwargs.setdefault('use_gpu', True)
+        super(LocalPoolMode, self).__init__(**kwargs)
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(multiprocessing.cpu_count()))
+        if num_slots is None:
+            num_slots = max(1, len(cpus) // (cpus_per_job or 1))
+        if cpus_per_job and num_slots * cpus_per_job > len(cpus):
+            raise ValueError('Cannot pin %d slots to %d cores each with %d cores available.' %
+                             (num_slots, cpus_per_job, len(cpus)))
+        self.num_slots = num_slots
+        self.cpus_per_job = cpus_per_job
+        self.gpu_ids = gpu_ids
+        self._cpus = cpus
+        self._slots = queue.Queue()
+        for slot in range(num_slots):
+            self._slots.put(slot)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_slots)
+
+    def __str__(self):
+        return 'LocalPoolMode-%d' % self.num_slots
+
+    def slot_cpus(self, slot):
+        if not self.cpus_per_job:
+            return None
+        return self._cpus[slot * self.cpus_per_job:(slot + 1) * self.cpus_per_job]
+
+    def slot_gpu(self, slot):
+        if not self.gpu_ids:
+            return None
+        return self.gpu_ids[slot % len(self.gpu_ids)]
+
+    def _get_slot_command(self, run_cmd, slot):
+        """
+        Returns the command and environment variables for running in a slot.
+        """
+        env = dict(os.environ)
+        cpus = self.slot_cpus(slot)
+        if cpus is not None:
+            cpu_list = ','.join([str(cpu) for cpu in cpus])
+            env['DAR_DOCKER_FLAGS'] = '--cpuset-cpus=%s' % cpu_list
+            if shutil.which('taskset'):
+                run_cmd = 'taskset -c %s %s' % (cpu_list, run_cmd)
+        gpu = self.slot_gpu(slot)
+        if gpu is not None:
+            env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+            env['DAR_DOCKER_GPUS'] = 'device=%s' % gpu
+        return run_cmd, env
+
+    def _run_in_slot(self, run_cmd, return_output=False, dry=False, verbose=False, job_id=None):
+        slot = self._slots.get()
+        try:
+            run_cmd, env = self._get_slot_command(run_cmd, slot)
+            if dry or verbose:
+                print('Slot %d executing command: %s' % (slot, run_cmd))
+            if dry:
+                return JobResult(0, None)
+            job_registry.update_job(job_id, status=job_registry.STATUS_RUNNING)
+            p = subprocess.Popen(run_cmd, shell=True, env=env,
+                                 stdout=subprocess.PIPE if return_output else None)
+            output, _ = p.communicate()
+            self._record_exit(job_id, p.returncode)
+            if output is not None:
+                output = output.decode('utf-8')
+            return JobResult(p.returncode, output)
+        finally:
+            self._slots.put(slot)
+
+    def submit(self, script_filename, dry=False, return_output=False, verbose=False):
+        """
+        Queues a shell script to run in the next free slot.
+
+        Returns:
+            Future: A future whose result is a JobResult(returncode, output).
+                output is None unless return_output is True.
+        """
+        run_cmd = self._get_run_command(script_filename)
+        job_id = None
+        if not dry:
+            # queued jobs are recorded as submitted until they get a slot
+            job_id = self._record_job(script_filename, job_registry.STATUS_SUBMITTED)
+        return self._executor.submit(self._run_in_slot, run_cmd,
+                                     return_output=return_output, dry=dry, verbose=verbose,
+                                     job_id=job_id)
+
+    def run_script(self, script_filename, dry=False, return_output=False, verbose=False):
+        """
+        Runs a shell script in the next free slot and waits for it to finish.
+        If async_run is True, returns the Future from submit instead.
+        """
+        future = self.submit(script_filename, dry=dry, return_output=return_output, verbose=verbose)
+        if self.async_run:
+            return future
+        result = future.result()
+        if return_output:
+            return result.output
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
 class SSHMode(LaunchMode):
-    def __init__(self, ssh_credentials, **kwargs):
+    """
+    Runs scripts on a remote host over SSH.
+
+    Args:
+        ssh_credentials (SSHCredentials): Host to run scripts on.
+        multiplex (bool): If True, all jobs share one persistent SSH
+            connection instead of opening three connections per job.
+        remote_cache_dir (str): If set, archives are uploaded once to this
+            directory on the host and run from there with each job's
+            arguments, instead of being copied for every job.
+            See ssh_util.RemoteArchiveCache.
+        max_cached_archives (int): Number of archives kept in remote_cache_dir.
+        detach (bool): If True, run_script starts each script in the
+            background on the host and returns a RemoteJob immediately.
+            Output and exit codes are kept in remote_job_dir, and can be
+            checked with job_statuses, tail_log and stream_log.
+        remote_job_dir (str): Directory on the host for detached jobs.
+    """
+    def __init__(self, ssh_credentials, multiplex=False, remote_cache_dir=None,
+                 max_cached_archives=10, detach=False, remote_job_dir=ssh_util.DEFAULT_REMOTE_JOB_DIR,
+                 **kwargs):
         super(SSHMode, self).__init__(**kwargs)
+        if multiplex and not ssh_credentials.control_path:
+            ssh_credentials = copy.copy(ssh_credentials)
+            ssh_credentials.control_path = ssh.DEFAULT_CONTROL_PATH
         self.ssh_cred = ssh_credentials
+        self.archive_cache = None
+        if remote_cache_dir:
+            self.archive_cache = ssh_util.RemoteArchiveCache(remote_cache_dir,
+                                                             max_entries=max_cached_archives)
+        self.detach = detach
+        self.remote_job_dir = remote_job_dir.rstrip('/')
+
+    def __str__(self):
+        return 'SSH-%s' % self.ssh_cred.user_host
+
+    def close(self):
+        """
+        Closes the persistent connection of a multiplexed SSHMode.
+        """
+        if self.ssh_cred.control_path:
+            shell.call(self.ssh_cred.get_close_master_cmd(), shell=True)
+
+    def run_script(self, script_filename, dry=False, return_output=False, verbose=False):
+        if self.detach:
+            if return_output:
+                raise ValueError('Cannot return output for detached SSH scripts. Use tail_log.')
+            return self._run_detached(script_filename, dry=dry, verbose=verbose)
+        if self.archive_cache is not None:
+            self.archive_cache.upload(self.ssh_cred, shlex.split(script_filename)[0], dry=dry)
+        return super(SSHMode, self).run_script(script_filename, dry=dry, return_output=return_output,
+                                               verbose=verbose)
 
     def _get_run_command(self, script_filename):
+        if self.archive_cache is not None:
+            cmd_split = shlex.split(script_filename)
+            remote_script = self.archive_cache.remote_path(cmd_split[0], missing_ok=True)
+            return self.ssh_cred.get_ssh_run_cmd(remote_script, args=cmd_split[1:],
+                                                 shell_interpreter=self.shell_interpreter)
         return self.ssh_cred.get_ssh_script_cmd(script_filename,
                                                 shell_interpreter=self.shell_interpreter)
 
+    def _run_detached(self, script_filename, dry=False, verbose=False):
+        """
+        Returns:
+            RemoteJob: A handle to the started job
+        """
+        job_dir = '%s/%s' % (self.remote_job_dir, uuid.uuid4().hex[:12])
+        cmd_split = shlex.split(script_filename)
+        setup = 'mkdir -p %s' % job_dir
+        remove_files = ()
+        if self.archive_cache is not None:
+            remote_script = self.archive_cache.upload(self.ssh_cred, cmd_split[0], dry=dry)
+        else:
+            # copied next to the job's log and deleted once the job exits
+            remote_script = job_dir + '/script.sh'
+            remove_files = (remote_script,)
+            tmp_script = './tmp_script_%s.sh' % os.path.basename(job_dir)
+            scp_cmd = self.ssh_cred.get_scp_cmd(cmd_split[0], tmp_script, src_remote=False, recursive=False)
+            if shell.call(scp_cmd, shell=True, dry=dry, verbose=verbose):
+                raise IOError('Could not copy %s to %s' % (cmd_split[0], self.ssh_cred.user_host))
+            setup += ' && mv %s %s' % (tmp_script, remote_script)
+        run_cmd = '%s %s %s' % (self.shell_interpreter, remote_script,
+                                ' '.join([shlex.quote(arg) for arg in cmd_split[1:]]))
+        cmd = self.ssh_cred.get_ssh_cmd('%s && %s' % (
+            setup, ssh_util.detached_job_cmd(job_dir, run_cmd, remove_files=remove_files)))
+        if shell.call(cmd, shell=True, dry=dry, verbose=verbose):
+            raise IOError('Could not start %s on %s' % (script_filename, self.ssh_cred.user_host))
+        job_id = None
+        if not dry:
+            job_id = self._record_job(script_filename, job_registry.STATUS_SUBMITTED,
+                                      instance_id='%s:%s' % (self.ssh_cred.user_host, job_dir))
+        return RemoteJob(job_id, job_dir)
+
+    def registry_jobs(self, sweep_id=None):
+        """
+        Returns the detached jobs of this host in the job registry which
+        have not finished, e.g. to monitor jobs launched by another process.
+
+        Returns:
+            list: RemoteJobs
+        """
+        registry = job_registry.get_registry()
+        if registry is None:
+            return []
+        jobs = []
+        for status in [job_registry.STATUS_SUBMITTED, job_registry.STATUS_RUNNING]:
+            for job in registry.query(sweep_id=sweep_id, status=status, mode=str(self)):
+                user_host, _, job_dir = (job['instance_id'] or '').partition(':')
+                if job_dir:
+                    jobs.append(RemoteJob(job['job_id'], job_dir))
+        return jobs
+
+    def job_statuses(self, jobs):
+        """
+        Checks the status of many detached jobs with one SSH command, and
+        updates them in the job registry.
+
+        Returns:
+            list: The job_registry status of each job
+        """
+        if not jobs:
+            return []
+        output, returncode = shell.call_and_get_output(
+            self.ssh_cred.get_ssh_cmd(ssh_util.job_status_cmd([job.job_dir for job in jobs])),
+            shell=True, return_code=True)
+        if returncode != 0:
+            raise IOError('Could not check jobs on %s' % self.ssh_cred.user_host)
+        remote_statuses = ssh_util.parse_job_statuses(output.decode('utf-8'))
+        statuses = []
+        for job in jobs:
+            state, exit_code = remote_statuses[job.job_dir]
+            if state == ssh_util.JOB_EXITED:
+                status = job_registry.STATUS_SUCCEEDED if exit_code == 0 else job_registry.STATUS_FAILED
+            elif state == ssh_util.JOB_LOST:
+                status = job_registry.STATUS_FAILED
+            else:
+                status = job_registry.STATUS_RUNNING
+            job_registry.update_job(job.job_id, status=status, exit_code=exit_code)
+            statuses.append(status)
+        return statuses
+
+    def tail_log(self, job, lines=20):
+        """
+        Returns:
+            str: The last lines of the output of a detached job
+        """
+        output = shell.call_and_get_output(
+            self.ssh_cred.get_ssh_cmd('tail -n %d %s/log' % (lines, job.job_dir)), shell=True)
+        return output.decode('utf-8')
+
+    def stream_log(self, job):
+        """
+        Prints the output of a detached job until it finishes.
+        """
+        return shell.call(self.ssh_cred.get_ssh_cmd(ssh_util.stream_log_cmd(job.job_dir)), shell=True)
+
+    def kill_job(self, job):
+        return shell.call(self.ssh_cred.get_ssh_cmd(ssh_util.kill_job_cmd(job.job_dir)), shell=True)
+
+    def clean_jobs(self):
+        """
+        Deletes the directories of all finished detached jobs on the host,
+        after recording the exit codes of jobs in the job registry.
+        """
+        self.job_statuses(self.registry_jobs())
+        return shell.call(self.ssh_cred.get_ssh_cmd(
+            ssh_util.clean_jobs_cmd([self.remote_job_dir + '/*'])), shell=True)
+
+
+# a detached job started by SSHMode, with its id in the job registry
+RemoteJob = collections.namedtuple('RemoteJob', ['job_id', 'job_dir'])
+
+
+HostStatus = collections.namedtuple('HostStatus', ['load', 'num_cpus', 'free_mem_mb', 'free_gpus', 'num_gpus'],
+                                    defaults=(None,))
+
+# prints the load average, cpu count, available memory and gpu usage of a host
+HOST_PROBE_CMD = ('cat /proc/loadavg; nproc; free -m | awk "/^Mem:/ {print \\$7}"; '
+                  'nvidia-smi --query-gpu=index,memory.used,utilization.gpu '
+                  '--format=csv,noheader,nounits 2> /dev/null || true')
+
+
+def parse_host_probe(output, max_gpu_mem_mb=500, max_gpu_util=10):
+    """
+    Parses the output of HOST_PROBE_CMD. A GPU is free if its memory and
+    utilization are below the given thresholds.
+
+    Returns:
+        HostStatus
+    """
+    lines = [line.strip() for line in output.strip().splitlines()]
+    free_gpus = []
+    num_gpus = 0
+    for line in lines[3:]:
+        try:
+            index, mem_used, util = [field.strip() for field in line.split(',')]
+            index, mem_used, util = int(index), float(mem_used), float(util)
+        except ValueError:
+            # e.g. an error message of nvidia-smi on a host with a broken driver
+            continue
+        num_gpus += 1
+        if mem_used < max_gpu_mem_mb and util < max_gpu_util:
+            free_gpus.append(index)
+    return HostStatus(load=float(lines[0].split()[0]), num_cpus=int(lines[1]),
+                      free_mem_mb=int(lines[2]), free_gpus=free_gpus, num_gpus=num_gpus)
+
+
+class SSHClusterMode(LaunchMode):
+    """
+    Runs scripts on a pool of hosts over SSH, placing each script on the
+    least loaded host.
+
+    Hosts are probed for their load average, available memory and free GPUs
+    at most every probe_interval seconds. Scripts launched by this mode are
+    counted against the load of their host until they finish, so concurrent
+    launches (e.g. from a sweep with several workers) spread across the pool.
+
+    Args:
+        ssh_credentials (list): SSHCredentials of each host.
+        gpus_per_job (int): Number of free GPUs given to each script, through
+            CUDA_VISIBLE_DEVICES and DAR_DOCKER_GPUS.
+        min_free_mem_mb (int): Hosts with less available memory are skipped.
+        max_jobs_per_host (int): If set, at most this many scripts run on
+            a host at once.
+        probe_interval (int): Seconds before host statuses are probed again.
+        multiplex (bool): If True, the jobs and probes of each host share a
+            persistent SSH connection.
+        wait_interval (int): Seconds to wait before retrying when no host
+            can take a script.
+        wait_timeout (int): If set, run_script raises a TimeoutError when no
+            host could take a script for this many seconds.
+        remote_cache_dir (str): If set, archives are uploaded once to this
+            directory on each host, as in SSHMode.
+        max_cached_archives (int): Number of archives kept in remote_cache_dir.
+    """
+    def __init__(self, ssh_credentials, gpus_per_job=0, min_free_mem_mb=0, max_jobs_per_host=None,
+                 probe_interval=30, multiplex=True, wait_interval=10, wait_timeout=None,
+                 remote_cache_dir=None, max_cached_archives=10, **kwargs):
+        if gpus_per_job:
+            kwargs.setdefault('use_gpu', True)
+        super(SSHClusterMode, self).__init__(**kwargs)
+        self.hosts = []
+        for credentials in ssh_credentials:
+            if multiplex and not credentials.control_path:
+                credentials = copy.copy(credentials)
+                credentials.control_path = ssh.DEFAULT_CONTROL_PATH
+            self.hosts.append(credentials)
+        self.gpus_per_job = gpus_per_job
+        self.min_free_mem_mb = min_free_mem_mb
+        self.max_jobs_per_host = max_jobs_per_host
+        self.probe_interval = probe_interval
+        self.wait_interval = wait_interval
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._statuses = {}
+        self._last_probe = None
+        # scripts and GPUs of this mode currently running on each host
+        self._running = collections.Counter()
+        self._used_gpus = collections.defaultdict(set)
+        self._local = threading.local()
+        self.archive_cache = None
+        if remote_cache_dir:
+            self.archive_cache = ssh_util.RemoteArchiveCache(remote_cache_dir,
+                                                             max_entries=max_cached_archives)
+
+    def __str__(self):
+        return 'SSHCluster-%d' % len(self.hosts)
+
+    def probe_host(self, host):
+        """
+        Returns:
+            HostStatus: The status of a host, or None if it could not be probed.
+        """
+        output, returncode = shell.call_and_get_output(host.get_ssh_bash_cmd(HOST_PROBE_CMD),
+                                                       shell=True, return_code=True)
+        try:
+            if returncode != 0:
+                raise ValueError('ssh exited with %d' % returncode)
+            return parse_host_probe(output.decode('utf-8'))
+        except (ValueError, IndexError) as e:
+            print('Could not probe %s: %s' % (host.user_host, e))
+            return None
+
+    def probe_hosts(self):
+        """
+        Probes all hosts in parallel.
+
+        Returns:
+            dict: A map from the user@host of each host to its HostStatus,
+                or None if the host could not be probed.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.hosts)) as executor:
+            statuses = list(executor.map(self.probe_host, self.hosts))
+        return {host.user_host: status for host, status in zip(self.hosts, statuses)}
+
+    def _place(self, dry=False):
+        """
+        Returns the least loaded host which can take a script and the GPUs
+        to give it, or (None, None) if no host can.
+        """
+        now = time.time()
+        if dry:
+            statuses = {host.user_host: None for host in self.hosts}
+        else:
+            if self._last_probe is None or now - self._last_probe > self.probe_interval:
+                self._statuses = self.probe_hosts()
+                self._last_probe = now
+            statuses = self._statuses
+        best = None
+        for host in self.hosts:
+            name = host.user_host
+            status = statuses.get(name)
+            if status is None and not dry:
+                continue
+            running = self._running[name]
+            if self.max_jobs_per_host is not None and running >= self.max_jobs_per_host:
+                continue
+            if dry:
+                score, gpus = running, []
+            else:
+                if status.free_mem_mb < self.min_free_mem_mb:
+                    continue
+                gpus = [gpu for gpu in status.free_gpus if gpu not in self._used_gpus[name]]
+                if len(gpus) < self.gpus_per_job:
+                    continue
+                # the load average lags behind recently started scripts
+                score = (status.load + running) / status.num_cpus
+            if best is None or score < best[0]:
+                best = (score, host, gpus[:self.gpus_per_job])
+        if best is None:
+            return None, None
+        return best[1], best[2]
+
+    def _check_placeable(self):
+        """
+        Raises an error if no host could take a script by waiting.
+        """
+        reachable = [status for status in self._statuses.values() if status is not None]
+        if not reachable:
+            raise IOError('Could not probe any host of %s' % [host.user_host for host in self.hosts])
+        if all([status.num_gpus is not None and status.num_gpus < self.gpus_per_job
+                for status in reachable]):
+            raise ValueError('No reachable host has %d GPUs' % self.gpus_per_job)
+
+    def _acquire(self, dry=False):
+        start = time.time()
+        while True:
+            with self._lock:
+                host, gpus = self._place(dry=dry)
+                if host is not None:
+                    self._running[host.user_host] += 1
+                    self._used_gpus[host.user_host].update(gpus)
+                    return host, gpus
+                if not dry:
+                    self._check_placeable()
+                # probe again on the next attempt
+                self._last_probe = None
+            if self.wait_timeout is not None and time.time() - start >= self.wait_timeout:
+                raise TimeoutError('No host could take a script within %d seconds' % self.wait_timeout)
+            print('No host is free, waiting %d seconds.' % self.wait_interval)
+            time.sleep(self.wait_interval)
+
+    def _release(self, host, gpus):
+        with self._lock:
+            self._running[host.user_host] -= 1
+            self._used_gpus[host.user_host].difference_update(gpus)
+
+    def running_jobs(self):
+        """
+        Returns:
+            dict: The number of scripts of this mode running on each host.
+        """
+        with self._lock:
+            return {host.user_host: self._running[host.user_host] for host in self.hosts}
+
+    def run_script(self, script_filename, dry=False, return_output=False, verbose=False):
+        host, gpus = self._acquire(dry=dry)
+        self._local.placement = (host, gpus)
+        try:
+            if dry or verbose:
+                print('Placing script on %s with GPUs %s' % (host.user_host, gpus))
+            if self.archive_cache is not None:
+                self.archive_cache.upload(host, shlex.split(script_filename)[0], dry=dry)
+            return super(SSHClusterMode, self).run_script(script_filename, dry=dry,
+                                                          return_output=return_output,
+                                                          verbose=verbose)
+        finally:
+            self._local.placement = None
+            self._release(host, gpus)
+
+    def _get_run_command(self, script_filename):
+        host, gpus = self._local.placement
+        env = {}
+        if gpus:
+            gpu_list = ','.join([str(gpu) for gpu in gpus])
+            env['CUDA_VISIBLE_DEVICES'] = gpu_list
+            env['DAR_DOCKER_GPUS'] = '\\"device=%s\\"' % gpu_list
+        if self.archive_cache is not None:
+            cmd_split = shlex.split(script_filename)
+            remote_script = self.archive_cache.remote_path(cmd_split[0], missing_ok=True)
+            return host.get_ssh_run_cmd(remote_script, args=cmd_split[1:],
+                                        shell_interpreter=self.shell_interpreter, env=env)
+        # scripts running at the same time on a host need their own copy
+        remote_script = './tmp_script_%s.sh' % uuid.uuid4().hex[:12]
+        return host.get_ssh_script_cmd(script_filename, shell_interpreter=self.shell_interpreter,
+                                       remote_script=remote_script, env=env)
+
+    def _record_job(self, script_filename, status, instance_id=None, context=None):
+        placement = getattr(self._local, 'placement', None)
+        if instance_id is None and placement is not None:
+            instance_id = placement[0].user_host
+        return super(SSHClusterMode, self)._record_job(script_filename, status,
+                                                       instance_id=instance_id, context=context)
+
 
 class EC2Mode(LaunchMode):
+    batch_launch = True
+    # EC2 limits the size of user data
+    MAX_USER_DATA_SIZE = 16 * 1024
+    # where MountS3 writes sync manifests on the instance
+    SYNC_MANIFEST_DIR = '/tmp/doodad_sync'
+    # seconds between checks for mounts which are due for a sync
+    SYNC_TICK = 5
+
     def __init__(self,
                  ec2_credentials,
                  s3_bucket,
@@ -100,7 +698,10 @@ class EC2Mode(LaunchMode):
                  aws_key_name=None,
                  iam_instance_profile_name='doodad',
                  swap_size=4096,
+                 swap_type='file',
                  tag_exp_name='doodad_experiment',
+                 launch_batch_size=100,
+                 prepared_image=False,
                  **kwargs):
         super(EC2Mode, self).__init__(**kwargs)
         self.credentials = ec2_credentials
@@ -120,18 +721,22 @@ class EC2Mode(LaunchMode):
         self.iam_instance_profile_name = iam_instance_profile_name
         self.security_groups = security_groups
         self.security_group_ids = security_group_ids
+        # swap_size=0 disables swap. See image_builder.swap_commands for swap types.
         self.swap_size = swap_size
+        if swap_type not in image_builder.SWAP_TYPES:
+            raise ValueError('Unknown swap type %s. Must be one of %s' % (swap_type, image_builder.SWAP_TYPES))
+        self.swap_type = swap_type
         self.sync_interval = 60
+        self.launch_batch_size = launch_batch_size
+        # ami_name was built by apis/ec2/image_builder.py
+        self.prepared_image = prepared_image
 
     def dedent(self, s):
         lines = [l.strip() for l in s.split('\n')]
         return '\n'.join(lines)
 
-    def run_script(self, script_name, dry=False, return_output=False, verbose=False):
-        if return_output:
-            raise ValueError("Cannot return output for AWS scripts.")
-
-        default_config = dict(
+    def _aws_config(self):
+        return dict(
             image_id=self.image_id,
             instance_type=self.instance_type,
             key_name=self.aws_key_name,
@@ -141,9 +746,41 @@ class EC2Mode(LaunchMode):
             security_group_ids=self.security_group_ids,
             network_interfaces=[],
         )
-        aws_config = dict(default_config)
-        time_key = gcp_util.make_timekey()
 
+    def _ec2_client(self):
+        return boto3.client(
+            "ec2",
+            region_name=self.region,
+            aws_access_key_id=self.credentials.aws_key,
+            aws_secret_access_key=self.credentials.aws_secret_key,
+        )
+
+    def _upload_script(self, script_name, dry=False):
+        """
+        Uploads the script run by a command to S3.
+
+        Returns:
+            tuple: (S3 path of the script, command line arguments of the script)
+        """
+        cmd_split = shlex.split(script_name)
+        script_fname = cmd_split[0]
+        if len(cmd_split) > 1:
+            script_args = ' '.join(cmd_split[1:])
+        else:
+            script_args = ''
+        # identical scripts are only uploaded once
+        script_s3_path = aws_util.s3_upload_by_hash(script_fname, self.s3_bucket, 'doodad/mount', dry=dry)
+        script_s3_filename = 's3://{bucket_name}/{script_s3_path}'.format(
+            bucket_name=self.s3_bucket,
+            script_s3_path=script_s3_path
+        )
+        return script_s3_filename, script_args
+
+    def _make_user_data(self, script_s3_filename, run_command):
+        """
+        Returns the startup script of an instance, which downloads
+        the script at script_s3_filename and runs run_command.
+        """
         s3_base_dir = os.path.join('s3://'+self.s3_bucket, self.s3_log_path)
         s3_log_dir = os.path.join(s3_base_dir, 'outputs')
         stdout_log_s3_path = os.path.join(s3_base_dir, 'stdout_$EC2_INSTANCE_ID.log')
@@ -164,35 +801,20 @@ class EC2Mode(LaunchMode):
             swap_location = '/mnt/swapfile'
         else:
             swap_location = '/var/swap.1'
-        sio.write(
-            'sudo dd if=/dev/zero of={swap_location} bs=1M count={swap_size}\n'
-            .format(swap_location=swap_location, swap_size=self.swap_size))
-        sio.write('sudo mkswap {swap_location}\n'.format(swap_location=swap_location))
-        sio.write('sudo chmod 600 {swap_location}\n'.format(swap_location=swap_location))
-        sio.write('sudo swapon {swap_location}\n'.format(swap_location=swap_location))
-
-        sio.write("service docker start\n")
-        #sio.write("docker --config /home/ubuntu/.docker pull {docker_image}\n".format(docker_image=self.docker_image))
-        sio.write("export AWS_DEFAULT_REGION={aws_region}\n".format(aws_region=self.s3_bucket))
-        sio.write("""
-            curl "https://s3.amazonaws.com/aws-cli/awscli-bundle.zip" -o "awscli-bundle.zip"
-            unzip awscli-bundle.zip
-            sudo ./awscli-bundle/install -i /usr/local/aws -b /usr/local/bin/aws
-        """)
-
-        # 1) Upload script and download it to remote
-        cmd_split = shlex.split(script_name)
-        script_fname = cmd_split[0]
-        script_split = os.path.split(script_fname)[-1]
-        if len(cmd_split) > 1:
-            script_args = ' '.join(cmd_split[1:])
+        if self.prepared_image:
+            # swap, docker and the aws cli are set up by image_builder
+            sio.write(image_builder.make_check_script(swap_location, self.swap_size,
+                                                      swap_type=self.swap_type))
+            sio.write("export AWS_DEFAULT_REGION={aws_region}\n".format(aws_region=self.region))
         else:
-            script_args = ''
-        aws_util.s3_upload(script_fname, self.s3_bucket, os.path.join('doodad/mount', script_split), dry=dry)
-        script_s3_filename = 's3://{bucket_name}/doodad/mount/{script_name}'.format(
-            bucket_name=self.s3_bucket,
-            script_name=script_split
-        )
+            sio.write(image_builder.swap_commands(swap_location, self.swap_size,
+                                                  swap_type=self.swap_type))
+            sio.write("service docker start\n")
+            #sio.write("docker --config /home/ubuntu/.docker pull {docker_image}\n".format(docker_image=self.docker_image))
+            sio.write("export AWS_DEFAULT_REGION={aws_region}\n".format(aws_region=self.region))
+            sio.write(image_builder.AWS_CLI_INSTALL)
+
+        # 1) Download script
         sio.write('aws s3 cp --region {region} {script_s3_filename} /tmp/remote_script.sh\n'.format(
             region=self.region,
             script_s3_filename=script_s3_filename
@@ -209,20 +831,38 @@ class EC2Mode(LaunchMode):
         ec2_local_dir = '/doodad'
 
         # Sync interval
-        # aws s3 sync --exclude '*' {include_string} {log_dir} {s3_path}
+        # Each MountS3 in the archive writes a manifest with its directory,
+        # sync interval and include filters (see MountS3.dar_host_command).
+        # aws s3 sync only uploads files which changed since the last sync.
+        # Without manifests, all of ec2_local_dir is synced.
         sio.write("""
+        export DOODAD_SYNC_MANIFEST_DIR={manifest_dir}
+        mkdir -p $DOODAD_SYNC_MANIFEST_DIR
+        doodad_sync() {{
+            now=$(date +%s)
+            manifests=$(ls $DOODAD_SYNC_MANIFEST_DIR/*.conf 2> /dev/null)
+            for manifest in ${{manifests:-$DOODAD_SYNC_MANIFEST_DIR/default}}; do
+                SYNC_DIR={log_dir}; SYNC_INTERVAL={periodic_sync_interval}; SYNC_ARGS=()
+                [ -f $manifest ] && . $manifest
+                # pass 1 to sync every mount regardless of its interval
+                if [ "$1" = "1" ] || [ $now -ge $(cat $manifest.due 2> /dev/null || echo 0) ]; then
+                    mkdir -p $SYNC_DIR
+                    aws s3 sync --region {region} --no-progress "${{SYNC_ARGS[@]}}" $SYNC_DIR {s3_path}${{SYNC_DIR#{log_dir}}}
+                    echo $((now + SYNC_INTERVAL)) > $manifest.due
+                fi
+            done
+        }}
         while /bin/true; do
-            aws s3 cp --recursive --region {region} {log_dir} {s3_path}
-            sleep {periodic_sync_interval}
+            doodad_sync
+            sleep {tick}
         done & echo sync initiated
         """.format(
-            #include_string='',
+            manifest_dir=self.SYNC_MANIFEST_DIR,
             s3_path=s3_log_dir,
-            #periodic_sync_interval=self.sync_interval
             log_dir=ec2_local_dir,
             region=self.region,
-            #s3_path=stdout_log_s3_path,
-            periodic_sync_interval=self.sync_interval
+            periodic_sync_interval=self.sync_interval,
+            tick=self.SYNC_TICK,
         ))
 
         # Sync on terminate. This catches the case where the spot
@@ -236,7 +876,7 @@ class EC2Mode(LaunchMode):
                 if [ -z $(curl -Is http://169.254.169.254/latest/meta-data/spot/termination-time | head -1 | grep 404 | cut -d \  -f 2) ]
                 then
                     logger "Running shutdown hook."
-                    aws s3 cp --region {region} --recursive {log_dir} {s3_path}
+                    doodad_sync 1
                     aws s3 cp --region {region} /tmp/user_data.log {stdout_log_s3_path}
                     break
                 else
@@ -249,8 +889,6 @@ class EC2Mode(LaunchMode):
             done & echo log sync initiated
         """.format(
             region=self.region,
-            log_dir=ec2_local_dir,
-            s3_path=s3_log_dir,
             stdout_log_s3_path=stdout_log_s3_path,
         ))
 
@@ -275,18 +913,13 @@ class EC2Mode(LaunchMode):
             sio.write("echo 'Testing nvidia-smi inside docker'\n")
             sio.write("nvidia-docker run --rm {docker_image} nvidia-smi\n".format(docker_image=self.docker_image))
 
-        docker_cmd = '%s /tmp/remote_script.sh %s' % (self.shell_interpreter, script_args)
-        sio.write(docker_cmd+'\n')
+        sio.write(run_command+'\n')
 
         # Sync all output mounts to s3 after running the user script
         # Ideally the earlier while loop would be sufficient, but it might be
         # the case that the earlier while loop isn't fast enough to catch a
         # termination. So, we explicitly sync on termination.
-        sio.write("aws s3 cp --region {region} --recursive {local_dir} {s3_dir}\n".format(
-            region=self.region,
-            local_dir=ec2_local_dir,
-            s3_dir=s3_log_dir
-        ))
+        sio.write("doodad_sync 1\n")
         sio.write("aws s3 cp --region {region} /tmp/user_data.log {s3_dir}\n".format(
             region=self.region,
             s3_dir=stdout_log_s3_path,
@@ -299,15 +932,10 @@ class EC2Mode(LaunchMode):
             """.format(aws_region=self.region))
         sio.write("} >> /tmp/user_data.log 2>&1\n")
 
-        full_script = self.dedent(sio.getvalue())
-        ec2 = boto3.client(
-            "ec2",
-            region_name=self.region,
-            aws_access_key_id=self.credentials.aws_key,
-            aws_secret_access_key=self.credentials.aws_secret_key,
-        )
+        return self.dedent(sio.getvalue())
 
-        user_data = full_script
+    def _instance_args(self, user_data, verbose=False, encode_user_data=True):
+        aws_config = self._aws_config()
         instance_args = dict(
             ImageId=aws_config["image_id"],
             KeyName=aws_config["key_name"],
@@ -327,35 +955,140 @@ class EC2Mode(LaunchMode):
             print("************************************************************")
             print('UserData:', instance_args["UserData"])
             print("************************************************************")
-        instance_args["UserData"] = base64.b64encode(instance_args["UserData"].encode()).decode("utf-8")
+        if encode_user_data:
+            instance_args["UserData"] = base64.b64encode(instance_args["UserData"].encode()).decode("utf-8")
+        return instance_args
+
+    def _tag_specifications(self, resource_types):
+        return [{'ResourceType': resource_type,
+                 'Tags': [{'Key': 'Name', 'Value': self.tag_exp_name}]}
+                for resource_type in resource_types]
+
+    def run_script(self, script_name, dry=False, return_output=False, verbose=False):
+        if return_output:
+            raise ValueError("Cannot return output for AWS scripts.")
+
+        script_s3_filename, script_args = self._upload_script(script_name, dry=dry)
+        run_command = '%s /tmp/remote_script.sh %s' % (self.shell_interpreter, script_args)
+        user_data = self._make_user_data(script_s3_filename, run_command)
+        instance_args = self._instance_args(user_data, verbose=verbose)
         spot_args = dict(
             DryRun=dry,
             InstanceCount=1,
             LaunchSpecification=instance_args,
-            SpotPrice=str(aws_config["spot_price"]),
+            SpotPrice=str(self._aws_config()["spot_price"]),
+            TagSpecifications=self._tag_specifications(['spot-instances-request']),
             # ClientToken=params_list[0]["exp_name"],
         )
 
         if verbose:
             pprint.pprint(spot_args)
         if not dry:
-            response = ec2.request_spot_instances(**spot_args)
+            ec2 = self._ec2_client()
+            response = aws_util.call_with_backoff(ec2.request_spot_instances, **spot_args)
             print('Launched EC2 job - Server response:')
             pprint.pprint(response)
             print('*****'*5)
             spot_request_id = response['SpotInstanceRequests'][
                 0]['SpotInstanceRequestId']
-            for _ in range(10):
-                try:
-                    ec2.create_tags(
-                        Resources=[spot_request_id],
-                        Tags=[
-                            {'Key': 'Name', 'Value': self.tag_exp_name}
-                        ],
-                    )
-                    break
-                except botocore.exceptions.ClientError:
-                    continue
+            self._record_job(script_name, job_registry.STATUS_SUBMITTED, instance_id=spot_request_id)
+
+
+    def run_scripts(self, script_names, dry=False, verbose=False, configs=None):
+        """
+        Launches many scripts as spot instances, using one run_instances
+        request for each batch of up to launch_batch_size scripts.
+
+        Scripts which run the same archive share a launch specification.
+        Each instance in a batch selects its command line arguments by its
+        ami-launch-index.
+        """
+        context = job_registry.current_context()
+        groups = collections.OrderedDict()
+        for idx, script_name in enumerate(script_names):
+            cmd_split = shlex.split(script_name)
+            groups.setdefault(cmd_split[0], []).append((idx, ' '.join(cmd_split[1:])))
+
+        if not dry:
+            # checks which archives exist in one listing and uploads the rest concurrently
+            aws_util.s3_upload_many_by_hash(list(groups.keys()), self.s3_bucket, 'doodad/mount')
+        for script_fname, jobs in groups.items():
+            script_s3_filename, _ = self._upload_script(script_fname, dry=dry)
+            base_size = len(self._make_user_data(script_s3_filename, self._batch_run_command([])))
+            batch = []
+            batch_size = base_size
+            for idx, script_args in jobs:
+                job_size = len(self._batch_case(len(batch), script_args))
+                if batch and (len(batch) >= self.launch_batch_size or
+                              batch_size + job_size > self.MAX_USER_DATA_SIZE):
+                    self._launch_batch(script_s3_filename, batch, script_names, configs,
+                                       context, dry=dry, verbose=verbose)
+                    batch, batch_size = [], base_size
+                batch.append((idx, script_args))
+                batch_size += job_size
+            if batch:
+                self._launch_batch(script_s3_filename, batch, script_names, configs,
+                                   context, dry=dry, verbose=verbose)
+
+    def _batch_case(self, launch_index, script_args):
+        return '%d) DOODAD_SCRIPT_ARGS=%s;;\n' % (launch_index, shlex.quote(script_args))
+
+    def _batch_run_command(self, args_list):
+        lines = ['AMI_LAUNCH_INDEX="`wget -q -O - http://169.254.169.254/latest/meta-data/ami-launch-index`"',
+                 'case "$AMI_LAUNCH_INDEX" in']
+        lines.extend([self._batch_case(i, script_args).strip() for i, script_args in enumerate(args_list)])
+        lines.append('esac')
+        lines.append('eval "%s /tmp/remote_script.sh $DOODAD_SCRIPT_ARGS"' % self.shell_interpreter)
+        return '\n'.join(lines)
+
+    def _launch_batch(self, script_s3_filename, batch, script_names, configs, context,
+                      dry=False, verbose=False):
+        run_command = self._batch_run_command([script_args for _, script_args in batch])
+        user_data = self._make_user_data(script_s3_filename, run_command)
+        instance_args = self._instance_args(user_data, verbose=verbose, encode_user_data=False)
+        spot_options = {
+            'SpotInstanceType': 'one-time',
+            'InstanceInterruptionBehavior': 'terminate',
+        }
+        if self.spot_price:
+            spot_options['MaxPrice'] = str(self.spot_price)
+        run_args = dict(
+            DryRun=dry,
+            MinCount=len(batch),
+            MaxCount=len(batch),
+            InstanceMarketOptions={'MarketType': 'spot', 'SpotOptions': spot_options},
+            InstanceInitiatedShutdownBehavior='terminate',
+            TagSpecifications=self._tag_specifications(['instance', 'spot-instances-request']),
+        )
+        for key, value in instance_args.items():
+            if value not in (None, []):
+                run_args[key] = value
+        if verbose:
+            pprint.pprint(run_args)
+        if dry:
+            return
+        ec2 = self._ec2_client()
+        try:
+            response = aws_util.call_with_backoff(ec2.run_instances, **run_args)
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in ('InsufficientInstanceCapacity', 'MaxSpotInstanceCountExceeded') or len(batch) == 1:
+                raise
+            # launch index tables are rebuilt for each half
+            half = len(batch) // 2
+            print('Could not launch %d instances (%s), splitting batch.' % (len(batch), code))
+            self._launch_batch(script_s3_filename, batch[:half], script_names, configs, context,
+                               dry=dry, verbose=verbose)
+            self._launch_batch(script_s3_filename, batch[half:], script_names, configs, context,
+                               dry=dry, verbose=verbose)
+            return
+        print('Launched %d EC2 instances in reservation %s' % (len(batch), response.get('ReservationId')))
+        instances = {instance['AmiLaunchIndex']: instance['InstanceId'] for instance in response['Instances']}
+        for launch_index, (idx, _) in enumerate(batch):
+            config = configs[idx] if configs is not None else context['config']
+            self._record_job(script_names[idx], job_registry.STATUS_SUBMITTED,
+                             instance_id=instances.get(launch_index),
+                             context={'sweep_id': context['sweep_id'], 'config': config})
 
 
 class EC2Autoconfig(EC2Mode):
@@ -410,7 +1143,13 @@ class GCPMode(LaunchMode):
         instance_type (str): GCE instance type
         gpu_model (str): GCP GPU model. See https://cloud.google.com/compute/docs/gpus.
         data_sync_interval (int): Number of seconds before each sync on mounts.
+        launch_batch_size (int): Maximum number of instances created by one
+            batch request in run_scripts.
     """
+    batch_launch = True
+    # GCE accepts at most 1000 calls in a batch request
+    MAX_LAUNCH_BATCH_SIZE = 1000
+
     def __init__(self,
                  gcp_project,
                  gcp_bucket,
@@ -426,6 +1165,7 @@ class GCPMode(LaunchMode):
                  num_gpu=1,
                  gpu_model='nvidia-tesla-t4',
                  data_sync_interval=15,
+                 launch_batch_size=100,
                  **kwargs):
         super(GCPMode, self).__init__(**kwargs)
         self.gcp_project = gcp_project
@@ -440,23 +1180,85 @@ class GCPMode(LaunchMode):
         self.instance_type = instance_type
         self.gcp_label = gcp_label
         self.data_sync_interval = data_sync_interval
-        self.compute = googleapiclient.discovery.build('compute', 'v1', cache_discovery=False)
+        self.launch_batch_size = min(launch_batch_size, self.MAX_LAUNCH_BATCH_SIZE)
+        # the image and startup scripts are the same for every instance
+        self._source_disk_image = None
+        self._startup_scripts = None
+        # googleapiclient services are not thread-safe, so each thread
+        # submitting jobs gets its own
+        self._local = threading.local()
+        # built now, as before, so that credential errors surface here
+        self._local.compute = self._build_compute()
 
         if self.use_gpu:
             self.num_gpu = num_gpu
             self.gpu_model = gpu_model
             self.gpu_type = gcp_util.get_gpu_type(self.gcp_project, self.zone, self.gpu_model)
 
+    def _build_compute(self):
+        return googleapiclient.discovery.build('compute', 'v1', cache_discovery=False)
+
+    @property
+    def compute(self):
+        if not hasattr(self._local, 'compute'):
+            self._local.compute = self._build_compute()
+        return self._local.compute
+
     def __str__(self):
         return 'GCP-%s-%s' % (self.gcp_project, self.instance_type)
 
     def print_launch_message(self):
         print('Go to https://console.cloud.google.com/compute to monitor jobs.')
 
-    def run_script(self, script, dry=False, return_output=False, verbose=False):
-        if return_output:
-            raise ValueError("Cannot return output for GCP scripts.")
-
+    def run_scripts(self, script_filenames, dry=False, verbose=False, configs=None):
+        """
+        Launches many scripts, uploading the archives they run in one bulk
+        upload and creating up to launch_batch_size instances per batch
+        request.
+        """
+        archives = collections.OrderedDict.fromkeys([shlex.split(script)[0]
+                                                     for script in script_filenames])
+        gcp_util.upload_files_to_gcp_storage(self.gcp_bucket, list(archives), dry=dry)
+        context = job_registry.current_context()
+        for start in range(0, len(script_filenames), self.launch_batch_size):
+            batch = list(range(start, min(start + self.launch_batch_size, len(script_filenames))))
+            self._launch_batch(batch, script_filenames, configs, context, dry=dry, verbose=verbose)
+
+    def _launch_batch(self, batch, script_filenames, configs, context, dry=False, verbose=False):
+        jobs = {}
+        errors = []
+
+        def callback(request_id, response, exception):
+            idx, name = jobs[request_id]
+            config = configs[idx] if configs is not None else context['config']
+            job_context = {'sweep_id': context['sweep_id'], 'config': config}
+            if exception is not None:
+                errors.append(exception)
+                self._record_job(script_filenames[idx], job_registry.STATUS_FAILED,
+                                 instance_id=name, context=job_context)
+                return
+            self._record_job(script_filenames[idx], job_registry.STATUS_SUBMITTED,
+                             instance_id=name, context=job_context)
+            if verbose:
+                print('Launched instance %s' % name)
+                print(response)
+
+        batch_request = self.compute.new_batch_http_request(callback=callback)
+        for idx in batch:
+            metadata = self._make_metadata(script_filenames[idx], dry=dry)
+            name, exp_name = self._make_instance_name()
+            request = self._insert_request(metadata, name, exp_name, self.gcp_label, dry=dry)
+            request_id = str(idx)
+            jobs[request_id] = (idx, name)
+            batch_request.add(request, request_id=request_id)
+        if dry:
+            return
+        batch_request.execute()
+        print('Launched %d of %d GCE instances' % (len(batch) - len(errors), len(batch)))
+        if errors:
+            raise errors[0]
+
+    def _make_metadata(self, script, dry=False):
         # Upload script to GCS
         cmd_split = shlex.split(script)
         script_fname = cmd_split[0]
@@ -466,15 +1268,15 @@ class GCPMode(LaunchMode):
             script_args = ''
         remote_script = gcp_util.upload_file_to_gcp_storage(self.gcp_bucket, script_fname, dry=dry)
 
-        exp_name = "{}-{}".format(self.gcp_label, gcp_util.make_timekey())
-        exp_prefix = self.gcp_label
-
-        with open(gcp_util.GCP_STARTUP_SCRIPT_PATH) as f:
-            start_script = f.read()
-        with open(gcp_util.GCP_SHUTDOWN_SCRIPT_PATH) as f:
-            stop_script = f.read()
+        if self._startup_scripts is None:
+            with open(gcp_util.GCP_STARTUP_SCRIPT_PATH) as f:
+                start_script = f.read()
+            with open(gcp_util.GCP_SHUTDOWN_SCRIPT_PATH) as f:
+                stop_script = f.read()
+            self._startup_scripts = (start_script, stop_script)
+        start_script, stop_script = self._startup_scripts
 
-        metadata = {
+        return {
             'shell_interpreter': self.shell_interpreter,
             'gcp_bucket_path': self.gcp_log_path,
             'remote_script_path': remote_script,
@@ -486,24 +1288,49 @@ class GCPMode(LaunchMode):
             'shutdown-script': stop_script,
             'data_sync_interval': self.data_sync_interval
         }
+
+    def _make_instance_name(self):
+        exp_name = "{}-{}".format(self.gcp_label, gcp_util.make_timekey())
         # instance name must match regex '(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)'">
-        unique_name= "doodad" + str(uuid.uuid4()).replace("-", "")
+        unique_name = "doodad" + str(uuid.uuid4()).replace("-", "")
+        return unique_name, exp_name
+
+    def run_script(self, script, dry=False, return_output=False, verbose=False):
+        if return_output:
+            raise ValueError("Cannot return output for GCP scripts.")
+
+        metadata = self._make_metadata(script, dry=dry)
+        unique_name, exp_name = self._make_instance_name()
+        exp_prefix = self.gcp_label
         instance_info = self.create_instance(metadata, unique_name, exp_name, exp_prefix, dry=dry)
+        if not dry:
+            self._record_job(script, job_registry.STATUS_SUBMITTED, instance_id=unique_name)
         if verbose:
             print('Launched instance %s' % unique_name)
             print(instance_info)
         return metadata
 
+    def get_source_disk_image(self, dry=False):
+        """
+        Returns the selfLink of the instance image, which is looked up once.
+        """
+        if self._source_disk_image is None:
+            compute_images = self.compute.images().get(
+                project=self.gce_image_project,
+                image=self.gce_image,
+            )
+            if dry:
+                return None
+            self._source_disk_image = compute_images.execute()['selfLink']
+        return self._source_disk_image
+
     def create_instance(self, metadata, name, exp_name="", exp_prefix="", dry=False):
-        compute_images = self.compute.images().get(
-            project=self.gce_image_project,
-            image=self.gce_image,
-        )
+        compute_instances = self._insert_request(metadata, name, exp_name, exp_prefix, dry=dry)
         if not dry:
-            image_response = compute_images.execute()
-        else:
-            image_response = {'selfLink': None}
-        source_disk_image = image_response['selfLink']
+            return compute_instances.execute()
+
+    def _insert_request(self, metadata, name, exp_name="", exp_prefix="", dry=False):
+        source_disk_image = self.get_source_disk_image(dry=dry)
         if self.zone == 'auto':
             raise NotImplementedError('auto zone finder')
         zone = self.zone
@@ -550,13 +1377,11 @@ class GCPMode(LaunchMode):
                       "acceleratorType": self.gpu_type,
                       "acceleratorCount": self.num_gpu,
             }]
-        compute_instances = self.compute.instances().insert(
+        return self.compute.instances().insert(
             project=self.gcp_project,
             zone=zone,
             body=config
         )
-        if not dry:
-            return compute_instances.execute()
 
 
 class SlurmScriptMode(LaunchMode):
@@ -580,7 +1405,24 @@ class SlurmScriptMode(LaunchMode):
     $ cd SLURM_PATH
     $ ./script.sh
     ```
+
+    run_scripts (used by sweeps) instead writes every command to a task
+    table, LOCAL_PATH/tasks.txt, and `script.sh` submits the whole sweep
+    as one job array:
+
+    ```
+    sbatch --SBATCH_ARGS --array=0-N%K --wrap=$'(line SLURM_ARRAY_TASK_ID of SLURM_PATH/tasks.txt)'
+    ```
+
+    Args:
+        task_table_filename (str): Name of the task table of job arrays.
+        max_concurrent_array_tasks (int): If given, the maximum number of
+            tasks of a job array which run at once (the K above).
+        max_array_size (int): The cluster's MaxArraySize minus one. Larger
+            sweeps are submitted as several arrays.
     """
+    batch_launch = True
+
     def __init__(self,
                  local_directory_for_scripts,
                  account_name,
@@ -594,6 +1436,9 @@ class SlurmScriptMode(LaunchMode):
                  extra_flags="",
                  slurm_directory_for_job_script=None,
                  slurm_script_filename='script.sh',
+                 task_table_filename='tasks.txt',
+                 max_concurrent_array_tasks=None,
+                 max_array_size=1000,
                  **kwargs):
         super(SlurmScriptMode, self).__init__(**kwargs)
         self.slurm_job_generator = SlurmJobGenerator(
@@ -615,6 +1460,16 @@ class SlurmScriptMode(LaunchMode):
             local_directory_for_scripts,
             slurm_script_filename,
         )
+        self.local_task_table_path = os.path.join(
+            local_directory_for_scripts,
+            task_table_filename,
+        )
+        self.slurm_task_table_path = os.path.join(
+            slurm_directory_for_job_script,
+            task_table_filename,
+        )
+        self.max_concurrent_array_tasks = max_concurrent_array_tasks
+        self.max_array_size = max_array_size
 
     def __str__(self):
         return 'Slurm-Script-%s' % self.local_directory_for_scripts
@@ -622,6 +1477,41 @@ class SlurmScriptMode(LaunchMode):
     def run_script(self, script, dry=False, return_output=False, verbose=False):
         self.save_job_script(script)
         self.create_slurm_script(script)
+        self._record_job(script, job_registry.STATUS_PENDING)
+        return 'Launch script save to: {}'.format(self.slurm_script_file_path)
+
+    def run_scripts(self, script_filenames, dry=False, verbose=False, configs=None):
+        """
+        Writes all scripts to the task table and a launch script which
+        submits them as job arrays, replacing any previous ones.
+        """
+        saved = set()
+        tasks = []
+        for script in script_filenames:
+            script_without_cli_args = script.split(' -- ')[0]
+            # a sweep usually runs the same archive with different arguments
+            if script_without_cli_args not in saved:
+                self.save_job_script(script)
+                saved.add(script_without_cli_args)
+            tasks.append(self._slurm_command(script))
+        with open(self.local_task_table_path, 'w') as f:
+            f.write(''.join([task + '\n' for task in tasks]))
+        sbatch_cmds = self.slurm_job_generator.wrap_task_table_with_sbatch(
+            self.slurm_task_table_path, len(tasks),
+            max_concurrent=self.max_concurrent_array_tasks,
+            max_array_size=self.max_array_size,
+        )
+        with open(self.slurm_script_file_path, 'w') as f:
+            f.write('\n'.join(sbatch_cmds) + '\n')
+        os.chmod(self.slurm_script_file_path, 0o777)
+        if verbose:
+            print('Launch script for %d tasks saved to: %s' % (len(tasks), self.slurm_script_file_path))
+
+        context = job_registry.current_context()
+        for i, script in enumerate(script_filenames):
+            config = configs[i] if configs is not None else context['config']
+            self._record_job(script, job_registry.STATUS_PENDING,
+                             context={'sweep_id': context['sweep_id'], 'config': config})
         return 'Launch script save to: {}'.format(self.slurm_script_file_path)
 
     def save_job_script(self, script):
@@ -630,7 +1520,10 @@ class SlurmScriptMode(LaunchMode):
             raise ValueError("Pattern ' -- ' should appear at most once.")
         shutil.copy(script_without_cli_args, self.local_directory_for_scripts)
 
-    def create_slurm_script(self, script):
+    def _slurm_command(self, script):
+        """
+        Returns the command which runs a saved job script on the cluster.
+        """
         script_without_cli_args, *cli_args = script.split(' -- ')
         if len(cli_args) > 1:
             raise ValueError("Pattern ' -- ' should appear at most once.")
@@ -639,7 +1532,10 @@ class SlurmScriptMode(LaunchMode):
                 / pathlib.Path(script_without_cli_args).name
         )
         cmd_with_cli_args = [str(new_script_path)] + cli_args
-        cmd = ' -- '.join(cmd_with_cli_args)
+        return ' -- '.join(cmd_with_cli_args)
+
+    def create_slurm_script(self, script):
+        cmd = self._slurm_command(script)
         full_cmd = self.slurm_job_generator.wrap_command_with_sbatch(cmd)
         with open(self.slurm_script_file_path, 'w') as f:
             f.write(full_cmd)
@@ -681,6 +1577,9 @@ class BrcHighThroughputMode(SlurmScriptMode):
 
     https://docs-research-it.berkeley.edu/services/high-performance-computing/user-guide/running-your-jobs/hthelper-script
     """
+    # task.sh already runs the whole sweep in one allocation
+    batch_launch = False
+
     def __init__(self,
                  *args,
                  task_filename='task.sh',
@@ -703,18 +1602,11 @@ class BrcHighThroughputMode(SlurmScriptMode):
         self.save_job_script(script)
         self.create_task_file(script)
         self.create_slurm_script(script)
+        self._record_job(script, job_registry.STATUS_PENDING)
         return 'Launch script save to: {}'.format(self.slurm_script_file_path)
 
     def create_task_file(self, script):
-        script_without_cli_args, *cli_args = script.split(' -- ')
-        if len(cli_args) > 1:
-            raise ValueError("Pattern ' -- ' should appear at most once.")
-        new_script_path = str(
-                pathlib.Path(self.slurm_directory_for_job_script)
-                / pathlib.Path(script_without_cli_args).name
-        )
-        cmd_with_cli_args = [str(new_script_path)] + cli_args
-        cmd = ' -- '.join(cmd_with_cli_args)
+        cmd = self._slurm_command(script)
         script_builder.add_to_script(
             cmd,
             path=self.local_task_file_path,
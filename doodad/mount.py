@@ -6,7 +6,10 @@ Each object defines a source and a mount point (where the directory will be visi
 to the launched process)
 
 """
+import fnmatch
 import os
+import re
+import shlex
 import shutil
 import tarfile
 import tempfile
@@ -15,6 +18,8 @@ from contextlib import contextmanager
 from doodad.apis import aws_util
 from doodad import utils
 
+LAYER_FILE = 'layer.tar.gz'
+
 
 class Mount(object):
     """
@@ -31,12 +36,44 @@ class Mount(object):
         self._name = None
         self.local_dir = None
 
-    def dar_build_archive(self, deps_dir):
+    def dar_build_archive(self, deps_dir, layer_cache=None, copy_files=True):
+        """
+        Writes the files and extraction script for this mount into deps_dir.
+
+        Args:
+            deps_dir (str): The deps directory of an archive being staged
+            layer_cache (LayerCache): Optional cache of packed mounts
+            copy_files (bool): If False, large files are not copied into
+                deps_dir and must be added with dar_add_to_writer instead.
+        """
         raise NotImplementedError()
 
+    def dar_add_to_writer(self, writer, layer_cache=None):
+        """
+        Streams files skipped by dar_build_archive(copy_files=False)
+        into an ArchiveWriter.
+        """
+        pass
+
     def dar_extract_command(self):
         raise NotImplementedError()
 
+    def dar_host_command(self):
+        """
+        Returns a command which the archive runs on the host, outside of
+        the container, before the payload starts, or None.
+        """
+        return None
+
+    def dar_fingerprint(self):
+        """
+        Returns a string identifying everything this mount contributes
+        to a Doodad Archive. Two mounts with the same fingerprint
+        produce identical archive contents.
+        """
+        return '%s:%s:%s:%s:%s' % (type(self).__name__, self.name,
+                                   self.mount_point, self.pythonpath, self.read_only)
+
     @property
     def writeable(self):
         return not self.read_only
@@ -82,17 +119,79 @@ class MountLocal(Mount):
                 to_ignore.append(content)
         return to_ignore
 
-    def dar_build_archive(self, deps_dir):
+    def walk_files(self, include_dirs=False):
+        """
+        Iterates over files which would be copied into an archive,
+        applying the same filters as ignore_patterns.
+
+        Args:
+            include_dirs (bool): If True, also yield (possibly empty)
+                subdirectories before their contents.
+
+        Yields:
+            (str, str): Tuples of (path relative to local_dir, absolute path)
+        """
+        for dirpath, dirnames, filenames in os.walk(self.local_dir, followlinks=True):
+            ignored = set(self.ignore_patterns(dirpath, dirnames + filenames))
+            dirnames[:] = sorted([d for d in dirnames if d not in ignored])
+            if include_dirs:
+                for dirname in dirnames:
+                    full_path = os.path.join(dirpath, dirname)
+                    yield os.path.relpath(full_path, self.local_dir), full_path
+            for filename in sorted(filenames):
+                if filename in ignored:
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                yield os.path.relpath(full_path, self.local_dir), full_path
+
+    def dar_fingerprint(self):
+        """
+        Files are identified by their path, size and modification time
+        (as make and rsync do) so that fingerprinting a large mount does
+        not require reading it.
+        """
+        fingerprint = [super(MountLocal, self).dar_fingerprint(), self.local_dir]
+        if self.read_only:
+            for rel_path, full_path in self.walk_files(include_dirs=True):
+                stat = os.stat(full_path)
+                if os.path.isdir(full_path):
+                    fingerprint.append('%s/' % rel_path)
+                else:
+                    fingerprint.append('%s:%d:%d:%o' % (rel_path, stat.st_size,
+                                                        stat.st_mtime_ns, stat.st_mode))
+        return '\n'.join(fingerprint)
+
+    def dar_archive_files(self):
+        """
+        Yields:
+            (str, str): Tuples of (path inside the archive, absolute path)
+                for every file and directory this mount adds to an archive.
+        """
+        if not self.read_only:
+            return
+        dep_dir = os.path.join('deps', 'local', self.name)
+        for rel_path, full_path in self.walk_files(include_dirs=True):
+            yield os.path.join(dep_dir, rel_path), full_path
+
+    def dar_build_archive(self, deps_dir, layer_cache=None, copy_files=True):
         utils.makedirs(os.path.join(deps_dir, 'local'))
         dep_dir = os.path.join(deps_dir, 'local', self.name)
         extract_file = os.path.join(dep_dir, 'extract.sh')
         mount_point = os.path.dirname(self.mount_point)
 
-        if self.read_only:
+        use_layer = self.read_only and copy_files and layer_cache is not None
+        if use_layer:
+            os.makedirs(dep_dir)
+            layer_cache.get_layer(self, os.path.join(dep_dir, LAYER_FILE))
+        elif self.read_only and copy_files:
             shutil.copytree(self.local_dir, dep_dir, ignore=self.ignore_patterns)
         else:
             os.makedirs(dep_dir)
         with open(extract_file, 'w') as f:
+            if use_layer:
+                # the layer unpacks into ./deps/local/{name}
+                f.write('tar -xzf ./deps/local/{name}/{layer}\n'.format(name=self.name, layer=LAYER_FILE))
+                f.write('rm ./deps/local/{name}/{layer}\n'.format(name=self.name, layer=LAYER_FILE))
             if self.read_only:
                 f.write('mkdir -p %s\n' % mount_point)
                 f.write('mv ./deps/local/{name} {mount}\n'.format(name=self.name, mount=self.mount_point))
@@ -102,6 +201,14 @@ class MountLocal(Mount):
                 f.write('export PYTHONPATH=$PYTHONPATH:{repo_dir}\n'.format(repo_dir=mount_point))
         os.chmod(extract_file, 0o777)
 
+    def dar_add_to_writer(self, writer, layer_cache=None):
+        if not self.read_only:
+            return
+        if layer_cache is not None:
+            writer.add_layer(layer_cache.get_layer(self))
+        else:
+            writer.add_files(self.dar_archive_files())
+
     def dar_extract_command(self):
         return './deps/local/{name}/extract.sh'.format(
             name=self.name,
@@ -127,7 +234,7 @@ class MountGit(Mount):
         self.branch = branch
         self._name = self.repo_name
 
-    def dar_build_archive(self, deps_dir):
+    def dar_build_archive(self, deps_dir, layer_cache=None, copy_files=True):
         dep_dir = os.path.join(deps_dir, 'git', self.name)
         os.makedirs(dep_dir)
 
@@ -156,14 +263,48 @@ class MountGit(Mount):
             name=self.name,
         )
 
+    def dar_fingerprint(self):
+        fingerprint = [super(MountGit, self).dar_fingerprint(), self.git_url, str(self.branch)]
+        if self.ssh_identity:
+            fingerprint.append(utils.hash_file(self.ssh_identity))
+        return '\n'.join(fingerprint)
+
+
+def sync_manifest_command(name, sync_dir, sync_interval, sync_args):
+    """
+    Returns a command which writes a sync manifest for an output mount into
+    $DOODAD_SYNC_MANIFEST_DIR, if it is set. The sync loops of EC2Mode and
+    GCPMode source these manifests to sync each mount on its own schedule.
+    The command runs on the host (see Mount.dar_host_command), where the
+    sync loop can read the manifest.
+
+    Args:
+        sync_args (list): Extra arguments of the sync command, e.g. filters.
+    """
+    manifest = ['SYNC_DIR=%s' % shlex.quote(sync_dir),
+                'SYNC_INTERVAL=%d' % sync_interval,
+                'SYNC_ARGS=(%s)' % ' '.join([shlex.quote(arg) for arg in sync_args])]
+    return ('if [ -n "$DOODAD_SYNC_MANIFEST_DIR" ]; then '
+            'mkdir -p $DOODAD_SYNC_MANIFEST_DIR && printf "%%s\\n" %s > $DOODAD_SYNC_MANIFEST_DIR/%s.conf; '
+            'fi') % (' '.join([shlex.quote(line) for line in manifest]), name)
+
 
 class MountS3(Mount):
+    """
+    An output directory which EC2Mode syncs to S3 while the job runs.
+
+    Args:
+        s3_path (str): Path underneath the log path of the launch mode.
+        sync_interval (int): Number of seconds between syncs.
+        include_types (tuple): Glob patterns of the files to sync, e.g.
+            ('*.txt', '*.csv'). By default every file is synced.
+    """
     def __init__(self,
                 s3_path,
                 sync_interval=15,
                 output=True,
                 dry=False,
-                include_types=('*.txt', '*.csv', '*.json', '*.gz', '*.tar', '*.log', '*.pkl'),
+                include_types=None,
                 **kwargs):
         super(MountS3, self).__init__(output=output, **kwargs)
         # load from config
@@ -182,12 +323,32 @@ class MountS3(Mount):
         self._name = self.sync_dir.replace('/', '_')
         assert output
 
-    def dar_build_archive(self, deps_dir):
+    def dar_build_archive(self, deps_dir, layer_cache=None, copy_files=True):
         return
 
     def dar_extract_command(self):
         return 'echo helloMountS3'
 
+    def dar_host_command(self):
+        # tells the sync loop in the EC2 user data how to sync this mount
+        return sync_manifest_command(self.name, self.sync_dir, self.sync_interval, self.sync_args())
+
+    def sync_args(self):
+        """
+        Returns:
+            list: Filter arguments of aws s3 sync for include_types
+        """
+        if not self.include_types:
+            return []
+        args = ['--exclude', '*']
+        for include_type in self.include_types:
+            args.extend(['--include', include_type])
+        return args
+
+    def dar_fingerprint(self):
+        return '%s:%s:%s' % (super(MountS3, self).dar_fingerprint(), self.sync_interval,
+                             self.include_types)
+
 
 class MountGCP(Mount):
     def __init__(self,
@@ -195,7 +356,8 @@ class MountGCP(Mount):
                 sync_interval=15,
                 output=True,
                 dry=False,
-                exclude_regex='*.tmp',
+                exclude_regex=r'.*\.tmp$',
+                exclude_glob=None,
                 **kwargs):
         """
 
@@ -204,6 +366,11 @@ class MountGCP(Mount):
             gcp_bucket (str): Bucket name
             gcp_path (str): Path underneath bucket. The full path will become
                 gs://{gcp_bucket}/{gcp_path}
+            sync_interval (int): Number of seconds between syncs.
+            exclude_regex (str): Files matching this python regex (as used
+                by gsutil rsync -x) are not synced.
+            exclude_glob (str): Files matching this glob pattern, e.g.
+                '*.ckpt', are not synced either.
         """
         super(MountGCP, self).__init__(output=output, **kwargs)
         # load from config
@@ -217,14 +384,37 @@ class MountGCP(Mount):
         self.output = output
         self.sync_interval = sync_interval
         self.sync_on_terminate = True
-        self.exclude_string = '"'+exclude_regex+'"'
+        patterns = []
+        if exclude_regex:
+            try:
+                re.compile(exclude_regex)
+            except re.error as e:
+                raise ValueError('Invalid exclude_regex %r (%s). Use exclude_glob for glob patterns.'
+                                 % (exclude_regex, e))
+            patterns.append(exclude_regex)
+        if exclude_glob:
+            # fnmatch wraps the pattern in (?s:...)\Z, which gsutil's python regexes accept
+            patterns.append(fnmatch.translate(exclude_glob))
+        if len(patterns) > 1:
+            patterns = ['|'.join(['(?:%s)' % pattern for pattern in patterns])]
+        self.exclude_regex = patterns[0] if patterns else None
+        self.exclude_string = '"%s"' % self.exclude_regex
         self._name = self.sync_dir.replace('/', '_')
         self.dry = dry
         assert output
 
-    def dar_build_archive(self, deps_dir):
+    def dar_build_archive(self, deps_dir, layer_cache=None, copy_files=True):
         return
 
     def dar_extract_command(self):
         return 'echo helloMountGCP'
 
+    def dar_host_command(self):
+        # tells the sync loop in the GCP startup script how to sync this mount
+        sync_args = ['-x', self.exclude_regex] if self.exclude_regex else []
+        return sync_manifest_command(self.name, self.sync_dir, self.sync_interval, sync_args)
+
+    def dar_fingerprint(self):
+        return '%s:%s:%s' % (super(MountGCP, self).dar_fingerprint(), self.sync_interval,
+                             self.exclude_regex)
+
@@ -0,0 +1,96 @@
+import unittest
+import contextlib
+import io
+import os
+import os.path as path
+import shutil
+import tempfile
+
+from doodad import job_registry, mode
+
+
+class TestJobRegistry(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.registry = job_registry.JobRegistry(path.join(self.work_dir, 'jobs.db'))
+        job_registry.set_registry(self.registry)
+
+    def tearDown(self):
+        job_registry.set_registry(None)
+        self.registry.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_query(self):
+        for i in range(4):
+            job_id = self.registry.add_job('EC2', 'run.dar', job_registry.STATUS_SUBMITTED,
+                                           sweep_id='sweep%d' % (i % 2), config={'i': i},
+                                           instance_id='sir-%d' % i)
+        self.registry.update_job(job_id, status=job_registry.STATUS_FAILED, exit_code=1)
+        jobs = self.registry.query(sweep_id='sweep1')
+        self.assertEqual([job['config'] for job in jobs], [{'i': 1}, {'i': 3}])
+        self.assertEqual(self.registry.count_by_status(sweep_id='sweep1'),
+                         {job_registry.STATUS_SUBMITTED: 1, job_registry.STATUS_FAILED: 1})
+        failed = self.registry.query(status=job_registry.STATUS_FAILED)
+        self.assertEqual(failed[0]['instance_id'], 'sir-3')
+        self.assertEqual(failed[0]['exit_code'], 1)
+
+    def test_local_modes(self):
+        script = path.join(self.work_dir, 'script.sh')
+        with open(script, 'w') as f:
+            f.write('exit $1\n')
+        launcher = mode.LocalMode()
+        with job_registry.job_context(sweep_id='local', config={'code': 0}):
+            launcher.run_script(script + ' 0')
+        with job_registry.job_context(sweep_id='local', config={'code': 3}):
+            launcher.run_script(script + ' 3', return_output=True)
+        pool = mode.LocalPoolMode(num_slots=2)
+        with job_registry.job_context(sweep_id='pool'):
+            futures = [pool.submit(script + ' %d' % i) for i in range(3)]
+        [future.result() for future in futures]
+
+        jobs = self.registry.query(sweep_id='local')
+        self.assertEqual([job['status'] for job in jobs],
+                         [job_registry.STATUS_SUCCEEDED, job_registry.STATUS_FAILED])
+        self.assertEqual(jobs[1]['config'], {'code': 3})
+        self.assertEqual(jobs[0]['archive_hash'], jobs[1]['archive_hash'])
+        self.assertEqual(self.registry.count_by_status(sweep_id='pool'),
+                         {job_registry.STATUS_SUCCEEDED: 1, job_registry.STATUS_FAILED: 2})
+
+    def test_failures_do_not_raise(self):
+        # a registry path which cannot be created, e.g. under a read-only home
+        not_a_dir = path.join(self.work_dir, 'file')
+        open(not_a_dir, 'w').close()
+        old_path = os.environ.get(job_registry.DB_PATH_ENV)
+        os.environ[job_registry.DB_PATH_ENV] = path.join(not_a_dir, 'jobs.db')
+        job_registry._REGISTRY, job_registry._DISABLED = None, False
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                for _ in range(3):
+                    self.assertIsNone(job_registry.record_job('Local', 'run.dar',
+                                                              job_registry.STATUS_RUNNING))
+                job_registry.update_job('job', status=job_registry.STATUS_FAILED)
+        finally:
+            if old_path is None:
+                del os.environ[job_registry.DB_PATH_ENV]
+            else:
+                os.environ[job_registry.DB_PATH_ENV] = old_path
+        # warned once, without trying to open the registry for every job
+        self.assertEqual(output.getvalue().count('WARNING: Could not open job registry'), 1)
+        self.assertEqual(len(output.getvalue().splitlines()), 1)
+        self.assertIsNone(job_registry.get_registry())
+
+        job_registry.set_registry(self.registry)
+        hash_archive = job_registry.hash_archive
+        def fail(command):
+            raise ValueError(command)
+        job_registry.hash_archive = fail
+        try:
+            self.assertIsNone(job_registry.record_job('Local', 'run.dar', job_registry.STATUS_RUNNING))
+        finally:
+            job_registry.hash_archive = hash_archive
+        self.assertEqual(self.registry.query(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
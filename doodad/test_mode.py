@@ -1,11 +1,29 @@
 import unittest
+import hashlib
+import json
+import re
+import os
 import os.path as path
+import shutil
+import subprocess
 import tempfile
 import contextlib
 
-from doodad import mode
+from doodad import mode, mount
+from doodad.darchive import archive_builder_docker
 from doodad.utils import TESTING_DIR
+from doodad import job_registry
+from doodad.apis import aws_util, gcp_util
+from doodad.apis.ec2 import image_builder
 from doodad.credentials import ssh, ec2
+from doodad.utils import safe_import
+
+moto = safe_import.try_import('moto')
+boto3 = safe_import.try_import('boto3')
+googleapiclient = safe_import.try_import('googleapiclient')
+googleapiclient.discovery = safe_import.try_import('googleapiclient.discovery')
+googleapiclient.errors = safe_import.try_import('googleapiclient.errors')
+httplib2 = safe_import.try_import('httplib2')
 
 
 class TestLocal(unittest.TestCase):
@@ -17,6 +35,39 @@ class TestLocal(unittest.TestCase):
         )
 
 
+class TestLocalPool(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_script(self, name, contents):
+        script = path.join(self.work_dir, name)
+        with open(script, 'w') as f:
+            f.write(contents)
+        return script
+
+    def test_outputs(self):
+        launcher = mode.LocalPoolMode(num_slots=2)
+        script = self.write_script('echo.sh', 'echo $1\nexit $1\n')
+        futures = [launcher.submit('%s %d' % (script, i), return_output=True) for i in range(4)]
+        results = [future.result() for future in futures]
+        self.assertEqual([result.returncode for result in results], [0, 1, 2, 3])
+        self.assertEqual([result.output.strip() for result in results], ['0', '1', '2', '3'])
+        self.assertEqual(launcher.run_script(script + ' 7', return_output=True).strip(), '7')
+        launcher.shutdown()
+
+    def test_pinning(self):
+        launcher = mode.LocalPoolMode(num_slots=1, cpus_per_job=1, gpu_ids=[3])
+        script = self.write_script('env.sh', 'echo $CUDA_VISIBLE_DEVICES $DAR_DOCKER_GPUS\n')
+        output = launcher.run_script(script, return_output=True)
+        self.assertEqual(output.strip(), '3 device=3')
+        self.assertEqual(len(launcher.slot_cpus(0)), 1)
+        with self.assertRaises(ValueError):
+            mode.LocalPoolMode(num_slots=10**6, cpus_per_job=1)
+
+
 class TestSSH(unittest.TestCase):
     def test_mode(self):
         credentials = ssh.SSHCredentials(hostname='b.com', username='a')
@@ -26,6 +77,89 @@ class TestSSH(unittest.TestCase):
             "scp -r myscript.sh a@b.com:./tmp_script.sh;ssh a@b.com 'bashy ./tmp_script.sh';ssh a@b.com 'rm ./tmp_script.sh'"
         )
 
+    def test_multiplex(self):
+        credentials = ssh.SSHCredentials(hostname='b.com', username='a')
+        launcher = mode.SSHMode(credentials, multiplex=True)
+        run_command = launcher._get_run_command('myscript.sh')
+        # all three commands share one master connection
+        self.assertEqual(run_command.count('-o ControlPath=%s' % ssh.DEFAULT_CONTROL_PATH), 3)
+        self.assertIsNone(credentials.control_path)
+
+    def test_remote_cache(self):
+        credentials = ssh.SSHCredentials(hostname='b.com', username='a')
+        launcher = mode.SSHMode(credentials, remote_cache_dir='cache')
+        self.assertEqual(
+            launcher._get_run_command("myscript.sh -- --name 'a b'"),
+            "ssh a@b.com 'touch -c cache/myscript.sh; sh cache/myscript.sh -- --name '\"'\"'a b'\"'\"''"
+        )
+
+    def test_detach(self):
+        credentials = ssh.SSHCredentials(hostname='b.com', username='a')
+        launcher = mode.SSHMode(credentials, detach=True, remote_job_dir='jobs')
+        job = launcher.run_script('myscript.sh', dry=True)
+        self.assertTrue(job.job_dir.startswith('jobs/'))
+        self.assertIsNone(job.job_id)
+        with self.assertRaises(ValueError):
+            launcher.run_script('myscript.sh', dry=True, return_output=True)
+
+
+class TestSSHCluster(unittest.TestCase):
+    def setUp(self):
+        hosts = [ssh.SSHCredentials(hostname='host%d' % i, username='a') for i in range(3)]
+        self.launcher = mode.SSHClusterMode(hosts, gpus_per_job=1, max_jobs_per_host=2)
+        self.statuses = {
+            'a@host0': mode.HostStatus(load=8.0, num_cpus=8, free_mem_mb=1000, free_gpus=[0, 1]),
+            'a@host1': mode.HostStatus(load=0.0, num_cpus=8, free_mem_mb=1000, free_gpus=[2]),
+            'a@host2': None,
+        }
+        self.launcher.probe_hosts = lambda: self.statuses
+
+    def test_parse(self):
+        status = mode.parse_host_probe('1.50 0.90 0.80 2/300 1234\n16\n64000\n'
+                                       '0, 3, 0\n1, 11000, 98\n')
+        self.assertEqual(status, mode.HostStatus(load=1.5, num_cpus=16, free_mem_mb=64000, free_gpus=[0],
+                                                 num_gpus=2))
+        # nvidia-smi prints its errors to stdout
+        status = mode.parse_host_probe('1.50 0.90 0.80 2/300 1234\n16\n64000\n'
+                                       'NVIDIA-SMI has failed because it could not communicate with the '
+                                       'NVIDIA driver.\n')
+        self.assertEqual(status, mode.HostStatus(load=1.5, num_cpus=16, free_mem_mb=64000, free_gpus=[],
+                                                 num_gpus=0))
+
+    def test_placement(self):
+        placements = [self.launcher._acquire() for _ in range(3)]
+        # host1 is idle but has one free GPU, host2 is unreachable
+        self.assertEqual([(host.hostname, gpus) for host, gpus in placements],
+                         [('host1', [2]), ('host0', [0]), ('host0', [1])])
+        self.assertEqual(self.launcher.running_jobs(), {'a@host0': 2, 'a@host1': 1, 'a@host2': 0})
+        self.launcher._release(*placements[0])
+        host, gpus = self.launcher._acquire()
+        self.assertEqual((host.hostname, gpus), ('host1', [2]))
+
+    def test_unplaceable(self):
+        self.launcher.wait_interval = 0
+        self.statuses['a@host0'] = self.statuses['a@host1'] = None
+        with self.assertRaises(IOError):
+            self.launcher._acquire()
+        self.statuses['a@host0'] = mode.HostStatus(load=0.0, num_cpus=8, free_mem_mb=1000,
+                                                   free_gpus=[], num_gpus=0)
+        with self.assertRaises(ValueError):
+            self.launcher._acquire()
+        # a GPU which is busy may become free
+        self.statuses['a@host0'] = mode.HostStatus(load=0.0, num_cpus=8, free_mem_mb=1000,
+                                                   free_gpus=[], num_gpus=1)
+        self.launcher.wait_timeout = 0
+        with self.assertRaises(TimeoutError):
+            self.launcher._acquire()
+
+    def test_run_command(self):
+        self.launcher._local.placement = self.launcher._acquire()
+        run_command = self.launcher._get_run_command('myscript.sh')
+        self.assertIn("ssh a@host1 ", run_command)
+        self.assertIn("CUDA_VISIBLE_DEVICES=2 ", run_command)
+        self.assertNotIn('./tmp_script.sh', run_command)
+
+
 class TestEC2(unittest.TestCase):
     def test_dry(self):
         credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
@@ -36,6 +170,147 @@ class TestEC2(unittest.TestCase):
         )
         launcher.run_script('test_script.sh', dry=True)
 
+    def test_batch_dry(self):
+        credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        launcher = mode.EC2Mode(
+            ec2_credentials=credentials,
+            s3_bucket='test.bucket',
+            s3_log_path='test_log_path',
+            launch_batch_size=3,
+        )
+        batches = []
+        launcher._launch_batch = lambda script, batch, *args, **kwargs: batches.append((script, batch))
+        scripts = ['a.dar -- --n %d' % i for i in range(4)] + ['b.dar -- --n 4']
+        launcher.run_scripts(scripts, dry=True)
+        self.assertEqual([len(batch) for _, batch in batches], [3, 1, 1])
+        self.assertEqual(batches[1], ('s3://test.bucket/doodad/mount/a.dar', [(3, '-- --n 3')]))
+
+    def test_upload_by_hash(self):
+        credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        launcher = mode.EC2Mode(ec2_credentials=credentials, s3_bucket='test.bucket',
+                                s3_log_path='test_log_path')
+        with tempfile.NamedTemporaryFile(suffix='.dar') as f:
+            f.write(b'archive')
+            f.flush()
+            s3_filename, script_args = launcher._upload_script(f.name + ' -- --n 1', dry=True)
+        self.assertEqual(s3_filename,
+                         's3://test.bucket/doodad/mount/%s.dar' % hashlib.md5(b'archive').hexdigest())
+        self.assertEqual(script_args, '-- --n 1')
+
+    def test_batch_launch_index(self):
+        credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        launcher = mode.EC2Mode(ec2_credentials=credentials, s3_bucket='test.bucket',
+                                s3_log_path='test_log_path', shell_interpreter='echo')
+        run_command = launcher._batch_run_command(['--n 1', "--name 'a b'"])
+        lines = run_command.splitlines()
+        self.assertIn('ami-launch-index', lines[0])
+        for launch_index, expected in [(0, '--n 1'), (1, '--name a b')]:
+            cmd = '\n'.join(['AMI_LAUNCH_INDEX=%d' % launch_index] + lines[1:])
+            output = subprocess.check_output(['bash', '-c', cmd]).decode('utf-8')
+            self.assertEqual(output.strip(), '/tmp/remote_script.sh ' + expected)
+
+    def test_prepared_image(self):
+        credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        for prepared_image in [False, True]:
+            launcher = mode.EC2Mode(ec2_credentials=credentials, s3_bucket='test.bucket',
+                                    s3_log_path='test_log_path', prepared_image=prepared_image)
+            user_data = launcher._make_user_data('s3://test.bucket/a.dar', 'sh /tmp/remote_script.sh')
+            subprocess.check_call(['bash', '-n', '-c', user_data])
+            # setup steps only run if the image is missing them
+            self.assertEqual('command -v aws' in user_data, prepared_image)
+            self.assertEqual('\nservice docker start' in user_data, not prepared_image)
+            self.assertIn('export AWS_DEFAULT_REGION=%s\n' % launcher.region, user_data)
+
+    def test_prepare_script(self):
+        script = image_builder.make_prepare_script(swap_size=1024)
+        subprocess.check_call(['bash', '-n', '-c', script])
+        self.assertIn('dd if=/dev/zero', script)
+        self.assertGreater(script.index('/etc/fstab'), script.rindex('swapon'))
+        self.assertIn("sudo shutdown -h now' EXIT", script)
+
+    def test_prepare_failed(self):
+        class FakeEC2Client(object):
+            def __init__(self):
+                self.terminated = []
+
+            def run_instances(self, **kwargs):
+                return {'Instances': [{'InstanceId': 'i-123'}]}
+
+            def get_waiter(self, name):
+                return FakeWaiter()
+
+            def get_console_output(self, InstanceId):
+                return {'Output': 'mkswap: error\n%s: exit code 1\n' % image_builder.PREPARE_FAILED}
+
+            def create_image(self, **kwargs):
+                raise AssertionError('image created from a failed build')
+
+            def terminate_instances(self, InstanceIds):
+                self.terminated.extend(InstanceIds)
+
+        class FakeWaiter(object):
+            def wait(self, **kwargs):
+                pass
+
+        client = FakeEC2Client()
+        with self.assertRaisesRegex(RuntimeError, 'mkswap: error'):
+            image_builder.build_prepared_image(client, 'ami-123', 'doodad-test')
+        self.assertEqual(client.terminated, ['i-123'])
+
+    def test_swap(self):
+        credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        for swap_type in ['file', 'instance_store', 'zram']:
+            for swap_size in [0, 1024]:
+                launcher = mode.EC2Mode(ec2_credentials=credentials, s3_bucket='test.bucket',
+                                        s3_log_path='test_log_path', swap_size=swap_size,
+                                        swap_type=swap_type)
+                user_data = launcher._make_user_data('s3://test.bucket/a.dar', 'sh /tmp/remote_script.sh')
+                subprocess.check_call(['bash', '-n', '-c', user_data])
+                self.assertEqual('swapon' in user_data, swap_size > 0)
+                self.assertEqual('dd if=/dev/zero' in user_data, swap_size > 0)
+                self.assertEqual('zramctl' in user_data, swap_size > 0 and swap_type == 'zram')
+        with self.assertRaises(ValueError):
+            mode.EC2Mode(ec2_credentials=credentials, s3_bucket='test.bucket',
+                         s3_log_path='test_log_path', swap_type='disk')
+
+    def test_sync(self):
+        credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        launcher = mode.EC2Mode(ec2_credentials=credentials, s3_bucket='test.bucket',
+                                s3_log_path='test_log_path')
+        work_dir = tempfile.mkdtemp()
+        try:
+            launcher.SYNC_MANIFEST_DIR = path.join(work_dir, 'manifests')
+            user_data = launcher._make_user_data('s3://test.bucket/a.dar', 'sh /tmp/remote_script.sh')
+            lines = user_data.splitlines()
+            start = lines.index('export DOODAD_SYNC_MANIFEST_DIR=%s' % launcher.SYNC_MANIFEST_DIR)
+            sync_function = '\n'.join(lines[start:lines.index('}', start) + 1])
+            # records the arguments of each aws call
+            with open(path.join(work_dir, 'aws'), 'w') as f:
+                f.write('#!/bin/sh\necho "$@" >> %s\n' % path.join(work_dir, 'calls'))
+            os.chmod(path.join(work_dir, 'aws'), 0o755)
+            with open(path.join(work_dir, 'docker'), 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(path.join(work_dir, 'docker'), 0o755)
+            s3_mount = mount.MountS3(s3_path='logs', mount_point='/data', sync_interval=100,
+                                     include_types=('*.txt',))
+            s3_mount.sync_dir = path.join(work_dir, 'logs')
+            # the manifest is written by the archive's docker hook on the host
+            archive = path.join(work_dir, 'a.dar')
+            archive_builder_docker.build_archive(archive_filename=archive, payload_script='echo hi',
+                                                 docker_image='python:3', mounts=[s3_mount])
+            script = '\n'.join([sync_function, 'sh %s --quiet > /dev/null' % archive,
+                                'doodad_sync', 'doodad_sync', 'doodad_sync 1'])
+            subprocess.check_call(['bash', '-c', script],
+                                  env=dict(os.environ, PATH=work_dir + ':' + os.environ['PATH']))
+            with open(path.join(work_dir, 'calls')) as f:
+                calls = f.read().splitlines()
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(calls[0], 's3 sync --region us-west-1 --no-progress --exclude * '
+                             '--include *.txt %s s3://test.bucket/test_log_path/outputs%s'
+                             % (s3_mount.sync_dir, s3_mount.sync_dir))
+        finally:
+            shutil.rmtree(work_dir)
+
     def test_autoconfig_dry(self):
         credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
         launcher = mode.EC2Autoconfig(
@@ -48,3 +323,178 @@ class TestEC2(unittest.TestCase):
         self.assertEqual(launcher.ami, 'ami-1111111111112west')
         self.assertEqual(launcher.aws_key_name, 'doodad-us-west-2')
 
+
+@unittest.skipIf(isinstance(moto, safe_import.FailedImportModule) or
+                 isinstance(boto3, safe_import.FailedImportModule),
+                 'moto and boto3 are required')
+class TestEC2Batch(unittest.TestCase):
+    def setUp(self):
+        for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+            os.environ.setdefault(key, 'testing')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.mock = (getattr(moto, 'mock_aws', None) or moto.mock_ec2)()
+        self.mock.start()
+        aws_util.reset_clients()
+        boto3.client('iam').create_instance_profile(InstanceProfileName='doodad')
+        aws_util.get_s3_client().create_bucket(Bucket='test-bucket')
+        self.registry = job_registry.JobRegistry(':memory:')
+        job_registry.set_registry(self.registry)
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        job_registry.set_registry(None)
+        shutil.rmtree(self.work_dir)
+        aws_util.reset_clients()
+        self.mock.stop()
+
+    def test_run_scripts(self):
+        archive = path.join(self.work_dir, 'a.dar')
+        with open(archive, 'w') as f:
+            f.write('archive')
+        launcher = mode.EC2Mode(
+            ec2_credentials=ec2.AWSCredentials(aws_key='testing', aws_secret='testing'),
+            s3_bucket='test-bucket', s3_log_path='logs', ami_name='ami-12c6146b',
+            instance_type='t2.micro', aws_key_name='key', security_groups=['default'],
+            launch_batch_size=3)
+        with job_registry.job_context(sweep_id='sweep'):
+            launcher.run_scripts([archive + ' -- --n %d' % i for i in range(5)],
+                                 configs=[{'n': i} for i in range(5)])
+        reservations = boto3.client('ec2', region_name=launcher.region).describe_instances()['Reservations']
+        self.assertEqual(sorted([len(r['Instances']) for r in reservations]), [2, 3])
+        self.assertEqual(reservations[0]['Instances'][0]['Tags'],
+                         [{'Key': 'Name', 'Value': launcher.tag_exp_name}])
+        jobs = self.registry.query(sweep_id='sweep')
+        self.assertEqual([job['config'] for job in jobs], [{'n': i} for i in range(5)])
+        self.assertEqual(len(set([job['instance_id'] for job in jobs])), 5)
+        # the archive is uploaded once
+        self.assertEqual(aws_util.get_s3_client().list_objects_v2(Bucket='test-bucket')['KeyCount'], 1)
+
+
+class FakeComputeHttp(object):
+    """
+    Answers GCE image lookups and batch requests, failing inserts of
+    instances named in fail_names.
+    """
+    def __init__(self, fail_names=()):
+        self.fail_names = fail_names
+        self.requests = []
+        self.instances = []
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        self.requests.append(uri)
+        if '/batch/' not in uri:
+            return httplib2.Response({'status': 200}), json.dumps({'selfLink': 'images/test'}).encode()
+        parts = []
+        for content_id, part in re.findall(r'Content-ID: <(.*?)>\s+(.*?)(?=\n--)', body, re.S):
+            instance = json.loads(part[part.index('{'):])
+            self.instances.append(instance)
+            status = '403 Forbidden' if instance['name'] in self.fail_names else '200 OK'
+            parts.append('--b\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                         'HTTP/1.1 %s\r\nContent-Type: application/json\r\n\r\n{}\r\n'
+                         % (content_id, status))
+        content = ''.join(parts) + '--b--'
+        return (httplib2.Response({'status': 200, 'content-type': 'multipart/mixed; boundary=b'}),
+                content.encode())
+
+
+@unittest.skipIf(isinstance(googleapiclient, safe_import.FailedImportModule),
+                 'googleapiclient is required')
+class TestGCPBatch(unittest.TestCase):
+    def setUp(self):
+        self.registry = job_registry.JobRegistry(':memory:')
+        job_registry.set_registry(self.registry)
+        self.http = http = FakeComputeHttp()
+
+        class FakeGCPMode(mode.GCPMode):
+            def _build_compute(self):
+                return googleapiclient.discovery.build('compute', 'v1', http=http,
+                                                       static_discovery=True)
+
+        self.launcher = FakeGCPMode(gcp_project='project', gcp_bucket='bucket',
+                                    gcp_log_path='logs', zone='us-west1-a',
+                                    launch_batch_size=3)
+        self.work_dir = tempfile.mkdtemp()
+        self.script = path.join(self.work_dir, 'script.sh')
+        with open(self.script, 'w') as f:
+            f.write('echo hello\n')
+        # the script is already in the bucket
+        gcp_util._uploaded.add(('bucket', gcp_util.upload_file_to_gcp_storage('bucket', self.script, dry=True)))
+
+    def tearDown(self):
+        job_registry.set_registry(None)
+        gcp_util.reset_clients()
+        shutil.rmtree(self.work_dir)
+
+    def test_run_scripts(self):
+        with job_registry.job_context(sweep_id='sweep'):
+            self.launcher.run_scripts([self.script + ' -- --n %d' % i for i in range(5)],
+                                      configs=[{'n': i} for i in range(5)])
+        # one image lookup and one request per batch
+        self.assertEqual(len(self.http.requests), 3)
+        self.assertEqual([instance['disks'][0]['initializeParams']['sourceImage']
+                          for instance in self.http.instances], ['images/test'] * 5)
+        args = [[item['value'] for item in instance['metadata']['items']
+                 if item['key'] == 'script_args'][0] for instance in self.http.instances]
+        self.assertEqual(args, ['-- --n %d' % i for i in range(5)])
+        jobs = self.registry.query(sweep_id='sweep')
+        self.assertEqual(sorted([job['config']['n'] for job in jobs]), list(range(5)))
+        self.assertEqual(sorted([job['instance_id'] for job in jobs]),
+                         sorted([instance['name'] for instance in self.http.instances]))
+
+    def test_failed_insert(self):
+        names = iter(['doodad-ok', 'doodad-fail'])
+        self.launcher._make_instance_name = lambda: (next(names), 'exp')
+        self.http.fail_names = ['doodad-fail']
+        with self.assertRaises(googleapiclient.errors.HttpError):
+            self.launcher.run_scripts([self.script, self.script])
+        self.assertEqual(self.registry.count_by_status(),
+                         {job_registry.STATUS_SUBMITTED: 1, job_registry.STATUS_FAILED: 1})
+
+
+# runs each task of an array in turn, as if the array had been scheduled
+FAKE_SBATCH = """#!/bin/bash
+for arg in "$@"; do
+    case $arg in
+        --array=*) array=${arg#--array=}; array=${array%%%*};;
+        --wrap=*) wrap=${arg#--wrap=};;
+    esac
+done
+for i in $(seq 0 ${array#0-}); do SLURM_ARRAY_TASK_ID=$i sh -c "$wrap"; done
+"""
+
+
+class TestSlurm(unittest.TestCase):
+    def setUp(self):
+        self.registry = job_registry.JobRegistry(':memory:')
+        job_registry.set_registry(self.registry)
+        self.work_dir = tempfile.mkdtemp()
+        self.script_dir = path.join(self.work_dir, 'scripts')
+        os.makedirs(self.script_dir)
+        self.script = path.join(self.work_dir, 'run.sh')
+        with open(self.script, 'w') as f:
+            f.write('echo "$@" >> %s\n' % path.join(self.work_dir, 'ran.txt'))
+        os.chmod(self.script, 0o755)
+        self.launcher = mode.SlurmScriptMode(self.script_dir, account_name='acc', partition='p',
+                                             time_in_mins=60, max_num_cores_per_node=8,
+                                             max_concurrent_array_tasks=2, max_array_size=3)
+
+    def tearDown(self):
+        job_registry.set_registry(None)
+        shutil.rmtree(self.work_dir)
+
+    def test_run_scripts(self):
+        with job_registry.job_context(sweep_id='sweep'):
+            self.launcher.run_scripts([self.script + ' -- --n %d' % i for i in range(5)],
+                                      configs=[{'n': i} for i in range(5)])
+        with open(self.launcher.slurm_script_file_path) as f:
+            sbatch_cmds = f.read().splitlines()
+        self.assertEqual([cmd.split('--array=')[1].split()[0] for cmd in sbatch_cmds], ['0-2%2', '0-1%2'])
+        with open(path.join(self.work_dir, 'sbatch'), 'w') as f:
+            f.write(FAKE_SBATCH)
+        os.chmod(path.join(self.work_dir, 'sbatch'), 0o755)
+        env = dict(os.environ, PATH=self.work_dir + os.pathsep + os.environ['PATH'])
+        subprocess.check_call(['bash', self.launcher.slurm_script_file_path], env=env)
+        with open(path.join(self.work_dir, 'ran.txt')) as f:
+            self.assertEqual(f.read().splitlines(), ['-- --n %d' % i for i in range(5)])
+        jobs = self.registry.query(sweep_id='sweep', status=job_registry.STATUS_PENDING)
+        self.assertEqual([job['config']['n'] for job in jobs], list(range(5)))
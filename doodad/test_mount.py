@@ -4,6 +4,8 @@ import os.path as path
 import shutil
 import tempfile
 import contextlib
+import re
+import subprocess
 
 from doodad import mount
 from doodad.utils import TESTING_DIR
@@ -29,3 +31,39 @@ class TestLocal(unittest.TestCase):
             shutil.rmtree(target_dir)
 
 
+class TestSyncManifest(unittest.TestCase):
+    def read_manifest(self, mnt):
+        work_dir = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, DOODAD_SYNC_MANIFEST_DIR=work_dir)
+            subprocess.check_call(['sh', '-c', mnt.dar_host_command()], env=env)
+            script = '. %s; echo $SYNC_DIR $SYNC_INTERVAL; printf "%%s\\n" "${SYNC_ARGS[@]}"' % \
+                path.join(work_dir, mnt.name + '.conf')
+            return subprocess.check_output(['bash', '-c', script]).decode('utf-8').splitlines()
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_s3(self):
+        mnt = mount.MountS3(s3_path='logs', mount_point='/data', sync_interval=30,
+                            include_types=('*.txt', '*.csv'))
+        self.assertEqual(self.read_manifest(mnt),
+                         ['/doodad/logs 30', '--exclude', '*', '--include', '*.txt', '--include', '*.csv'])
+        # every file is synced by default, e.g. checkpoints
+        self.assertEqual(mount.MountS3(s3_path='logs').sync_args(), [])
+
+    def test_gcp(self):
+        mnt = mount.MountGCP(gcp_path='logs', mount_point='/data', exclude_regex=None,
+                             exclude_glob='ckpt.*')
+        manifest = self.read_manifest(mnt)
+        self.assertEqual(manifest[:2], ['/doodad/logs 15', '-x'])
+        # glob patterns are converted to a regex for gsutil rsync -x
+        self.assertTrue(re.match(manifest[2], 'ckpt.10'))
+        self.assertFalse(re.match(manifest[2], 'ckpt10'))
+        mnt = mount.MountGCP(gcp_path='logs', exclude_glob='*.ckpt')
+        self.assertTrue(re.match(mnt.exclude_regex, 'a/b.tmp'))
+        self.assertTrue(re.match(mnt.exclude_regex, 'a/b.ckpt'))
+        self.assertFalse(re.match(mnt.exclude_regex, 'b.txt'))
+        self.assertEqual(mount.MountGCP(gcp_path='logs').exclude_regex, r'.*\.tmp$')
+        with self.assertRaises(ValueError):
+            mount.MountGCP(gcp_path='logs', exclude_regex='*.tmp')
+
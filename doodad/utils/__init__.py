@@ -22,6 +22,21 @@ def hash_file(filename):
     return hasher.hexdigest()
 
 
+_file_hashes = {}
+
+
+def hash_file_cached(filename):
+    """
+    Like hash_file, but remembers the hash of a file until its size or
+    modification time changes.
+    """
+    stat = os.stat(filename)
+    key = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        _file_hashes[key] = hash_file(filename)
+    return _file_hashes[key]
+
+
 def makedirs(path):
     try:
         os.makedirs(path)
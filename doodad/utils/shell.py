@@ -22,10 +22,17 @@ def call(cmd, verbose=False, dry=False, wait=True, shell=False):
             return 1
 
 
-def call_and_get_output(cmd, shell=False, dry=False):
+def call_and_get_output(cmd, shell=False, dry=False, return_code=False):
+    """
+    Returns stdout, or (stdout, return code) if return_code is True
+    """
     if dry:
         print(cmd)
+        if return_code:
+            return None, None
     else:
         p = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE)
         output, errors = p.communicate()
+        if return_code:
+            return output, p.returncode
         return output
@@ -13,6 +13,8 @@ or
 run_sweep_serial(func, args)
 
 """
+import base64
+import json
 import math
 import os
 import itertools
@@ -20,33 +22,185 @@ import multiprocessing
 import random
 from datetime import datetime
 import hashlib
+import heapq
+import zlib
 import doodad
-from doodad import mount
+from doodad import job_registry, mount
 from doodad.launch import launch_api
+from doodad.launch.submitter import JobSubmitter
+from doodad.wrappers.sweeper import samplers
 from doodad.darchive import archive_builder_docker as archive_builder
 
+CHUNK_RUNNER_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'runner')
+CHUNK_RUNNER_SCRIPT = 'chunk_runner.py'
+CHUNK_RUNNER_MOUNT = os.path.join('target', 'doodad_chunk_runner')
+# must match RUNTIME_PREFIX in runner/chunk_runner.py
+CHUNK_RUNTIME_PREFIX = 'doodad_chunk_runtime:'
 
-class Sweeper(object):
-    def __init__(self, hyper_config):
-        self.hyper_config = hyper_config
 
-    def __iter__(self):
-        count = 0
-        for config in itertools.product(*[val for val in self.hyper_config.values()]):
-            kwargs = {key:config[i] for i, key in enumerate(self.hyper_config.keys())}
-            count += 1
-            yield kwargs
+# Sweeper iterates over the full grid of params.
+# See samplers.py for other ways of sampling configs.
+Sweeper = samplers.GridSweeper
 
 
-def chunker(sweeper, num_chunks=10, confirm=True):
-    chunks = [ [] for _ in range(num_chunks) ]
+def make_sweeper(params):
+    """
+    Args:
+        params: A dict of parameter values to sweep over as a grid, or a
+            sampler (such as samplers.RandomSweeper).
+    """
+    if isinstance(params, dict):
+        return Sweeper(params)
+    return params
+
+
+def make_sweep_id(target):
+    name = os.path.splitext(os.path.basename(target))[0]
+    return '%s_%s' % (name, datetime.now().strftime('%Y_%m_%d_%H_%M_%S'))
+
+
+def make_cli_args(config):
+    return ' '.join(['--%s %s' % (key, config[key]) for key in config])
+
+
+def encode_chunk(cli_args_list):
+    """
+    Encodes a list of command line argument strings into a single
+    shell-safe argument for runner/chunk_runner.py.
+    """
+    data = zlib.compress(json.dumps(cli_args_list).encode('utf-8'))
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def _shuffle(x):
+    # random.shuffle(x, random.random), which was removed in Python 3.11
+    for i in reversed(range(1, len(x))):
+        j = int(random.random() * (i + 1))
+        x[i], x[j] = x[j], x[i]
+
+
+class RuntimeHistory(object):
+    """
+    Estimates the cost of configs from the runtimes of previous runs.
+    Can be passed as the cost_fn of chunker.
+
+    Runtimes of chunked sweeps are written by the chunk runner to stderr
+    and can be recorded from the job logs with record_log.
+
+    Args:
+        history_file (str): JSON file in which to store runtimes.
+            If None, runtimes are only kept in memory.
+        default_cost (float): Estimate used when no runtimes are recorded.
+    """
+    def __init__(self, history_file=None, default_cost=1.0):
+        self.history_file = history_file
+        self.default_cost = default_cost
+        self.runtimes = {}
+        if history_file is not None and os.path.exists(history_file):
+            with open(history_file) as f:
+                self.runtimes = json.load(f)
+
+    def record(self, config, runtime):
+        """
+        Args:
+            config: A config dict, or its command line arguments
+            runtime (float): Runtime in seconds
+        """
+        if isinstance(config, dict):
+            config = make_cli_args(config)
+        self.runtimes[config] = runtime
+
+    def record_log(self, log_text):
+        """
+        Records all runtimes written by the chunk runner to a log.
+        """
+        for line in log_text.splitlines():
+            if line.startswith(CHUNK_RUNTIME_PREFIX):
+                runtime, _, cli_args = line[len(CHUNK_RUNTIME_PREFIX):].strip().partition(' ')
+                self.record(cli_args, float(runtime))
+
+    def save(self):
+        """
+        Writes the recorded runtimes to history_file, if there is one.
+        """
+        if self.history_file is None:
+            return
+        tmp_file = self.history_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.runtimes, f)
+        os.replace(tmp_file, self.history_file)
+
+    def __call__(self, config):
+        """
+        Returns the recorded runtime of config if there is one, and otherwise
+        the mean runtime of the recorded configs sharing the most parameter
+        values with it.
+        """
+        cli_args = make_cli_args(config)
+        if cli_args in self.runtimes:
+            return self.runtimes[cli_args]
+        if not self.runtimes:
+            return self.default_cost
+        args = _cli_arg_pairs(cli_args)
+        best_overlap = -1
+        best_runtimes = []
+        for other_args, runtime in self.runtimes.items():
+            overlap = len(args & _cli_arg_pairs(other_args))
+            if overlap > best_overlap:
+                best_overlap, best_runtimes = overlap, []
+            if overlap == best_overlap:
+                best_runtimes.append(runtime)
+        return sum(best_runtimes) / len(best_runtimes)
+
+
+def _cli_arg_pairs(cli_args):
+    return set([arg.strip() for arg in (' ' + cli_args).split(' --') if arg.strip()])
+
+
+def pack_chunks(configs, num_chunks, cost_fn):
+    """
+    Splits configs into chunks with roughly equal total cost, using the
+    longest-processing-time-first rule: configs are assigned in order of
+    decreasing cost to the chunk with the lowest total cost so far.
+
+    Returns:
+        tuple: (list of chunks, list of total costs of each chunk)
+    """
+    costs = [cost_fn(config) for config in configs]
+    chunks = [[] for _ in range(num_chunks)]
+    loads = [0.0] * num_chunks
+    heap = [(0.0, i) for i in range(num_chunks)]
+    for idx in sorted(range(len(configs)), key=lambda idx: -costs[idx]):
+        load, chunk_idx = heapq.heappop(heap)
+        chunks[chunk_idx].append(configs[idx])
+        loads[chunk_idx] = load + costs[idx]
+        heapq.heappush(heap, (loads[chunk_idx], chunk_idx))
+    return chunks, loads
+
+
+def chunker(sweeper, num_chunks=10, confirm=True, cost_fn=None):
+    """
+    Splits the configs of a sweeper into num_chunks chunks.
+
+    Args:
+        cost_fn: A function returning the estimated runtime of a config,
+            such as a RuntimeHistory. If given, chunks are packed to balance
+            their total runtime. Otherwise, configs are shuffled and dealt
+            out evenly.
+    """
     print('computing chunks')
     configs = [config for config in sweeper]
-    random.shuffle(configs, random.random)
-    for i, config in enumerate(configs):
-        chunks[i % num_chunks].append(config)
+    if cost_fn is None:
+        chunks = [ [] for _ in range(num_chunks) ]
+        _shuffle(configs)
+        for i, config in enumerate(configs):
+            chunks[i % num_chunks].append(config)
+    else:
+        chunks, loads = pack_chunks(configs, num_chunks, cost_fn)
     print('num chunks:  ', num_chunks)
     print('chunk sizes: ', [len(chunk) for chunk in chunks])
+    if cost_fn is not None:
+        print('chunk costs: ', ['%.1f' % load for load in loads])
     print('total jobs:  ', sum([len(chunk) for chunk in chunks]))
 
     resp = 'y'
@@ -60,7 +214,17 @@ def chunker(sweeper, num_chunks=10, confirm=True):
         return []
 
 
-def run_sweep_doodad(target, params, run_mode, mounts, test_one=False, docker_image='python:3', return_output=False, verbose=False):
+def run_sweep_doodad(target, params, run_mode, mounts, test_one=False, docker_image='python:3', return_output=False, verbose=False, archive_cache=None, layer_cache=None, compression=None, num_workers=1, max_retries=0, sweep_id=None):
+    """
+    Runs one job per config in a sweep.
+
+    Args:
+        num_workers (int): Number of jobs to submit concurrently.
+        max_retries (int): Number of times to retry submitting a job which
+            raised a network or rate limit error (see submitter.is_transient_error).
+        sweep_id (str): Id under which jobs are recorded in the job registry.
+            Defaults to the target name and the current time.
+    """
 
     # build archive
     target_dir = os.path.dirname(target)
@@ -72,68 +236,118 @@ def run_sweep_doodad(target, params, run_mode, mounts, test_one=False, docker_im
         target_full_path
     )
 
+    if sweep_id is None:
+        sweep_id = make_sweep_id(target)
     print('Launching jobs with mode %s' % run_mode)
-    results = []
-    njobs = 0
+    submitter = JobSubmitter(max_workers=num_workers, max_retries=max_retries)
     with archive_builder.temp_archive_file() as archive_file:
         archive = archive_builder.build_archive(archive_filename=archive_file,
                                                 payload_script=command,
                                                 verbose=verbose,
                                                 docker_image=docker_image,
                                                 use_gpu_image=run_mode.use_gpu,
-                                                mounts=mounts)
-
-        sweeper = Sweeper(params)
-        for config in sweeper:
-            njobs += 1
-            cli_args= ' '.join(['--%s %s' % (key, config[key]) for key in config])
-            cmd = archive + ' -- ' + cli_args
-            result = run_mode.run_script(cmd, return_output=return_output, verbose=False)
-            if return_output:
-                result = archive_builder._strip_stdout(result)
-                results.append(result)
-            if test_one:
-                break
-    print('Launching completed for %d jobs' % njobs)
+                                                mounts=mounts,
+                                                archive_cache=archive_cache,
+                                                layer_cache=layer_cache,
+                                                compression=compression)
+
+        def submit(config):
+            cmd = archive + ' -- ' + make_cli_args(config)
+            with job_registry.job_context(sweep_id=sweep_id, config=config):
+                return run_mode.run_script(cmd, return_output=return_output, verbose=False)
+
+        configs = make_sweeper(params)
+        if test_one:
+            configs = itertools.islice(configs, 1)
+        if run_mode.batch_launch and not return_output:
+            configs = list(configs)
+            cmds = [archive + ' -- ' + make_cli_args(config) for config in configs]
+            with job_registry.job_context(sweep_id=sweep_id):
+                run_mode.run_scripts(cmds, configs=configs)
+            outputs = configs
+        else:
+            outputs = submitter.map(submit, configs)
+    print('Launching completed for %d jobs in sweep %s' % (len(outputs), sweep_id))
     run_mode.print_launch_message()
-    return tuple(results)
+    if return_output:
+        return tuple([archive_builder._strip_stdout(output) for output in outputs])
+    return tuple()
 
 
-def run_sweep_doodad_chunked(target, params, run_mode, mounts, num_chunks=10, docker_image='python:3', return_output=False, test_one=False, confirm=True, verbose=False):
-    # build archive
+def run_sweep_doodad_chunked(target, params, run_mode, mounts, num_chunks=10, docker_image='python:3', return_output=False, test_one=False, confirm=True, verbose=False, archive_cache=None, layer_cache=None, compression=None, build_once=True, num_workers=1, max_retries=0, cost_fn=None, chunk_slots=1, sweep_id=None):
+    """
+    Runs a sweep by splitting configs into num_chunks jobs which each run
+    their configs one after another.
+
+    Args:
+        build_once (bool): If True, a single archive is built for the whole
+            sweep and each chunk's configs are passed to it as command line
+            arguments. If False, a separate archive is built for each chunk.
+        cost_fn: A function estimating the runtime of a config, used to
+            balance the runtime of chunks. See chunker.
+        chunk_slots (int): Number of configs each chunk runs at once.
+            If 0, each chunk runs one config per CPU core of its machine.
+        sweep_id (str): Id under which jobs are recorded in the job registry.
+            Defaults to the target name and the current time.
+        num_workers (int): Number of chunks to submit concurrently.
+        max_retries (int): Number of times to retry submitting a chunk which
+            raised a network or rate limit error (see submitter.is_transient_error).
+    """
     target_dir = os.path.dirname(target)
     target_mount_dir = os.path.join('target', os.path.basename(target_dir))
     target_mount = mount.MountLocal(local_dir=target_dir, mount_point=target_mount_dir)
-    mounts = list(mounts) + [target_mount]
+    runner_mount = mount.MountLocal(local_dir=CHUNK_RUNNER_DIR, mount_point=CHUNK_RUNNER_MOUNT)
+    mounts = list(mounts) + [target_mount, runner_mount]
     target_full_path = os.path.join(target_mount.mount_point, os.path.basename(target))
+    runner_command = 'python %s --num-slots %d %s' % (
+        os.path.join(CHUNK_RUNNER_MOUNT, CHUNK_RUNNER_SCRIPT), chunk_slots, target_full_path)
 
+    if sweep_id is None:
+        sweep_id = make_sweep_id(target)
     print('Launching jobs with mode %s' % run_mode)
-    results = []
-    njobs = 0
-    sweeper = Sweeper(params)
-    chunks = chunker(sweeper, num_chunks, confirm=confirm)
-    for chunk in chunks:
-        command = ''
-        for config in chunk:
-            njobs += 1
-            cli_args=' '.join(['--%s %s' % (key, config[key]) for key in config])
-            single_command = target_full_path + ' ' + cli_args
-            command += 'python %s;' % single_command
-        with archive_builder.temp_archive_file() as archive_file:
-            archive = archive_builder.build_archive(archive_filename=archive_file,
-                                                    payload_script=command,
-                                                    verbose=verbose,
-                                                    docker_image=docker_image,
-                                                    use_gpu_image=run_mode.use_gpu,
-                                                    mounts=mounts)
-
-            result = run_mode.run_script(archive, return_output=return_output, verbose=False)
-        if return_output:
-            result = archive_builder._strip_stdout(result)
-            results.append(result)
-        if test_one:
-            break
-    print('Launching completed for %d jobs on %d machines' % (njobs, num_chunks))
-    run_mode.print_launch_message()
-    return tuple(results)
+    submitter = JobSubmitter(max_workers=num_workers, max_retries=max_retries)
+    sweeper = make_sweeper(params)
+    chunks = [chunk for chunk in chunker(sweeper, num_chunks, confirm=confirm, cost_fn=cost_fn) if chunk]
+    if test_one:
+        chunks = chunks[:1]
+
+    def build(archive_file, payload_script):
+        return archive_builder.build_archive(archive_filename=archive_file,
+                                             payload_script=payload_script,
+                                             verbose=verbose,
+                                             docker_image=docker_image,
+                                             use_gpu_image=run_mode.use_gpu,
+                                             mounts=mounts,
+                                             archive_cache=archive_cache,
+                                             layer_cache=layer_cache,
+                                             compression=compression)
 
+    with archive_builder.temp_archive_file() as archive_file:
+        if build_once:
+            archive = build(archive_file, runner_command)
+
+        def submit(chunk):
+            chunk_args = encode_chunk([make_cli_args(config) for config in chunk])
+            with job_registry.job_context(sweep_id=sweep_id, config=chunk):
+                if build_once:
+                    cmd = archive + ' -- ' + chunk_args
+                    return run_mode.run_script(cmd, return_output=return_output, verbose=False)
+                # each chunk needs its own file when chunks are submitted concurrently
+                with archive_builder.temp_archive_file() as chunk_archive_file:
+                    cmd = build(chunk_archive_file, runner_command + ' ' + chunk_args)
+                    return run_mode.run_script(cmd, return_output=return_output, verbose=False)
+
+        if build_once and run_mode.batch_launch and not return_output:
+            cmds = [archive + ' -- ' + encode_chunk([make_cli_args(config) for config in chunk])
+                    for chunk in chunks]
+            with job_registry.job_context(sweep_id=sweep_id):
+                run_mode.run_scripts(cmds, configs=chunks)
+            outputs = chunks
+        else:
+            outputs = submitter.map(submit, chunks)
+    njobs = sum([len(chunk) for chunk in chunks])
+    print('Launching completed for %d jobs on %d machines in sweep %s' % (njobs, len(chunks), sweep_id))
+    run_mode.print_launch_message()
+    if return_output:
+        return tuple([archive_builder._strip_stdout(output) for output in outputs])
+    return tuple()
@@ -7,6 +7,10 @@ import doodad.mount as mount
 from doodad.utils import REPO_DIR
 from doodad.wrappers.sweeper import hyper_sweep
 
+# number of jobs submitted concurrently to cloud launch modes
+CLOUD_SUBMIT_WORKERS = 8
+CLOUD_SUBMIT_RETRIES = 2
+
 
 class DoodadSweeper(object):
     def __init__(self,
@@ -52,20 +56,34 @@ class DoodadSweeper(object):
                          mounts=self.mounts+[self.mount_out_local]+extra_mounts,
                          test_one=True, **kwargs)
 
-    def run_sweep_local(self, target, params, extra_mounts=None, num_chunks=-1, **kwargs):
+    def run_sweep_local(self, target, params, extra_mounts=None, num_chunks=-1,
+                        num_slots=None, cpus_per_job=None, gpu_ids=None, **kwargs):
         """
         Run a grid search locally
+
+        Args:
+            num_slots (int): If set, runs this many jobs at once with a
+                LocalPoolMode.
+            cpus_per_job (int): If set, runs jobs at once with a LocalPoolMode
+                and pins each job to its own set of this many CPU cores.
+            gpu_ids (list): GPUs to assign to jobs run with a LocalPoolMode.
         """
         if extra_mounts is None:
             extra_mounts = []
+        run_mode = self.mode_local
+        if num_slots or cpus_per_job:
+            run_mode = doodad.mode.LocalPoolMode(num_slots=num_slots,
+                                                 cpus_per_job=cpus_per_job,
+                                                 gpu_ids=gpu_ids)
+            kwargs.setdefault('num_workers', run_mode.num_slots)
         if num_chunks > 0:
-            return hyper_sweep.run_sweep_doodad_chunked(target, params, run_mode=self.mode_local,
+            return hyper_sweep.run_sweep_doodad_chunked(target, params, run_mode=run_mode,
                          docker_image=self.image,
                          mounts=self.mounts+[self.mount_out_local]+extra_mounts,
                          num_chunks=num_chunks,
                          **kwargs)
         else:
-            return hyper_sweep.run_sweep_doodad(target, params, run_mode=self.mode_local,
+            return hyper_sweep.run_sweep_doodad(target, params, run_mode=run_mode,
                          docker_image=self.image,
                          mounts=self.mounts+[self.mount_out_local]+extra_mounts,
                          **kwargs)
@@ -78,6 +96,8 @@ class DoodadSweeper(object):
         """
         Run a grid search on GCP
         """
+        kwargs.setdefault('num_workers', CLOUD_SUBMIT_WORKERS)
+        kwargs.setdefault('max_retries', CLOUD_SUBMIT_RETRIES)
         if extra_mounts is None:
             extra_mounts = []
         if log_prefix is None:
@@ -118,6 +138,8 @@ class DoodadSweeper(object):
         """
         Run a grid search on GCP
         """
+        kwargs.setdefault('num_workers', CLOUD_SUBMIT_WORKERS)
+        kwargs.setdefault('max_retries', CLOUD_SUBMIT_RETRIES)
         if extra_mounts is None:
             extra_mounts = []
         if log_prefix is None:
@@ -0,0 +1,83 @@
+"""
+Runs a chunk of sweep configurations inside a Doodad Archive.
+
+This script is mounted into the archives built by
+hyper_sweep.run_sweep_doodad_chunked, so it must not import doodad.
+
+Usage:
+    python chunk_runner.py [--num-slots N] TARGET ENCODED_CHUNK
+
+where ENCODED_CHUNK is a list of command line argument strings
+encoded with hyper_sweep.encode_chunk.
+
+Up to N configs run at once (default 1). If N is 0, one config runs per
+CPU core available to the runner. When configs run concurrently, the
+output of each config is buffered and printed in the order of the chunk.
+
+The runtime of each config is written to stderr in the format read by
+hyper_sweep.RuntimeHistory.record_log.
+"""
+import argparse
+import base64
+import concurrent.futures
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+import zlib
+
+RUNTIME_PREFIX = 'doodad_chunk_runtime:'
+
+
+def decode_chunk(encoded):
+    return json.loads(zlib.decompress(base64.urlsafe_b64decode(encoded.encode('ascii'))).decode('utf-8'))
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def run_config(target, cli_args, capture_output=False):
+    start = time.time()
+    p = subprocess.Popen([sys.executable, target] + shlex.split(cli_args),
+                         stdout=subprocess.PIPE if capture_output else None)
+    output, _ = p.communicate()
+    sys.stderr.write('%s %.3f %s\n' % (RUNTIME_PREFIX, time.time() - start, cli_args))
+    sys.stderr.flush()
+    return p.returncode, output
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-slots', type=int, default=1)
+    parser.add_argument('target')
+    parser.add_argument('chunk', nargs='?')
+    args = parser.parse_args(argv[1:])
+    chunk = decode_chunk(args.chunk) if args.chunk else []
+    num_slots = args.num_slots or available_cpus()
+
+    returncode = 0
+    if num_slots == 1:
+        for cli_args in chunk:
+            sys.stdout.flush()
+            code, _ = run_config(args.target, cli_args)
+            returncode = returncode or code
+        return returncode
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_slots) as executor:
+        futures = [executor.submit(run_config, args.target, cli_args, capture_output=True)
+                   for cli_args in chunk]
+        for future in futures:
+            code, output = future.result()
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+            returncode = returncode or code
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
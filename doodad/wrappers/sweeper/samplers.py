@@ -0,0 +1,359 @@
+"""
+Lazy samplers over hyperparameter spaces.
+
+A space is a dict mapping parameter names to one of:
+    - a list of values
+    - a distribution (Uniform, LogUniform), for samplers other than GridSweeper
+    - a Conditional, whose chosen value selects a nested space
+
+Samplers are iterables of config dicts. None of them build the full
+product of the space, so a few points can be sampled from a very large
+grid in constant memory. Samplers with a seed produce the same configs
+every time they are iterated.
+
+Example usage:
+
+params = {
+    'seed': [1, 2, 3],
+    'lr': LogUniform(1e-5, 1e-2),
+    'optimizer': Conditional({
+        'adam': {'beta1': [0.9, 0.99]},
+        'sgd': {'momentum': [0.0, 0.9]},
+    }),
+}
+for config in SobolSweeper(params, num_samples=64, seed=0):
+    print(config)
+"""
+import math
+import random
+
+
+class Uniform(object):
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (type(self).__name__, self.low, self.high)
+
+    def from_unit(self, u):
+        return self.low + u * (self.high - self.low)
+
+
+class LogUniform(Uniform):
+    def from_unit(self, u):
+        log_low, log_high = math.log(self.low), math.log(self.high)
+        return math.exp(log_low + u * (log_high - log_low))
+
+
+class Conditional(object):
+    """
+    A parameter whose value selects a nested space.
+
+    Args:
+        branches (dict): A mapping from parameter values to the spaces
+            of additional parameters used with that value.
+    """
+    def __init__(self, branches):
+        self.branches = branches
+
+
+def grid_size(params):
+    """
+    Returns the number of configs in a grid over params.
+    """
+    size = 1
+    for value in params.values():
+        if isinstance(value, Conditional):
+            size *= sum([grid_size(branch) for branch in value.branches.values()])
+        elif isinstance(value, Uniform):
+            raise ValueError('Cannot make a grid over continuous distribution %s' % value)
+        else:
+            size *= len(value)
+    return size
+
+
+def grid_config(params, index):
+    """
+    Returns the config at an index of a grid over params, in the same
+    order as itertools.product (the last parameter changes fastest).
+    """
+    config = {}
+    for key in reversed(list(params.keys())):
+        value = params[key]
+        if isinstance(value, Conditional):
+            index, sub_index = divmod(index, grid_size({key: value}))
+            for branch_value, branch in value.branches.items():
+                branch_size = grid_size(branch)
+                if sub_index < branch_size:
+                    config[key] = branch_value
+                    config.update(grid_config(branch, sub_index))
+                    break
+                sub_index -= branch_size
+        else:
+            index, sub_index = divmod(index, len(value))
+            config[key] = value[sub_index]
+    return {key: config[key] for key in _ordered_keys(params, config)}
+
+
+def num_dims(params):
+    """
+    Returns the number of unit-interval coordinates used to pick a config.
+    Each branch of a Conditional has its own coordinates.
+    """
+    dims = 0
+    for value in params.values():
+        dims += 1
+        if isinstance(value, Conditional):
+            dims += sum([num_dims(branch) for branch in value.branches.values()])
+    return dims
+
+
+def unit_config(params, point):
+    """
+    Returns the config for a point in the unit hypercube of num_dims(params)
+    dimensions.
+    """
+    config, _ = _unit_config(params, point, 0)
+    return {key: config[key] for key in _ordered_keys(params, config)}
+
+
+def _unit_config(params, point, offset):
+    config = {}
+    for key, value in params.items():
+        u = point[offset]
+        offset += 1
+        if isinstance(value, Conditional):
+            branch_values = list(value.branches.keys())
+            chosen = branch_values[min(int(u * len(branch_values)), len(branch_values) - 1)]
+            config[key] = chosen
+            for branch_value in branch_values:
+                branch = value.branches[branch_value]
+                if branch_value == chosen:
+                    branch_config, _ = _unit_config(branch, point, offset)
+                    config.update(branch_config)
+                offset += num_dims(branch)
+        elif isinstance(value, Uniform):
+            config[key] = value.from_unit(u)
+        else:
+            config[key] = value[min(int(u * len(value)), len(value) - 1)]
+    return config, offset
+
+
+def _ordered_keys(params, config):
+    # parameters in the order they are declared, with nested parameters
+    # directly after the parameter which selects them
+    keys = []
+    for key, value in params.items():
+        keys.append(key)
+        if isinstance(value, Conditional):
+            branch = value.branches[config[key]]
+            keys.extend(_ordered_keys(branch, config))
+    return keys
+
+
+def _is_discrete(params):
+    for value in params.values():
+        if isinstance(value, Uniform):
+            return False
+        if isinstance(value, Conditional):
+            if not all([_is_discrete(branch) for branch in value.branches.values()]):
+                return False
+    return True
+
+
+def _as_lists(params):
+    """
+    Returns a copy of params with each value list converted to a list, so
+    that sets, tuples and generators can be indexed.
+    """
+    converted = {}
+    for key, value in params.items():
+        if isinstance(value, Conditional):
+            converted[key] = Conditional({branch_value: _as_lists(branch)
+                                          for branch_value, branch in value.branches.items()})
+        elif isinstance(value, Uniform):
+            converted[key] = value
+        else:
+            converted[key] = list(value)
+    return converted
+
+
+class GridSweeper(object):
+    """
+    Iterates over every combination of parameter values.
+    """
+    def __init__(self, hyper_config):
+        self.hyper_config = _as_lists(hyper_config)
+
+    def __len__(self):
+        return grid_size(self.hyper_config)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield grid_config(self.hyper_config, index)
+
+
+class RandomSweeper(object):
+    """
+    Samples configs uniformly at random.
+
+    If every parameter is discrete, configs are sampled from the grid
+    without replacement.
+
+    Args:
+        hyper_config (dict): A space
+        num_samples (int): Number of configs to sample
+        seed (int): Random seed
+    """
+    def __init__(self, hyper_config, num_samples, seed=None):
+        self.hyper_config = _as_lists(hyper_config)
+        self.num_samples = num_samples
+        self.seed = seed
+        self.discrete = _is_discrete(self.hyper_config)
+        if self.discrete:
+            self.num_samples = min(num_samples, grid_size(self.hyper_config))
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        if self.discrete:
+            # random.sample over a range only stores the sampled indices
+            indices = rng.sample(range(grid_size(self.hyper_config)), self.num_samples)
+            for index in indices:
+                yield grid_config(self.hyper_config, index)
+        else:
+            dims = num_dims(self.hyper_config)
+            for _ in range(self.num_samples):
+                yield unit_config(self.hyper_config, [rng.random() for _ in range(dims)])
+
+
+class SobolSweeper(object):
+    """
+    Samples configs from a Sobol low-discrepancy sequence, which covers the
+    space more evenly than random sampling. num_samples should be a power of 2.
+
+    Args:
+        hyper_config (dict): A space
+        num_samples (int): Number of configs to sample
+        seed (int): If set, the sequence is scrambled with a random digital shift.
+    """
+    def __init__(self, hyper_config, num_samples, seed=None):
+        self.hyper_config = _as_lists(hyper_config)
+        self.num_samples = num_samples
+        self.seed = seed
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        dims = num_dims(self.hyper_config)
+        for point in sobol_sequence(dims, self.num_samples, seed=self.seed):
+            yield unit_config(self.hyper_config, point)
+
+
+class LatinHypercubeSweeper(object):
+    """
+    Samples configs with Latin hypercube sampling: the range of every
+    coordinate is split into num_samples strata and each stratum is
+    sampled exactly once.
+
+    Args:
+        hyper_config (dict): A space
+        num_samples (int): Number of configs to sample
+        seed (int): Random seed
+    """
+    def __init__(self, hyper_config, num_samples, seed=None):
+        self.hyper_config = _as_lists(hyper_config)
+        self.num_samples = num_samples
+        self.seed = seed
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        dims = num_dims(self.hyper_config)
+        strata = []
+        for _ in range(dims):
+            permutation = list(range(self.num_samples))
+            rng.shuffle(permutation)
+            strata.append(permutation)
+        for i in range(self.num_samples):
+            point = [(strata[d][i] + rng.random()) / self.num_samples for d in range(dims)]
+            yield unit_config(self.hyper_config, point)
+
+
+# Primitive polynomials and initial direction numbers for Sobol dimensions
+# 2 and up (S. Joe and F. Y. Kuo, new-joe-kuo-6.21201), as (s, a, m_1..m_s).
+SOBOL_DIRECTIONS = [
+    (1, 0, (1,)),
+    (2, 1, (1, 3)),
+    (3, 1, (1, 3, 1)),
+    (3, 2, (1, 1, 1)),
+    (4, 1, (1, 1, 3, 3)),
+    (4, 4, (1, 3, 5, 13)),
+    (5, 2, (1, 1, 5, 5, 17)),
+    (5, 4, (1, 1, 5, 5, 5)),
+    (5, 7, (1, 1, 7, 11, 19)),
+    (5, 11, (1, 1, 5, 1, 1)),
+    (5, 13, (1, 1, 1, 3, 11)),
+    (5, 14, (1, 3, 5, 5, 31)),
+    (6, 1, (1, 3, 3, 9, 7, 49)),
+    (6, 13, (1, 1, 1, 15, 21, 21)),
+    (6, 16, (1, 3, 1, 13, 27, 49)),
+    (6, 19, (1, 1, 1, 15, 7, 5)),
+    (6, 22, (1, 3, 1, 15, 13, 25)),
+    (6, 25, (1, 1, 5, 5, 19, 61)),
+    (7, 1, (1, 3, 7, 11, 23, 15, 103)),
+    (7, 4, (1, 3, 7, 13, 13, 15, 69)),
+]
+SOBOL_BITS = 32
+MAX_SOBOL_DIMS = len(SOBOL_DIRECTIONS) + 1
+
+
+def _sobol_direction_numbers(dim):
+    if dim == 0:
+        return [1 << (SOBOL_BITS - 1 - k) for k in range(SOBOL_BITS)]
+    s, a, m = SOBOL_DIRECTIONS[dim - 1]
+    v = [m[k] << (SOBOL_BITS - 1 - k) for k in range(s)]
+    for k in range(s, SOBOL_BITS):
+        value = v[k - s] ^ (v[k - s] >> s)
+        for j in range(1, s):
+            if (a >> (s - 1 - j)) & 1:
+                value ^= v[k - j]
+        v.append(value)
+    return v
+
+
+def sobol_sequence(dims, num_samples, seed=None):
+    """
+    Generates points of a Sobol sequence in the unit hypercube.
+
+    Args:
+        dims (int): Number of dimensions
+        num_samples (int): Number of points
+        seed (int): If set, points are scrambled with a random digital shift.
+    """
+    if dims > MAX_SOBOL_DIMS:
+        raise ValueError('Sobol sequences are supported for up to %d dimensions, got %d. '
+                         'Use LatinHypercubeSweeper instead.' % (MAX_SOBOL_DIMS, dims))
+    if num_samples > 2 ** SOBOL_BITS:
+        raise ValueError('Too many Sobol samples: %d' % num_samples)
+    directions = [_sobol_direction_numbers(d) for d in range(dims)]
+    if seed is None:
+        shifts = [0] * dims
+    else:
+        rng = random.Random(seed)
+        shifts = [rng.getrandbits(SOBOL_BITS) for _ in range(dims)]
+    x = [0] * dims
+    scale = 1.0 / (1 << SOBOL_BITS)
+    for i in range(num_samples):
+        if i > 0:
+            # Gray code ordering: flip the direction number of the lowest zero bit of i-1
+            c = (~(i - 1) & i).bit_length() - 1
+            for d in range(dims):
+                x[d] ^= directions[d][c]
+        yield [(x[d] ^ shifts[d]) * scale for d in range(dims)]
@@ -3,6 +3,8 @@ import contextlib
 import itertools
 import os
 import random
+import subprocess
+import sys
 
 from doodad import mode
 from doodad.utils import TESTING_DIR
@@ -26,6 +28,49 @@ class TestSweeper(unittest.TestCase):
         self.assertIn({'arg1': 2, 'arg2': 'b'}, cross_sweep)
 
 
+class TestChunker(unittest.TestCase):
+    def test_pack_chunks(self):
+        configs = [{'n': n} for n in [7, 5, 4, 3, 3, 2, 2, 2]]
+        chunks, loads = hyper_sweep.pack_chunks(configs, 3, cost_fn=lambda config: config['n'])
+        self.assertEqual(sorted(loads), [9, 9, 10])
+        self.assertEqual(sorted([config['n'] for chunk in chunks for config in chunk]),
+                         sorted([config['n'] for config in configs]))
+
+    def test_runtime_history(self):
+        history = hyper_sweep.RuntimeHistory()
+        self.assertEqual(history({'n': 1, 'm': 1}), history.default_cost)
+        history.record_log('\n'.join([
+            'other output',
+            '%s 10.0 --n 1 --m 1' % hyper_sweep.CHUNK_RUNTIME_PREFIX,
+            '%s 2.0 --n 2 --m 1' % hyper_sweep.CHUNK_RUNTIME_PREFIX,
+            '%s 4.0 --n 2 --m 2' % hyper_sweep.CHUNK_RUNTIME_PREFIX,
+        ]))
+        self.assertEqual(history({'n': 1, 'm': 1}), 10.0)
+        self.assertEqual(history({'n': 2, 'm': 3}), 3.0)
+        chunks = hyper_sweep.chunker([{'n': 1, 'm': 1}, {'n': 2, 'm': 1}, {'n': 2, 'm': 2}],
+                                     num_chunks=2, confirm=False, cost_fn=history)
+        self.assertEqual(chunks[0], [{'n': 1, 'm': 1}])
+        # in memory only
+        history.save()
+
+
+class TestChunkRunner(unittest.TestCase):
+    def test_run_chunk(self):
+        chunk = hyper_sweep.encode_chunk([hyper_sweep.make_cli_args({'n': 3}),
+                                          hyper_sweep.make_cli_args({'n': 5})])
+        runner = os.path.join(hyper_sweep.CHUNK_RUNNER_DIR, hyper_sweep.CHUNK_RUNNER_SCRIPT)
+        output = subprocess.check_output([sys.executable, runner, SWEEPER_TEST_FILE, chunk])
+        self.assertEqual(output.decode('utf-8').splitlines(), ['3', '5'])
+
+    def test_run_chunk_parallel(self):
+        chunk = hyper_sweep.encode_chunk([hyper_sweep.make_cli_args({'n': n}) for n in range(6)])
+        runner = os.path.join(hyper_sweep.CHUNK_RUNNER_DIR, hyper_sweep.CHUNK_RUNNER_SCRIPT)
+        for num_slots in ['3', '0']:
+            output = subprocess.check_output([sys.executable, runner, '--num-slots', num_slots,
+                                              SWEEPER_TEST_FILE, chunk], stderr=subprocess.DEVNULL)
+            self.assertEqual(output.decode('utf-8').splitlines(), [str(n) for n in range(6)])
+
+
 class TestDoodadSweep(unittest.TestCase):
     def setUp(self):
         self.sweeper = launcher.DoodadSweeper()
@@ -0,0 +1,82 @@
+import unittest
+import itertools
+
+from doodad.wrappers.sweeper import samplers
+
+
+class TestGrid(unittest.TestCase):
+    def test_product_order(self):
+        params = {'a': [1, 2, 3], 'b': ['x', 'y'], 'c': [True, False]}
+        expected = [dict(zip(params.keys(), values))
+                    for values in itertools.product(*params.values())]
+        self.assertEqual(list(samplers.GridSweeper(params)), expected)
+
+    def test_iterables(self):
+        params = {'a': (n for n in [1, 2, 3]), 'b': {'x'}, 'c': (True, False)}
+        configs = list(samplers.GridSweeper(params))
+        self.assertEqual(len(configs), 6)
+        self.assertEqual(configs[0], {'a': 1, 'b': 'x', 'c': True})
+        self.assertEqual(configs[-1], {'a': 3, 'b': 'x', 'c': False})
+
+    def test_conditional(self):
+        params = {
+            'seed': [1, 2],
+            'optimizer': samplers.Conditional({
+                'adam': {'beta1': [0.9, 0.99]},
+                'sgd': {},
+            }),
+        }
+        configs = list(samplers.GridSweeper(params))
+        self.assertEqual(len(configs), 6)
+        self.assertIn({'seed': 2, 'optimizer': 'adam', 'beta1': 0.99}, configs)
+        self.assertIn({'seed': 1, 'optimizer': 'sgd'}, configs)
+
+
+class TestSamplers(unittest.TestCase):
+    def setUp(self):
+        # 10^8 configs
+        self.large_grid = {'p%d' % i: list(range(10)) for i in range(8)}
+
+    def test_random_large_grid(self):
+        sweeper = samplers.RandomSweeper(self.large_grid, num_samples=500, seed=0)
+        configs = list(sweeper)
+        self.assertEqual(len(configs), 500)
+        keys = set([tuple(config.values()) for config in configs])
+        self.assertEqual(len(keys), 500)
+        self.assertEqual(configs, list(sweeper))
+
+    def test_random_without_replacement(self):
+        configs = list(samplers.RandomSweeper({'a': [1, 2, 3]}, num_samples=10, seed=0))
+        self.assertEqual(sorted([config['a'] for config in configs]), [1, 2, 3])
+
+    def test_sobol(self):
+        points = list(samplers.sobol_sequence(2, 4))
+        self.assertEqual(points, [[0.0, 0.0], [0.5, 0.5], [0.75, 0.25], [0.25, 0.75]])
+        # each coordinate of the first 2^m points is stratified
+        points = list(samplers.sobol_sequence(samplers.MAX_SOBOL_DIMS, 64, seed=1))
+        for d in range(samplers.MAX_SOBOL_DIMS):
+            self.assertEqual(sorted([int(point[d] * 64) for point in points]), list(range(64)))
+
+    def test_latin_hypercube(self):
+        params = {'lr': samplers.LogUniform(1e-4, 1e-1), 'x': samplers.Uniform(0, 10)}
+        configs = list(samplers.LatinHypercubeSweeper(params, num_samples=10, seed=0))
+        self.assertEqual(sorted([int(config['x']) for config in configs]), list(range(10)))
+        for config in configs:
+            self.assertTrue(1e-4 <= config['lr'] <= 1e-1)
+
+    def test_conditional(self):
+        params = {
+            'optimizer': samplers.Conditional({
+                'adam': {'beta1': samplers.Uniform(0.8, 1.0)},
+                'sgd': {'momentum': [0.0, 0.9]},
+            }),
+        }
+        for config in samplers.SobolSweeper(params, num_samples=16):
+            if config['optimizer'] == 'adam':
+                self.assertEqual(set(config.keys()), {'optimizer', 'beta1'})
+            else:
+                self.assertEqual(set(config.keys()), {'optimizer', 'momentum'})
+
+
+if __name__ == '__main__':
+    unittest.main()
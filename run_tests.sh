@@ -1 +1 @@
-python -m unittest discover .
+DOODAD_JOB_DB=:memory: python -m unittest discover .
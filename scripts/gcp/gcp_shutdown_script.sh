@@ -8,7 +8,14 @@ bucket_name=$(query_metadata bucket_name)
 gcp_bucket_path=$(query_metadata gcp_bucket_path)
 instance_name=$(curl http://metadata/computeMetadata/v1/instance/name -H "Metadata-Flavor: Google")
 
-gsutil cp -r /doodad/* gs://$bucket_name/$gcp_bucket_path/outputs
+if [ -f /tmp/doodad_sync/sync.sh ]; then
+    # syncs each mount with its filters, see gcp_startup_script.sh
+    export DOODAD_SYNC_MANIFEST_DIR=/tmp/doodad_sync
+    . $DOODAD_SYNC_MANIFEST_DIR/sync.sh
+    doodad_sync 1
+else
+    gsutil cp -r /doodad/* gs://$bucket_name/$gcp_bucket_path/outputs
+fi
 # sync stdout
 gcp_bucket_path=${gcp_bucket_path%/}  # remove trailing slash if present
 gsutil cp /home/ubuntu/user_data.log gs://$bucket_name/$gcp_bucket_path/${instance_name}_stdout.log
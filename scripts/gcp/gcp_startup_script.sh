@@ -45,11 +45,32 @@ query_metadata() {
 
     # sync mount
     # Because GCPMode has no idea where the mounts are (the archive has them)
-    # we just make the archive store everything into /doodad
+    # we just make the archive store everything into /doodad.
+    # Each MountGCP in the archive writes a manifest with its directory, sync
+    # interval and exclude regex (see MountGCP.dar_host_command), and is
+    # synced on its own schedule. Without manifests, all of /doodad is synced.
     mkdir -p /doodad
+    export DOODAD_SYNC_MANIFEST_DIR=/tmp/doodad_sync
+    mkdir -p $DOODAD_SYNC_MANIFEST_DIR
+    doodad_sync() {
+        now=$(date +%s)
+        manifests=$(ls $DOODAD_SYNC_MANIFEST_DIR/*.conf 2> /dev/null)
+        for manifest in ${manifests:-$DOODAD_SYNC_MANIFEST_DIR/default}; do
+            SYNC_DIR=/doodad; SYNC_INTERVAL=$data_sync_interval; SYNC_ARGS=()
+            [ -f $manifest ] && . $manifest
+            # pass 1 to sync every mount regardless of its interval
+            if [ "$1" = "1" ] || [ $now -ge $(cat $manifest.due 2> /dev/null || echo 0) ]; then
+                mkdir -p $SYNC_DIR
+                gsutil -m rsync -r "${SYNC_ARGS[@]}" $SYNC_DIR gs://$bucket_name/$gcp_bucket_path/outputs${SYNC_DIR#/doodad}
+                echo $((now + SYNC_INTERVAL)) > $manifest.due
+            fi
+        done
+    }
+    # used by the shutdown script
+    declare -f doodad_sync > $DOODAD_SYNC_MANIFEST_DIR/sync.sh
     while /bin/true; do
-        gsutil -m rsync -r /doodad gs://$bucket_name/$gcp_bucket_path/outputs
-        sleep $data_sync_interval
+        doodad_sync
+        sleep 5
     done & echo sync from /doodad to gs://$bucket_name/$gcp_bucket_path/outputs initiated
 
     # sync stdout
@@ -71,6 +92,7 @@ query_metadata() {
     #echo $run_script_cmd >> run_script_cmd.sh
     #bash run_script_cmd.sh
     $shell_interpreter /tmp/remote_script.sh $script_args
+    doodad_sync 1
 
     if [ "$terminate" = "true" ]; then
         echo "Finished experiment. Terminating"